@@ -1,23 +1,287 @@
-from flask import Flask, jsonify, request, send_from_directory
-from optimize import run_optimization
+import os
+import threading
+
+from flask import Flask, Response, jsonify, request, send_from_directory
+from dof import Unsolvable
+from drag_channel import ChannelRegistry
+from metrics import enable_json_log, registry
+from protocol import PARSE_ERRORS, parse_batch, parse_problem, parse_target, parse_trajectory, points_to_json
+from solver_pool import Overloaded, SolverPool, UnknownSession
+from wire import (DELTA, MEDIA_TYPE, PROBLEM, decode_delta, decode_problem, encode_delta_result, encode_result,
+                  message_kind)
 
 app = Flask(__name__)
 
-print("here")
+# ソルバーのワーカープロセス (最初のリクエストで起動します)
+pool = None
+pool_lock = threading.Lock()
+
+# ドラッグ中の目標位置を受け付けるストリーミングチャンネル
+channels = ChannelRegistry()
+
+# 締め切りに加えて、プロセス間のやり取りのために待つ時間 (秒)
+RESULT_GRACE = 0.1
+
+# 時間の予算付きのドラッグで、途中の解を裏で解き続けるときの1回分の時間 (秒)
+# (この間に届いた次の目標位置は、この時間だけ待たされます)
+REFINE_BUDGET = 0.05
+
+# SOLVER_METRICS_LOG=1 のとき、解くたびの計測値をJSONで1行ずつ標準エラーに出力します。
+if os.environ.get('SOLVER_METRICS_LOG'):
+    enable_json_log()
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = SolverPool()
+        return pool
+
+def wait(future):
+    """
+    Wait for a solve until its deadline.
+    :return: (result, None), or (None, (JSON error body, HTTP status)) if it did not succeed.
+    """
+    try:
+        return future.result(timeout=get_pool().timeout + RESULT_GRACE), None
+    except TimeoutError:
+        return None, ({'status': 'timeout'}, 504)
+    except UnknownSession:
+        return None, ({'error': 'unknown session'}, 404)
+    except Unsolvable as e:
+        # 矛盾した制約 (どの制約が過剰で、どれが矛盾しているかを返します)
+        return None, ({'status': 'unsolvable', **e.report}, 422)
+    except RuntimeError as e:
+        return None, ({'status': 'error', 'error': str(e)}, 500)
+
+def collect(future, names, batch=False, trajectory=False, anytime=False, delta=False):
+    """
+    Wait for a solve until its deadline.
+    :param batch: The future is of a batch solve; the body lists every problem's points and success.
+    :param trajectory: The future is of a trajectory solve; the body lists every frame's points with the report.
+    :param anytime: The future is of a session solve with a time budget; the body has the points,
+        whether they are provisional and their constraint violation.
+    :param delta: The future is of a delta session solve; the body has only the points that moved.
+    :return: (JSON body, HTTP status)
+    """
+    value, error = wait(future)
+    if error is not None:
+        return error
+    if delta:
+        indices, coordinates, success = value
+        return {'changed': points_to_json([names[i] for i in indices], coordinates), 'success': bool(success)}, 200
+    x, success = value
+    if trajectory:
+        return {'frames': [points_to_json(names, frame) for frame in x], **success}, 200
+    if anytime:
+        return {'points': points_to_json(names, x), **success}, 200
+    if batch:
+        return {'results': [{'points': points_to_json(names, xi), 'success': bool(s)} for xi, s in zip(x, success)]}, 200
+    return points_to_json(names, x), 200
+
+def wait_result(future, names):
+    body, status = collect(future, names)
+
+    # 結果をJSON形式で返す
+    return jsonify(body), status
 
 @app.route('/')
 def serve():
     return send_from_directory(app.static_folder, 'index.html')
 
+@app.route('/metrics')
+def serve_metrics():
+    # Prometheusのテキスト形式
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/session', methods=['POST'])
+def create_session():
+    try:
+        problem = decode_problem(request.get_data()) if request.mimetype == MEDIA_TYPE else parse_problem(request.get_json())
+    except PARSE_ERRORS as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        session_id = get_pool().create_session(problem)
+    except Unsolvable as e:
+        return jsonify({'status': 'unsolvable', **e.report}), 422
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+    except TimeoutError:
+        return jsonify({'status': 'timeout'}), 504
+    return jsonify({'session': session_id})
+
+@app.route('/session/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    try:
+        found = get_pool().delete_session(session_id)
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+    if not found:
+        return jsonify({'error': 'unknown session'}), 404
+    return jsonify({})
+
 @app.route('/optimize', methods=['POST'])
 def optimize():
+    if request.mimetype == MEDIA_TYPE:
+        return optimize_binary()
     data = request.get_json()
-    
-    # run_optimization関数を呼び出して最適化問題を解く
-    result = run_optimization(data)
 
-    # 結果をJSON形式で返す
-    return jsonify(result)
+    # ワーカーに渡す前に読み取り、不正なリクエストは 400 で返す
+    if not isinstance(data, dict):
+        return jsonify({'error': 'expected a JSON object'}), 400
+    try:
+        session_id = data.get('session')
+        if session_id is not None:
+            names = get_pool().session_names(session_id)
+            target = parse_target(data['target'], names)
+            tolerance = float(data['tolerance']) if 'tolerance' in data else None
+        else:
+            problem = parse_problem(data)
+            names = problem.names
+    except UnknownSession:
+        return jsonify({'error': 'unknown session'}), 404
+    except PARSE_ERRORS as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        # セッションがあれば直前のフレームの解から解き直す
+        if session_id is not None:
+            # tolerance があれば、前回から動いた点だけを返す (差分モード)
+            if tolerance is not None:
+                future = get_pool().solve_session_delta(session_id, *target, tolerance)
+                body, status = collect(future, names, delta=True)
+                return jsonify(body), status
+            future = get_pool().solve_session(session_id, *target)
+        # なければワーカーで最適化問題を一から解く
+        else:
+            future = get_pool().solve(problem)
+    except UnknownSession:
+        return jsonify({'error': 'unknown session'}), 404
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+
+    return wait_result(future, names)
+
+def optimize_binary():
+    # バイナリ形式 (wire.py): 問題を1回解くか、セッションの差分モードのフレームを解く
+    body = request.get_data()
+    try:
+        kind = message_kind(body)
+        if kind == DELTA:
+            session_id, target_index, target_x, target_y, tolerance = decode_delta(body)
+            if not 0 <= target_index < len(get_pool().session_names(session_id)):
+                raise ValueError('the dragged point does not exist')
+            future = get_pool().solve_session_delta(session_id, target_index, target_x, target_y, tolerance)
+        elif kind == PROBLEM:
+            future = get_pool().solve(decode_problem(body))
+        else:
+            raise ValueError(f'cannot solve a message of kind {kind}')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except UnknownSession:
+        return jsonify({'error': 'unknown session'}), 404
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+
+    value, error = wait(future)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    data = encode_delta_result(*value) if kind == DELTA else encode_result(*value)
+    return Response(data, mimetype=MEDIA_TYPE)
+
+@app.route('/optimize/batch', methods=['POST'])
+def optimize_batch():
+    # 同じ問題を複数の目標位置 (と初期配置) についてまとめて解く
+    try:
+        problem, initial_points, targets, target_index = parse_batch(request.get_json())
+    except PARSE_ERRORS as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        future = get_pool().solve_batch(problem, initial_points, targets, target_index)
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+
+    body, status = collect(future, problem.names, batch=True)
+    return jsonify(body), status
+
+@app.route('/optimize/trajectory', methods=['POST'])
+def optimize_trajectory():
+    # 点を経路に沿って動かし、全フレームの解をまとめて返す (アニメーション用)
+    try:
+        problem, targets, target_index = parse_trajectory(request.get_json())
+    except PARSE_ERRORS as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        future = get_pool().solve_trajectory(problem, targets, target_index)
+    except Overloaded:
+        return jsonify({'status': 'overloaded'}), 503
+
+    body, status = collect(future, problem.names, trajectory=True)
+    return jsonify(body), status
+
+@app.route('/drag/<session_id>', methods=['POST'])
+def drag(session_id):
+    # 目標位置はここで検証し、解析済みの (点の番号, x, y) をチャンネルに入れます
+    data = request.get_json(silent=True)
+    try:
+        names = get_pool().session_names(session_id)
+    except UnknownSession:
+        return jsonify({'error': 'unknown session'}), 404
+    try:
+        if not isinstance(data, dict):
+            raise ValueError('the body must be a JSON object')
+        seq = data['seq']
+        if isinstance(seq, bool) or not isinstance(seq, int):
+            raise ValueError('seq must be an integer')
+        target = parse_target(data['target'], names)
+    except PARSE_ERRORS as e:
+        return jsonify({'error': str(e)}), 400
+    channels.get(session_id).push(seq, target)
+    return jsonify({}), 202
+
+@app.route('/drag/<session_id>/stream')
+def drag_stream(session_id):
+    try:
+        names = get_pool().session_names(session_id)
+    except UnknownSession:
+        return jsonify({'error': 'unknown session'}), 404
+    # ?budget=0.016 で1フレームの時間を秒で制限し、収束しなかった解は途中の解として送ってから
+    # 裏で解き続けます (?refine=0 で解き続けません)。
+    budget = request.args.get('budget', type=float)
+    refine_enabled = budget is not None and request.args.get('refine', '1') != '0'
+    channel = channels.get(session_id)
+
+    def solve(target):
+        try:
+            future = get_pool().solve_session(session_id, *target, budget=budget)
+        except UnknownSession:
+            return {'error': 'unknown session', 'final': True}
+        except Overloaded:
+            return {'status': 'overloaded'}
+        body, status = collect(future, names, anytime=budget is not None)
+        if status == 200:
+            return body if budget is not None else {'points': body}
+        return dict(body, final=status == 404)
+
+    def refine():
+        try:
+            future = get_pool().refine_session(session_id, REFINE_BUDGET)
+        except (UnknownSession, Overloaded):
+            return None
+        body, status = collect(future, names, anytime=True)
+        if status != 200:
+            return None
+        return dict(body, refined=True)
+
+    def stream():
+        try:
+            yield from channel.events(solve, refine=refine if refine_enabled else None)
+        finally:
+            channels.remove(session_id, channel)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
@@ -0,0 +1,393 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from optimize import NORMALIZED_FTOL, compile_constraints, objective_function, objective_gradient
+
+###########################################
+# ソルバーのバックエンド
+#
+# solve_problem が使う解法を名前で登録します。どのバックエンドも
+#   solve(compiled, 初期座標, 目標x, 目標y, ドラッグする点, callback, options) → OptimizeResult
+# の形で、反復ごとに callback(x) を呼び (StopIteration で打ち切り、status 99)、
+# nit, nfev, njev と制約の最大違反 maxcv を返します。登録していない名前は scipy.optimize.minimize の method として扱います。
+#
+# method を指定しないときは、問題の特徴 (変数の数の桁、制約と変数の数の比、カーネルの種類の組み合わせ) から
+# 自動調整の表を引いて選びます。ヤコビアンの1行が触る座標の数はカーネルの種類で決まるので、
+# 疎の度合いは変数の数と種類の組み合わせで決まります。
+# 表は代表的なスケッチ (benchmark.GENERATORS: 距離だけのスケッチと、rectangles と sliders で
+# 残りの種類の制約) で候補を時間を計って解き、収束した中で一番速いものを特徴ごとに記録したJSONです。
+#   python backends.py --tune            (SOLVER_AUTOTUNE の場所か、このディレクトリの autotune.json に保存)
+# 組み合わせは実際のスケッチごとに違うので、表にない特徴は近い記録で代用します (choose_backend)。
+# 同じ比の記録のうち、共通のカーネルの種類の割合が一番大きく、次に桁が一番近いものを使い、
+# 共通の種類がある記録がなければ大きさだけで選びます (default_backend)。
+###########################################
+
+class Backend:
+    """
+    One way of solving the drag problem.
+    :param solve: solve(compiled, initial_point, target_x, target_y, target_index, callback, options).
+    :param normalize: Solve in normalized coordinates (see scaling.ScaledConstraints).
+    :param normalized_options: Default options when solving in normalized coordinates.
+    :param max_variables: Largest problem worth trying (dense backends), or None.
+    :param iteration_cost: Seconds per cubed number of variables of one iteration, for backends whose
+        iterations cannot be interrupted and grow with the cube of the size (see first_iteration_time), or None.
+    """
+    def __init__(self, name, solve, normalize=True, normalized_options=None, max_variables=None,
+                 iteration_cost=None):
+        self.name = name
+        self.solve = solve
+        self.normalize = normalize
+        self.normalized_options = normalized_options
+        self.max_variables = max_variables
+        self.iteration_cost = iteration_cost
+
+    def first_iteration_time(self, variable_count):
+        """
+        Rough time in seconds before the first callback, or 0 if the backend can stop at any evaluation.
+        """
+        if self.iteration_cost is None:
+            return 0.0
+        return self.iteration_cost * variable_count ** 3
+
+# 名前 → Backend
+BACKENDS = {}
+
+def register_backend(name, normalize=True, normalized_options=None, max_variables=None, iteration_cost=None):
+    """
+    Decorator registering a solve function as a backend.
+    """
+    def decorator(solve):
+        BACKENDS[name] = Backend(name, solve, normalize, normalized_options, max_variables, iteration_cost)
+        return solve
+    return decorator
+
+def get_backend(name):
+    """
+    :return: The registered Backend, or one running scipy.optimize.minimize with method name.
+    """
+    if name in BACKENDS:
+        return BACKENDS[name]
+    return Backend(name, lambda *args: _minimize(name, *args))
+
+def _maxcv(compiled, x):
+    return float(np.max(np.abs(compiled.residuals(x)), initial=0.0))
+
+###########################################
+# バックエンド
+
+def _minimize(method, compiled, initial_point, target_x, target_y, target_index, callback, options):
+    # scipyは最初に解くときに読み込みます (importを軽くするため)。
+    from scipy.optimize import minimize
+
+    # 全ての制約をNumPy配列にまとめ、1つのベクトル値の等式制約として渡します。
+    scipy_constraints = []
+    if compiled.size:
+        scipy_constraints.append({
+            'type': 'eq',                # 等式制約を指定します。
+            'fun': compiled.residuals,   # 全制約の残差ベクトルを返す関数
+            'jac': compiled.jacobian,    # 残差ベクトルの解析的ヤコビアン
+        })
+
+    # 目的関数に渡す追加の引数
+    additional_args = (target_x, target_y, target_index)
+
+    # 最適化を実行
+    return minimize(
+        fun = objective_function,        # 最小化する目的関数
+        x0 = initial_point,              # 最適化の初期推定値
+        args = additional_args,          # 目的関数に渡す追加の引数
+        jac = objective_gradient,        # 目的関数の解析的勾配
+        method = method,                 # 最適化アルゴリズム (Noneなら自動選択)
+        callback = callback,             # 反復ごとに呼ばれる関数 (StopIterationで打ち切り)
+        constraints = scipy_constraints, # 最適化に適用する制約条件
+        options = options                # 収束判定などの設定 (Noneなら既定値)
+    )
+
+# iteration_cost は格子のスケッチで1反復目を計った値に余裕を持たせたものです
+# (800変数で SLSQP 約0.03秒、trust-constr 約0.6秒)。
+@register_backend('SLSQP', normalized_options={'ftol': NORMALIZED_FTOL}, max_variables=1000, iteration_cost=1e-10)
+def slsqp(compiled, initial_point, target_x, target_y, target_index, callback, options):
+    """
+    Sequential least squares programming with the dense Jacobian.
+    """
+    return _minimize('SLSQP', compiled, initial_point, target_x, target_y, target_index, callback, options)
+
+@register_backend('trust-constr', max_variables=5000, iteration_cost=2e-9)
+def trust_constr(compiled, initial_point, target_x, target_y, target_index, callback, options):
+    """
+    Interior point / SQP trust region with sparse Jacobians and exact Hessians.
+    """
+    from scipy.optimize import NonlinearConstraint, minimize
+    from scipy.sparse import coo_matrix
+
+    n = len(initial_point)
+    # 目的関数のヘッセ行列は対象点の2座標だけが2です。
+    cols = [2 * target_index, 2 * target_index + 1]
+    objective_hessian = coo_matrix(([2.0, 2.0], (cols, cols)), shape=(n, n)).tocsr()
+
+    def constraint_hessian(x, multipliers):
+        rows, cols, values = compiled.hessian_entries(x, multipliers)
+        return coo_matrix((values, (rows, cols)), shape=(n, n)).tocsr()
+
+    constraints = []
+    if compiled.size:
+        constraints.append(NonlinearConstraint(compiled.residuals, 0.0, 0.0, jac=compiled.jacobian_sparse,
+                                               hess=constraint_hessian))
+    # trust-constr はコールバックを callback(x, state) で呼ぶので、他の解法と同じく x だけを渡します。
+    result = minimize(objective_function, initial_point, args=(target_x, target_y, target_index),
+                      jac=objective_gradient, hess=lambda *args: objective_hessian, method='trust-constr',
+                      constraints=constraints, callback=None if callback is None else lambda x, state: callback(x),
+                      options=options)
+    if result.status == 3:
+        # trust-constr はコールバックの StopIteration を status 3 で返すので、他の解法とそろえます。
+        result.status = 99
+    result.maxcv = _maxcv(compiled, result.x)
+    return result
+
+@register_backend('least-squares', max_variables=200000)
+def least_squares(compiled, initial_point, target_x, target_y, target_index, callback, options):
+    """
+    Penalty formulation solved as a sequence of sparse nonlinear least squares problems,
+    min |x_t - target|^2 + w^2 |c(x)|^2 with w growing by the factors in options['weights'].
+    options['tol'] is the constraint violation required for success.
+    """
+    from scipy.optimize import OptimizeResult
+    from scipy.optimize import least_squares as solve_least_squares
+    from scipy.sparse import coo_matrix, vstack
+
+    options = dict(options or {})
+    weights = options.pop('weights', (1e2, 1e4, 1e6))
+    tol = options.pop('tol', 1e-8)
+    n = len(initial_point)
+    cols = np.array([2 * target_index, 2 * target_index + 1])
+    target = np.array([target_x, target_y], dtype=float)
+    # 目標位置との差の2行
+    pull = coo_matrix(([1.0, 1.0], ([0, 1], cols)), shape=(2, n)).tocsr()
+
+    x = np.array(initial_point, dtype=float)
+    nit = nfev = njev = 0
+    status, message = 0, 'Optimization terminated successfully'
+    for weight in weights:
+        result = solve_least_squares(
+            lambda z: np.concatenate([weight * compiled.residuals(z), z[cols] - target]), x,
+            jac=lambda z: vstack([weight * compiled.jacobian_sparse(z), pull]).tocsr(),
+            method='trf', tr_solver='lsmr', x_scale=1.0,
+            # least_squares は引数の名前でコールバックの呼び方を決めるので、x を受け取る形にそろえます。
+            callback=None if callback is None else lambda x: callback(x), **options)
+        x = result.x
+        nit += 1
+        nfev += result.nfev
+        njev += result.njev or 0
+        if result.status == -2:
+            status, message = 99, '`callback` raised `StopIteration`.'
+            break
+        if not compiled.size:
+            break
+    maxcv = _maxcv(compiled, x)
+    if status == 0 and maxcv > tol:
+        status, message = 4, 'Constraints not satisfied at the largest penalty weight'
+    return OptimizeResult(x=x, success=status == 0, status=status, message=message,
+                          fun=objective_function(x, target_x, target_y, target_index), maxcv=maxcv,
+                          nit=nit, nfev=nfev, njev=njev)
+
+@register_backend('sparse-lm', normalize=False)
+def sparse_lm(compiled, initial_point, target_x, target_y, target_index, callback, options):
+    """
+    Sparse constrained Gauss-Newton / Levenberg-Marquardt (see sparse_solver).
+    """
+    from sparse_solver import solve_sparse
+
+    return solve_sparse(compiled, initial_point, target_x, target_y, target_index, callback=callback,
+                        **(options or {}))
+
+###########################################
+# 自動選択
+
+# SOLVER_AUTOTUNE で場所を変えられます。
+TABLE_PATH = os.environ.get('SOLVER_AUTOTUNE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             'autotune.json'))
+
+# 表に何もないときに密なSLSQPを使う変数の数の上限
+DENSE_LIMIT = 600
+
+_table = None
+
+def problem_features(compiled, variable_count):
+    """
+    :return: (size class, constraint to variable ratio class, kernel mix) of a problem.
+    """
+    size = 10 ** max(math.ceil(math.log10(max(variable_count, 1))), 1)
+    ratio = compiled.size / max(variable_count, 1)
+    ratio_class = 'loose' if ratio < 0.5 else 'tight' if ratio <= 1 else 'over'
+    mix = '+'.join(sorted(type(kernel).__name__ for kernel in compiled.kernels)) or 'none'
+    return size, ratio_class, mix
+
+def table_key(features):
+    return '/'.join(str(feature) for feature in features)
+
+def load_table(path=None):
+    """
+    :return: The autotuning table {feature key: {'backend': name, 'timings': {name: seconds or None}}}.
+    """
+    try:
+        with open(path or TABLE_PATH) as f:
+            return json.load(f)['entries']
+    except FileNotFoundError:
+        return {}
+
+def save_table(entries, path=None):
+    with open(path or TABLE_PATH, 'w') as f:
+        json.dump({'version': 1, 'entries': entries}, f, indent=1, sort_keys=True)
+
+def default_backend(variable_count):
+    return 'SLSQP' if variable_count <= DENSE_LIMIT else 'sparse-lm'
+
+def choose_backend(compiled, variable_count, table=None):
+    """
+    The backend name for a problem, from the autotuning table.
+    Without an entry for its exact features, the entry with the same ratio class and the most similar
+    kernel mix (then the nearest size) is used; if no entry shares a kernel kind, default_backend.
+    :param table: The table to use (default: the one at TABLE_PATH, read once).
+    """
+    global _table
+
+    if table is None:
+        if _table is None:
+            _table = load_table()
+        table = _table
+    features = problem_features(compiled, variable_count)
+    entry = table.get(table_key(features))
+    if entry is None:
+        # 同じ比の記録のうち、カーネルの種類の組み合わせが一番似ていて (共通の種類の割合)、
+        # 次に変数の数の桁が一番近いものを使います。共通の種類がなければ使いません。
+        size, ratio_class, mix = features
+        kinds = set(mix.split('+'))
+        nearby = []
+        for key, candidate in table.items():
+            key_size, key_ratio, key_mix = key.split('/', 2)
+            key_kinds = set(key_mix.split('+'))
+            if key_ratio == ratio_class and kinds & key_kinds:
+                similarity = len(kinds & key_kinds) / len(kinds | key_kinds)
+                nearby.append(((-similarity, abs(math.log10(int(key_size) / size))), candidate))
+        entry = min(nearby, key=lambda item: item[0])[1] if nearby else None
+    if entry is None:
+        return default_backend(variable_count)
+    backend = BACKENDS.get(entry['backend'])
+    if backend is None or (backend.max_variables is not None and variable_count > backend.max_variables):
+        return default_backend(variable_count)
+    return entry['backend']
+
+###########################################
+# 自動調整
+
+def representative_problems(generators=None, sizes=(10, 100, 1000, 10000)):
+    """
+    The problems solve_problem gets when dragging the benchmark sketches: the dragged
+    component of each, with its fixed points presolved away, and for sketches of several
+    components also the whole sketch as given, as when solve_problem is called directly.
+    :return: [(name, compiled, initial point, target_x, target_y, target_index), ...]
+    """
+    from benchmark import GENERATORS, FixedDistanceConstraint
+    from decompose import Decomposition
+    from presolve import Presolve
+
+    problems = []
+    for generator in generators or GENERATORS:
+        for size in sizes:
+            constraints, xy, target_index = GENERATORS[generator](size)
+            decomposition = Decomposition(constraints, len(xy))
+            # benchmark.run_case と同じく、リンクの長さの中央値の10%だけ動かします。
+            lengths = [c.distance for c in constraints if isinstance(c, FixedDistanceConstraint)]
+            step = 0.1 * float(np.median(lengths)) if lengths else 1.0
+            target_x, target_y = xy[target_index] + step * np.array([0.6, 0.8])
+            if len(decomposition.components) > 1:
+                # 分解も前処理もしない全体は、二乗距離の固定点の残差で退化していて、正規化した単位では
+                # 収束したように見えても元の単位で制約を破るバックエンドがあります。
+                problems.append((f'{generator}/{size}/whole', compile_constraints(constraints), xy.ravel(),
+                                 target_x, target_y, target_index))
+            component = decomposition.component(target_index)
+            local = xy.ravel()[component.columns]
+            presolve = Presolve(component.compiled.constraints, local)
+            reduced_target = presolve.target_index(component.local_index(target_index))
+            if reduced_target is None or not presolve.system.size:
+                continue
+            problems.append((f'{generator}/{size}', presolve.system, presolve.reduce(local),
+                             target_x, target_y, reduced_target))
+    return problems
+
+def time_backend(name, problem, repeat=3, tol=1e-6, timeout=10.0):
+    """
+    :return: Best wall time of solving problem with the backend, or None if it did not
+        converge (constraint violation over tol) or took longer than timeout.
+    """
+    from optimize import solve_problem
+
+    _, compiled, x0, target_x, target_y, target_index = problem
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = solve_problem(compiled, x0, target_x, target_y, target_index, method=name,
+                               deadline=time.monotonic() + timeout)
+        wall = time.perf_counter() - start
+        if not result.success or _maxcv(compiled, result.x) > tol:
+            return None
+        best = wall if best is None else min(best, wall)
+    return best
+
+def autotune(problems, candidates=None, repeat=3, log=sys.stderr):
+    """
+    Time every candidate backend on every problem and keep, for each feature key,
+    the fastest backend that converged on all its problems.
+    :return: The autotuning table entries.
+    """
+    totals = {}
+    for problem in problems:
+        name, compiled, x0 = problem[:3]
+        key = table_key(problem_features(compiled, len(x0)))
+        timings = totals.setdefault(key, {})
+        for candidate in candidates or BACKENDS:
+            backend = get_backend(candidate)
+            if backend.max_variables is not None and len(x0) > backend.max_variables:
+                # 同じ特徴の問題を全部は解けないので、その特徴では選びません。
+                timings[candidate] = None
+                continue
+            if candidate in timings and timings[candidate] is None:
+                continue
+            wall = time_backend(candidate, problem, repeat)
+            timings[candidate] = None if wall is None else timings.get(candidate, 0.0) + wall
+            if log is not None:
+                shown = 'failed' if wall is None else f'{wall * 1000:.2f} ms'
+                print(f'{name:24s} {key:50s} {candidate:14s} {shown}', file=log)
+
+    entries = {}
+    for key, timings in totals.items():
+        converged = {candidate: wall for candidate, wall in timings.items() if wall is not None}
+        if converged:
+            entries[key] = {'backend': min(converged, key=converged.get), 'timings': timings}
+    return entries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the autotuning table of the solver backends.')
+    parser.add_argument('--tune', action='store_true', help='time the backends and save the table')
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help=f'where to save the table (default: {TABLE_PATH})')
+    args = parser.parse_args(argv)
+
+    if not args.tune:
+        for key, entry in sorted(load_table(args.output).items()):
+            print(f"{key:50s} {entry['backend']}")
+        return 0
+    problems = representative_problems(sizes=[int(s) for s in args.sizes.split(',')])
+    save_table(autotune(problems, args.backends.split(','), args.repeat), args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
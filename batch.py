@@ -0,0 +1,98 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+
+from decompose import Decomposition
+from metrics import Stopwatch, enable_json_log, registry, solve_record
+from protocol import parse_problem, points_to_json
+
+###########################################
+# まとめて解くコマンド
+#
+# /optimize と同じ形式の問題を1行に1つ書いたJSONLを読み、解を1行ずつJSONLで書き出します。
+# 行に "id" があれば解にもそのまま付けます。--processes でワーカープロセスに振り分けます
+# (出力の順番は入力と同じです)。
+#
+#   python batch.py problems.jsonl -o solutions.jsonl --processes 8
+#   cat problems.jsonl | python batch.py > solutions.jsonl
+###########################################
+
+def solve_line(numbered_line, method=None):
+    """
+    Solve one JSONL line.
+    :param numbered_line: (line number, text of the line).
+    :return: (output dictionary, metrics record or None if the line could not be solved)
+    """
+    number, line = numbered_line
+    try:
+        data = json.loads(line)
+        problem = parse_problem(data)
+        with Stopwatch() as stopwatch:
+            decomposition = Decomposition(problem.constraints, len(problem.points_array) // 2)
+            x, results = decomposition.solve(problem.points_array, problem.target_x, problem.target_y,
+                                             problem.target_index, method=method)
+        success = bool(results[decomposition.component_of[problem.target_index]].success)
+    except Exception as e:
+        return {'line': number, 'error': repr(e)}, None
+
+    output = {'points': points_to_json(problem.names, x), 'success': success}
+    if 'id' in data:
+        output = {'id': data['id'], **output}
+    record = solve_record('batch', stopwatch, list(results.values()), success, len(problem.names),
+                          len(problem.constraints))
+    return output, record
+
+def _solve_line(args):
+    return solve_line(*args)
+
+def solve_stream(lines, processes=1, method=None, chunksize=16):
+    """
+    Solve a stream of JSONL lines, in order.
+    :param processes: Number of worker processes (None: one per CPU); 1 solves in this process.
+    :return: Iterator of (output dictionary, metrics record or None).
+    """
+    tasks = (((number, line), method) for number, line in enumerate(lines, 1) if line.strip())
+    if processes == 1:
+        yield from map(_solve_line, tasks)
+        return
+    with multiprocessing.get_context('spawn').Pool(processes) as pool:
+        yield from pool.imap(_solve_line, tasks, chunksize)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Solve sketches from a JSONL file and write the solutions as JSONL.')
+    parser.add_argument('input', nargs='?', default='-', help='JSONL file of problems (default: stdin)')
+    parser.add_argument('-o', '--output', default='-', help='JSONL file of solutions (default: stdout)')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes (0: one per CPU)')
+    parser.add_argument('--method', help="solver method, e.g. 'sparse-lm' "
+                        "(default: chosen per problem from the autotuning table, see backends.py)")
+    parser.add_argument('--chunksize', type=int, default=16, help='lines sent to a worker at a time')
+    parser.add_argument('--log-metrics', action='store_true', help='write one JSON metrics line per solve to stderr')
+    args = parser.parse_args(argv)
+
+    if args.log_metrics:
+        enable_json_log()
+    source = sys.stdin if args.input == '-' else open(args.input)
+    sink = sys.stdout if args.output == '-' else open(args.output, 'w')
+    counts = {'converged': 0, 'failed': 0, 'error': 0}
+    start = time.perf_counter()
+    try:
+        for output, record in solve_stream(source, args.processes or None, args.method, args.chunksize):
+            sink.write(json.dumps(output) + '\n')
+            if record is None:
+                counts['error'] += 1
+            else:
+                registry.observe(record)
+                counts[record['status'] if record['status'] in counts else 'failed'] += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout:
+            sink.close()
+    print(f"{sum(counts.values())} problems in {time.perf_counter() - start:.2f} s: "
+          f"{counts['converged']} converged, {counts['failed']} failed, {counts['error']} errors", file=sys.stderr)
+    return 1 if counts['error'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from optimize import compile_constraints
+from presolve import Presolve
+from sparse_solver import kkt_step, merit_step
+
+###########################################
+# 同じ構造の問題をまとめて解くソルバー
+#
+# 制約 (トポロジーと寸法) が同じで、初期配置と目標位置だけが違う問題を B 個まとめて解きます
+# (到達範囲のマップや、同じテンプレートのスケッチを多数解く場合)。
+# 1反復は sparse_solver と同じで、残差とヤコビアンを (B, 座標数) の配列で一度に評価し、
+# 各問題のKKT系を対角に並べた1つの疎行列を kkt_step で分解し、merit_step で問題ごとに採否を決めます。
+# 減衰 mu・乗数・ステップの採否は問題ごとに持ち、収束した問題は次の反復から外します。
+# 固定点はどの問題でも同じ位置なので、最初に Presolve で代入して変数から除きます
+# (固定点から決まる点は、問題ごとに初期配置で選ぶ交点が違いうるので変数のまま残します)。
+# KKT系のLU分解が MAX_STACKED_BYTES を超えうる分は、問題を分けて順に解きます。
+###########################################
+
+# 一度に積み重ねるKKT系のLU分解の大きさの上限 (バイト)
+MAX_STACKED_BYTES = 256 * 2 ** 20
+
+def solve_batch(constraints, initial_points, targets, target_index=0, maxiter=100, tol=1e-8, mu=1e-3, delta=1e-10,
+                callback=None):
+    """
+    Solve many drag problems that share one constraint set.
+    Problems are stacked at most MAX_STACKED_BYTES at a time, so the memory does not grow with B.
+    :param constraints: A list of Constraint objects (not compiled, so fixed points can be substituted).
+    :param initial_points: Starting coordinates, shape (B, 2 * number of points), or one flat array for all.
+    :param targets: Target positions, shape (B, 2).
+    :param target_index: The dragged point, one for all problems or an array of B indices.
+    :param maxiter: Maximum number of stacked steps.
+    :param tol: Tolerance on the constraint violation and on the step length.
+    :param mu: Initial damping of every problem.
+    :param delta: Regularization of the constraint block, so redundant constraints stay solvable.
+    :param callback: Called with the (B, 2 * number of points) coordinates after each step;
+        may raise StopIteration to stop the problems that have not converged yet.
+    :return: A scipy OptimizeResult whose x, success, status, nit, fun and maxcv have one entry per problem;
+        nfev and njev count the stacked evaluations. If fixed points contradict each other, every problem
+        fails with status 4 and conflicts lists their indices in constraints.
+    """
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    count = len(targets)
+    initial_points = np.asarray(initial_points, dtype=float)
+    if initial_points.ndim == 1:
+        initial_points = np.broadcast_to(initial_points, (count, len(initial_points)))
+    target_index = np.broadcast_to(np.asarray(target_index, dtype=np.intp), (count,))
+
+    presolve = Presolve(constraints, initial_points[0], propagate=False)
+    system = presolve.system
+    n = len(system.free_columns)
+    m = system.size
+    # 1問題あたり: KKT系のLU分解は、フィルインが最も多くても (n + m)² 要素です。
+    chunk = max(MAX_STACKED_BYTES // (8 * (n + m) ** 2), 1)
+    if chunk < count:
+        return _solve_in_parts(constraints, initial_points, targets, target_index, chunk,
+                               dict(maxiter=maxiter, tol=tol, mu=mu, delta=delta), callback)
+    x = system.reduce(initial_points).copy()
+    rows = np.arange(count)
+
+    # 縮小した変数での対象点の列 (対象点が固定点なら目的関数は定数です)
+    target_columns = system.column_map[np.stack([2 * target_index, 2 * target_index + 1], axis=1)]
+    has_target = target_columns[:, 0] >= 0
+    target_columns = np.where(has_target[:, None], target_columns, 0)
+    hessian_diagonal = np.zeros((count, n))
+    hessian_diagonal[rows[has_target, None], target_columns[has_target]] = 2.0
+
+    def target_offset(z, problems):
+        # z は problems の行だけを持つ配列です。
+        diff = z[np.arange(len(problems))[:, None], target_columns[problems]] - targets[problems]
+        return np.where(has_target[problems, None], diff, 0.0)
+
+    def objective(z, problems):
+        diff = target_offset(z, problems)
+        return np.einsum('ij,ij->i', diff, diff)
+
+    residuals = system.residuals(x)
+    damping = np.full(count, mu)
+    penalty = np.ones(count)
+    multipliers = np.zeros((count, m))
+    nit = np.zeros(count, dtype=int)
+    status = np.ones(count, dtype=int)
+    active = np.arange(count)
+    nfev, njev = 1, 0
+    for _ in range(maxiter):
+        if not len(active):
+            break
+        z, r = x[active], residuals[active]
+        njev += 1
+        gradient = np.zeros((len(active), n))
+        # 対象点が固定点の問題では列0に0を書くだけになります。
+        np.add.at(gradient, (np.arange(len(active))[:, None], target_columns[active]), 2 * target_offset(z, active))
+        try:
+            step, candidate_multipliers, solve_kkt = kkt_step(system, z, r, gradient, hessian_diagonal[active],
+                                                              damping[active], multipliers[active], delta)
+        except np.linalg.LinAlgError:
+            # どれかの系が特異な場合は減衰を強めてやり直します。
+            damping[active] *= 10
+            continue
+
+        taken = merit_step(system, lambda points, positions: objective(points, active[positions]), z, r, step,
+                           candidate_multipliers, penalty[active], damping[active], solve_kkt)
+        nfev += taken.nfev
+        nit[active] += 1
+        penalty[active], damping[active] = taken.penalty, taken.damping
+        accept = taken.accept
+        accepted = active[accept]
+        x[accepted] = taken.x[accept]
+        residuals[accepted] = taken.residuals[accept]
+        multipliers[accepted] = candidate_multipliers[accept]
+
+        # 収束した問題を外します。
+        small_step = np.linalg.norm(taken.step, axis=1) <= tol * (1 + np.linalg.norm(taken.x, axis=1))
+        feasible = np.max(np.abs(taken.residuals), axis=1, initial=0.0) <= tol
+        converged = accept & small_step & feasible
+        status[active[converged]] = 0
+        active = active[~converged]
+
+        if callback is not None:
+            try:
+                callback(system.expand(x))
+            except StopIteration:
+                status[active] = 99
+                break
+
+    points = system.expand(x)
+    diff = points[rows[:, None], np.stack([2 * target_index, 2 * target_index + 1], axis=1)] - targets
+    result = OptimizeResult(
+        x=points,
+        success=status == 0,
+        status=status,
+        nit=nit,
+        fun=np.einsum('ij,ij->i', diff, diff),
+        maxcv=np.max(np.abs(compile_constraints(constraints).residuals(points)), axis=1, initial=0.0),
+        nfev=nfev,
+        njev=njev,
+    )
+    if presolve.conflicts:
+        # 同じ点を違う位置に固定している制約は、解いても満たせません。
+        result.conflicts = presolve.conflicts
+        result.status = np.where(status == 99, 99, 4)
+        result.success = np.zeros(count, dtype=bool)
+    return result
+
+def _solve_in_parts(constraints, initial_points, targets, target_index, chunk, options, callback):
+    """
+    solve_batch for problems too large to stack at once: chunk problems at a time.
+    """
+    count = len(targets)
+    points = np.array(initial_points, dtype=float)
+    compiled = compile_constraints(constraints)
+    parts = []
+    stopped = False
+    for start in range(0, count, chunk):
+        part = slice(start, start + chunk)
+        if stopped:
+            # 打ち切った後の問題は解かずに初期配置のまま返します。
+            x = points[part]
+            diff = x[np.arange(len(x))[:, None], np.stack([2 * target_index[part], 2 * target_index[part] + 1], axis=1)] - targets[part]
+            parts.append(OptimizeResult(x=x, success=np.zeros(len(x), dtype=bool), status=np.full(len(x), 99),
+                                        nit=np.zeros(len(x), dtype=int), fun=np.einsum('ij,ij->i', diff, diff),
+                                        maxcv=np.max(np.abs(compiled.residuals(x)), axis=1, initial=0.0),
+                                        nfev=0, njev=0))
+            continue
+
+        def part_callback(x, part=part):
+            # 呼び出し側には常に全問題の座標を渡します。
+            points[part] = x
+            callback(points)
+
+        result = solve_batch(constraints, points[part], targets[part], target_index[part],
+                             callback=None if callback is None else part_callback, **options)
+        points[part] = result.x
+        parts.append(result)
+        stopped = bool(np.any(result.status == 99))
+
+    merged = OptimizeResult({key: np.concatenate([part[key] for part in parts])
+                             for key in ('x', 'success', 'status', 'nit', 'fun', 'maxcv')},
+                            nfev=sum(part.nfev for part in parts), njev=sum(part.njev for part in parts))
+    if 'conflicts' in parts[0]:
+        merged.conflicts = parts[0].conflicts
+    return merged
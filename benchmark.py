@@ -0,0 +1,272 @@
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from decompose import Decomposition
+from optimize import (AngleConstraint, CoincidentConstraint, EqualLengthConstraint, FixedDistanceConstraint,
+                      FixedPointConstraint, HorizontalConstraint, ParallelConstraint, PerpendicularConstraint,
+                      PointOnCircleConstraint, PointOnLineConstraint, VerticalConstraint, compile_constraints,
+                      solve_problem)
+from presolve import Presolve
+
+###########################################
+# ソルバーのベンチマーク
+#
+# パラメータ付きのスケッチ (鎖・閉じた多角形・四節リンク・三角形分割した格子・ランダムグラフ、
+# 距離以外の制約を使う長方形の列とスライダー機構の列) を
+# 10点から10万点まで生成し、各エンジンの実行時間・反復回数・残差・ピークメモリを記録します。
+# 結果をベースラインとして保存しておき、比較で性能の後退を検出します。
+#
+#   python benchmark.py --save benchmark_baseline.json
+#   python benchmark.py --compare benchmark_baseline.json
+###########################################
+
+def _distance(xy, i, j):
+    return float(np.hypot(*(xy[i] - xy[j])))
+
+def _fix(xy, i):
+    return FixedPointConstraint(i, float(xy[i, 0]), float(xy[i, 1]))
+
+def chain(n):
+    """A zigzag chain of n points hanging from a fixed first point; the last point is dragged."""
+    xy = np.array([(10.0 * i, 10.0 * (i % 2)) for i in range(n)])
+    constraints = [_fix(xy, 0)] + [FixedDistanceConstraint(i, i + 1, _distance(xy, i, i + 1)) for i in range(n - 1)]
+    return constraints, xy, n - 1
+
+def polygon(n):
+    """A closed polygon of n points with two adjacent fixed vertices; the opposite vertex is dragged."""
+    angles = 2 * np.pi * np.arange(n) / n
+    xy = 10.0 * n / (2 * np.pi) * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    constraints = [_fix(xy, 0), _fix(xy, 1)]
+    constraints += [FixedDistanceConstraint(i, (i + 1) % n, _distance(xy, i, (i + 1) % n)) for i in range(n)]
+    return constraints, xy, n // 2
+
+def four_bar(n):
+    """n // 4 independent four-bar linkages side by side, like the prototypes; one coupler point is dragged."""
+    base = np.array([(200.0, 100.0), (200.0, 300.0), (500.0, 400.0), (500.0, 100.0)])
+    xy = np.concatenate([base + (400.0 * k, 0.0) for k in range(max(n // 4, 1))])
+    constraints = []
+    for k in range(len(xy) // 4):
+        a, b, c, d = 4 * k, 4 * k + 1, 4 * k + 2, 4 * k + 3
+        constraints += [_fix(xy, a), _fix(xy, d)]
+        constraints += [FixedDistanceConstraint(p, q, _distance(xy, p, q)) for p, q in [(a, b), (b, c), (c, d)]]
+    return constraints, xy, 2
+
+def grid(n):
+    """A triangulated square grid of about n points pinned at one corner; the opposite corner is dragged."""
+    k = max(int(round(np.sqrt(n))), 2)
+    xy = np.array([(10.0 * i, 10.0 * j) for j in range(k) for i in range(k)])
+    constraints = [_fix(xy, 0)]
+    for j in range(k):
+        for i in range(k):
+            p = j * k + i
+            neighbours = []
+            if i + 1 < k:
+                neighbours.append(p + 1)
+            if j + 1 < k:
+                neighbours.append(p + k)
+            if i + 1 < k and j + 1 < k:
+                neighbours.append(p + k + 1)
+            constraints += [FixedDistanceConstraint(p, q, _distance(xy, p, q)) for q in neighbours]
+    return constraints, xy, k * k - 1
+
+def random_graph(n, seed=0):
+    """Random points, each tied by two distances to earlier points (a rigid body pinned at point 0)."""
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 10.0 * np.sqrt(n), size=(n, 2))
+    constraints = [_fix(xy, 0), FixedDistanceConstraint(0, 1, _distance(xy, 0, 1))]
+    for p in range(2, n):
+        for q in rng.choice(p, size=min(2, p), replace=False):
+            constraints.append(FixedDistanceConstraint(int(q), p, _distance(xy, int(q), p)))
+    return constraints, xy, n - 1
+
+def rectangles(n):
+    """
+    A row of n // 4 rectangles of equal width, each sharing an edge with the previous one
+    (horizontal, vertical, coincident and equal-length constraints); the last corner is dragged.
+    """
+    count = max(n // 4, 1)
+    xy = np.array([corner for k in range(count)
+                   for corner in [(10.0 * k, 0.0), (10.0 * k + 10.0, 0.0), (10.0 * k + 10.0, 6.0), (10.0 * k, 6.0)]])
+    constraints = [_fix(xy, 0)]
+    for k in range(count):
+        a, b, c, d = 4 * k, 4 * k + 1, 4 * k + 2, 4 * k + 3
+        constraints += [HorizontalConstraint(a, b), HorizontalConstraint(d, c), VerticalConstraint(b, c)]
+        if k == 0:
+            constraints.append(VerticalConstraint(a, d))
+        else:
+            # 左の辺は前の長方形の右の辺と重なるので、縦の制約は重複します。
+            constraints += [CoincidentConstraint(a, a - 3), CoincidentConstraint(d, d - 5),
+                            EqualLengthConstraint(a, b, a - 4, b - 4)]
+    return constraints, xy, len(xy) - 2
+
+def sliders(n):
+    """
+    A chain of n // 5 crank-slider units, each driven by the last point of the previous one and sliding
+    along the previous unit (circle, perpendicular, point-on-line, parallel and angle constraints);
+    the last point is dragged.
+    """
+    count = max(n // 5, 1)
+    # 最初のユニットの中心と案内の直線は固定点です。
+    xy = [(0.0, 0.0), (0.0, -10.0), (40.0, -10.0)]
+    constraints = [_fix(np.array(xy), i) for i in range(3)]
+    anchor, guide = 0, (1, 2)
+    for k in range(count):
+        ox, oy = xy[anchor]
+        gx, gy = np.subtract(xy[guide[1]], xy[guide[0]]) / np.hypot(*np.subtract(xy[guide[1]], xy[guide[0]]))
+        # p: 中心のまわりの円上、q: 中心 → p に垂直、s: 案内の直線上、t: 中心 → p に平行、u: 案内に対して一定の角度
+        p = (ox + 6.0, oy + 3.0)
+        q = (p[0] - 3.0, p[1] + 6.0)
+        s = (xy[guide[0]][0] + 12.0 * gx, xy[guide[0]][1] + 12.0 * gy)
+        t = (s[0] + 6.0, s[1] + 3.0)
+        u = (t[0] + 4.0 * np.cos(0.5) * gx - 4.0 * np.sin(0.5) * gy, t[1] + 4.0 * np.sin(0.5) * gx + 4.0 * np.cos(0.5) * gy)
+        first = len(xy)
+        xy += [p, q, s, t, u]
+        p, q, s, t, u = range(first, first + 5)
+        points = np.array(xy)
+        constraints += [
+            PointOnCircleConstraint(p, anchor, _distance(points, p, anchor)),
+            PerpendicularConstraint(anchor, p, p, q), FixedDistanceConstraint(p, q, _distance(points, p, q)),
+            PointOnLineConstraint(s, *guide), FixedDistanceConstraint(q, s, _distance(points, q, s)),
+            ParallelConstraint(anchor, p, s, t), FixedDistanceConstraint(s, t, _distance(points, s, t)),
+            AngleConstraint(*guide, t, u, 0.5), FixedDistanceConstraint(t, u, _distance(points, t, u)),
+        ]
+        anchor, guide = u, (s, t)
+    return constraints, np.array(xy), len(xy) - 1
+
+GENERATORS = {
+    'chain': chain,
+    'polygon': polygon,
+    'four_bar': four_bar,
+    'grid': grid,
+    'random_graph': random_graph,
+    'rectangles': rectangles,
+    'sliders': sliders,
+}
+
+###########################################
+# エンジン: (制約, 初期座標, 目標x, 目標y, ドラッグする点) → (解, 反復回数などの辞書)
+
+def _decomposed(method):
+    def run(constraints, points_array, target_x, target_y, target_index):
+        decomposition = Decomposition(constraints, len(points_array) // 2)
+        x, results = decomposition.solve(points_array, target_x, target_y, target_index, method=method)
+        counts = {key: sum(int(r.get(key, 0)) for r in results.values()) for key in ('nit', 'nfev', 'njev')}
+        counts['success'] = all(bool(r.success) for r in results.values())
+        return x, counts
+    return run
+
+def _monolithic(constraints, points_array, target_x, target_y, target_index):
+    # 連結成分に分けずに全体をSLSQPで解きます。固定点の二乗距離の残差は満たされた点で勾配が0になり、
+    # SLSQPの部分問題が特異になるので、固定点だけは前処理で取り除きます。
+    presolve = Presolve(constraints, points_array)
+    reduced_target = presolve.target_index(target_index)
+    if reduced_target is None or not presolve.system.size:
+        return presolve.expand(presolve.reduce(points_array)), {'nit': 0, 'nfev': 0, 'njev': 0, 'success': True}
+    result = solve_problem(presolve.system, presolve.reduce(points_array), target_x, target_y, reduced_target,
+                           method='SLSQP')
+    return presolve.expand(result.x), {'nit': int(result.nit), 'nfev': int(result.nfev), 'njev': int(result.njev),
+                                       'success': bool(result.success)}
+
+# エンジン名 → (関数, 扱える最大の点数)
+ENGINES = {
+    'run_optimization': (_decomposed(None), 300),
+    'sparse-lm': (_decomposed('sparse-lm'), 100000),
+    'slsqp-monolithic': (_monolithic, 300),
+}
+
+###########################################
+
+def run_case(generator, size, engine, repeat=3):
+    """
+    Time one engine on one generated sketch.
+    :return: Dictionary of wall time (best of repeat), counts, final residual and peak memory.
+    """
+    constraints, xy, target_index = GENERATORS[generator](size)
+    points_array = xy.ravel()
+    # ドラッグする点を、リンクの長さの中央値の10%だけ動かします
+    # (スケッチ全体の大きさに比例させると、独立な部品が並ぶだけで届かない目標になるため)。
+    lengths = [c.distance for c in constraints if isinstance(c, FixedDistanceConstraint)]
+    step = 0.1 * float(np.median(lengths)) if lengths else 1.0
+    target_x, target_y = xy[target_index] + step * np.array([0.6, 0.8])
+    run, _ = ENGINES[engine]
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        x, counts = run(constraints, points_array, target_x, target_y, target_index)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run(constraints, points_array, target_x, target_y, target_index)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    residuals = compile_constraints(constraints).residuals(x)
+    return dict(counts, points=len(xy), constraints=len(constraints), wall=min(times),
+                residual=float(np.max(np.abs(residuals))) if len(residuals) else 0.0, peak_memory=peak)
+
+def run_suite(generators, sizes, engines, repeat=3, log=sys.stderr):
+    results = {}
+    for generator in generators:
+        for size in sizes:
+            for engine in engines:
+                if size > ENGINES[engine][1]:
+                    continue
+                key = f'{generator}/{size}/{engine}'
+                results[key] = run_case(generator, size, engine, repeat)
+                if log is not None:
+                    r = results[key]
+                    print(f"{key:40s} {r['wall'] * 1000:10.2f} ms  nit={r['nit']:<5d} "
+                          f"residual={r['residual']:.1e}  peak={r['peak_memory'] / 1e6:.1f} MB"
+                          f"{'' if r['success'] else '  (not converged)'}", file=log)
+    return results
+
+def compare(results, baseline, time_tolerance=0.5, residual_tolerance=1e-6):
+    """
+    :return: A list of human readable regressions against the baseline.
+    """
+    regressions = []
+    for key, r in results.items():
+        if key not in baseline:
+            continue
+        b = baseline[key]
+        if r['wall'] > b['wall'] * (1 + time_tolerance):
+            regressions.append(f"{key}: wall time {r['wall'] * 1000:.2f} ms vs baseline {b['wall'] * 1000:.2f} ms")
+        if b['success'] and not r['success']:
+            regressions.append(f'{key}: no longer converges')
+        if r['residual'] > max(b['residual'], residual_tolerance):
+            regressions.append(f"{key}: residual {r['residual']:.1e} vs baseline {b['residual']:.1e}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the constraint solvers on synthetic sketches.')
+    parser.add_argument('--generators', default=','.join(GENERATORS))
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write the results to this JSON file as the new baseline')
+    parser.add_argument('--compare', help='compare against this baseline JSON file; exit 1 on regression')
+    parser.add_argument('--time-tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown before a case counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.generators.split(','), [int(s) for s in args.sizes.split(',')],
+                        args.engines.split(','), args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.time_tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from optimize import compile_constraints
+
+###########################################
+# 解のキャッシュ
+#
+# 同じテンプレートのスケッチを同じ場所にドラッグする要求が多いので、
+# 制約の集合・初期座標・(許容誤差で量子化した) 目標位置をキーに解を覚えておきます。
+# ヒットしなければ、同じ問題で一番近い目標位置の解を初期値として使えます。
+# ただし遠い目標位置の解から始めると、どの解の枝に落ちるかがキャッシュの中身 (どのワーカーが受けたか) で
+# 変わってしまうので、スケッチの大きさの WARM_START_RADIUS 倍より近いときだけにします。
+###########################################
+
+# 初期値に使うキャッシュの解の目標位置までの距離の上限 (スケッチの大きさに対する比)
+WARM_START_RADIUS = 0.05
+
+def _hash_constraints(digest, constraints, ordered=False):
+    compiled = compile_constraints(constraints)
+    kernels = compiled.kernels if ordered else sorted(compiled.kernels, key=lambda k: type(k).__name__)
+    for kernel in kernels:
+        # カーネルの配列を1つの表にまとめ、行を並べ替えて順序に依存しないようにします。
+        columns = [np.asarray(value, dtype=float).reshape(len(kernel), -1) for _, value in sorted(vars(kernel).items())]
+        table = np.hstack(columns)
+        if not ordered:
+            table = table[np.lexsort(table.T[::-1])]
+        digest.update(type(kernel).__name__.encode())
+        digest.update(table.tobytes())
+    if ordered:
+        # カーネル内の順番は元の順番なので、種類の並びを加えれば元の順番が決まります。
+        kinds = {type(kernel): k for k, kernel in enumerate(compiled.kernels)}
+        digest.update(np.array([kinds[c.kernel] for c in constraints], dtype=np.int32).tobytes())
+
+def constraint_key(constraints, point_count):
+    """
+    Hash of a constraint list over point_count points. Unlike problem_key it depends on the order
+    of the constraints, so results that refer to constraints by position can be cached under it.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_constraints(digest, constraints, ordered=True)
+    digest.update(np.int64(point_count).tobytes())
+    return digest.hexdigest()
+
+def problem_key(constraints, points_array):
+    """
+    Canonical hash of a constraint set and its starting geometry.
+    Independent of the order of the constraints and of how the points are named.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    _hash_constraints(digest, constraints)
+    digest.update(np.ascontiguousarray(points_array, dtype=float).tobytes())
+    return digest.hexdigest()
+
+class SolutionCache:
+    """
+    Bounded LRU cache of solutions.
+    :param max_entries: Number of solutions kept.
+    :param tolerance: Targets closer than this (in coordinate units) share an entry.
+    """
+    def __init__(self, max_entries=1024, tolerance=0.5):
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.entries = OrderedDict()
+        # (問題, ドラッグする点) → その問題で覚えている量子化済みの目標位置
+        self.targets = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, problem, target_index, target_x, target_y):
+        return problem, target_index, round(target_x / self.tolerance), round(target_y / self.tolerance)
+
+    def get(self, problem, target_index, target_x, target_y):
+        key = self._key(problem, target_index, target_x, target_y)
+        with self.lock:
+            solution = self.entries.get(key)
+            if solution is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return solution.copy()
+
+    def put(self, problem, target_index, target_x, target_y, solution):
+        key = self._key(problem, target_index, target_x, target_y)
+        with self.lock:
+            self.entries[key] = np.array(solution, dtype=float)
+            self.entries.move_to_end(key)
+            self.targets.setdefault(key[:2], set()).add(key[2:])
+            while len(self.entries) > self.max_entries:
+                old, _ = self.entries.popitem(last=False)
+                self.evictions += 1
+                quantized = self.targets[old[:2]]
+                quantized.discard(old[2:])
+                if not quantized:
+                    del self.targets[old[:2]]
+
+    def nearest(self, problem, target_index, target_x, target_y, max_distance=None):
+        """
+        The cached solution of the same problem whose target is closest, for warm starts.
+        :param max_distance: If given, targets farther than this are not considered.
+        :return: A solution array, or None if this problem has no cached solution close enough.
+        """
+        qx, qy = target_x / self.tolerance, target_y / self.tolerance
+        with self.lock:
+            quantized = self.targets.get((problem, target_index))
+            if not quantized:
+                return None
+            best = min(quantized, key=lambda q: (q[0] - qx) ** 2 + (q[1] - qy) ** 2)
+            if max_distance is not None and np.hypot(best[0] - qx, best[1] - qy) * self.tolerance > max_distance:
+                return None
+            return self.entries[(problem, target_index) + best].copy()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self.entries)}
+
+    def events_since(self, stats):
+        """
+        :param stats: An earlier result of stats().
+        :return: {'hits': n, 'misses': n, 'evictions': n} since then, for metrics.solve_record.
+        """
+        now = self.stats()
+        return {key: now[key] - stats[key] for key in ('hits', 'misses', 'evictions')}
+
+def cached_solve(cache, solve, constraints, points_array, target_x, target_y, target_index):
+    """
+    Look the problem up in the cache, otherwise solve it warm-started from the nearest cached target
+    if that is within WARM_START_RADIUS of the sketch size, else from points_array.
+    :param solve: Function taking the initial coordinates and returning (solution, success).
+    :return: (solution, success)
+    """
+    problem = problem_key(constraints, points_array)
+    solution = cache.get(problem, target_index, target_x, target_y)
+    if solution is not None:
+        return solution, True
+
+    # スケッチの大きさは点の重心からの二乗平均平方根の距離 (scaling と同じ) で測ります。
+    xy = np.asarray(points_array, dtype=float).reshape(-1, 2)
+    size = float(np.sqrt(np.mean(np.sum((xy - xy.mean(axis=0)) ** 2, axis=1)))) if len(xy) else 0.0
+    warm = cache.nearest(problem, target_index, target_x, target_y,
+                         max_distance=max(WARM_START_RADIUS * size, cache.tolerance))
+    solution, success = solve(points_array if warm is None else warm)
+    if success:
+        cache.put(problem, target_index, target_x, target_y, solution)
+    return solution, success
@@ -0,0 +1,119 @@
+import math
+
+import numpy as np
+
+from optimize import FixedDistanceConstraint, FixedPointConstraint, point_index
+
+###########################################
+# 反復計算を使わずに幾何学的に解ける小さな問題の高速経路
+#
+# 固定点から順に、位置が決まる点を作図していきます。
+#   - ドラッグした点が既知の点と1本の距離で結ばれている → 円への目標点の射影
+#   - 既知の点2つと距離で結ばれている → 2円の交点
+#   - 既知の点1つとだけ結ばれた端の点 → 円上で今の位置に一番近い点
+# 全ての点が決まり、全ての制約を満たしていれば、それが最適解です。
+# そうでなければ None を返し、反復ソルバーに任せます。
+###########################################
+
+def build_plan(constraints, target_index):
+    """
+    Find a construction order for the points of a small rigid sub-problem.
+    Only depends on the structure, so it can be cached per dragged point.
+    :param constraints: Constraints of one component.
+    :return: A list of construction steps, or None if the pattern is not recognized.
+    """
+    fixed = {}
+    neighbours = {target_index: []}
+    for constraint in constraints:
+        if isinstance(constraint, FixedPointConstraint):
+            p = point_index(constraint.point)
+            position = (float(constraint.x), float(constraint.y))
+            if fixed.setdefault(p, position) != position:
+                return None
+            neighbours.setdefault(p, [])
+        elif isinstance(constraint, FixedDistanceConstraint):
+            p, q = point_index(constraint.point1), point_index(constraint.point2)
+            neighbours.setdefault(p, []).append((q, float(constraint.distance)))
+            neighbours.setdefault(q, []).append((p, float(constraint.distance)))
+        else:
+            return None
+
+    steps = [('fixed', p, x, y) for p, (x, y) in fixed.items()]
+    known = set(fixed)
+
+    if target_index not in known:
+        anchors = [(q, d) for q, d in neighbours[target_index] if q in known]
+        if not neighbours[target_index]:
+            steps.append(('free', target_index))
+        elif len(anchors) == 1:
+            steps.append(('project', target_index, anchors[0], 'target'))
+        elif len(anchors) >= 2:
+            steps.append(('intersect', target_index, anchors[0], anchors[1], 'target'))
+        else:
+            return None
+        known.add(target_index)
+
+    unknown = set(neighbours) - known
+    while unknown:
+        progress = False
+        for p in sorted(unknown):
+            anchors = [(q, d) for q, d in neighbours[p] if q in known]
+            if len(anchors) >= 2:
+                steps.append(('intersect', p, anchors[0], anchors[1], 'current'))
+            elif len(anchors) == 1 and len(neighbours[p]) == 1:
+                steps.append(('project', p, anchors[0], 'current'))
+            else:
+                continue
+            known.add(p)
+            unknown.discard(p)
+            progress = True
+        if not progress:
+            return None
+    return steps
+
+def project_on_circle(center, radius, toward, fallback):
+    # 円の中心から目標点への方向に半径だけ進んだ点 (目標点が中心と重なる場合は今の方向)
+    dx, dy = toward[0] - center[0], toward[1] - center[1]
+    norm = math.hypot(dx, dy)
+    if norm == 0:
+        dx, dy = fallback[0] - center[0], fallback[1] - center[1]
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            return None
+    return center[0] + radius * dx / norm, center[1] + radius * dy / norm
+
+def intersect_circles(c1, r1, c2, r2, reference, eps=1e-9):
+    # 2円の交点のうち reference に近い方
+    dx, dy = c2[0] - c1[0], c2[1] - c1[1]
+    d = math.hypot(dx, dy)
+    if d == 0 or d > r1 + r2 + eps or d < abs(r1 - r2) - eps:
+        return None
+    a = (r1 * r1 - r2 * r2 + d * d) / (2 * d)
+    h = math.sqrt(max(r1 * r1 - a * a, 0.0))
+    bx, by = c1[0] + a * dx / d, c1[1] + a * dy / d
+    candidates = [(bx - h * dy / d, by + h * dx / d), (bx + h * dy / d, by - h * dx / d)]
+    return min(candidates, key=lambda c: (c[0] - reference[0]) ** 2 + (c[1] - reference[1]) ** 2)
+
+def run_plan(steps, points_array, target_x, target_y):
+    """
+    Execute a construction plan.
+    :return: The new flat coordinate array, or None if a step has no solution.
+    """
+    xy = np.array(points_array, dtype=float).reshape(-1, 2)
+    target = (target_x, target_y)
+    for step in steps:
+        kind, p = step[0], step[1]
+        if kind == 'fixed':
+            position = (step[2], step[3])
+        elif kind == 'free':
+            position = target
+        elif kind == 'project':
+            (q, d), reference = step[2], step[3]
+            position = project_on_circle(xy[q], d, target if reference == 'target' else xy[p], xy[p])
+        else:
+            (q1, d1), (q2, d2), reference = step[2], step[3], step[4]
+            position = intersect_circles(xy[q1], d1, xy[q2], d2, target if reference == 'target' else xy[p])
+        if position is None:
+            return None
+        xy[p] = position
+    return xy.ravel()
@@ -0,0 +1,279 @@
+import numpy as np
+
+from decompose import Component, Decomposition
+from optimize import Constraint, FixedPointConstraint, point_index
+
+###########################################
+# 編集できる制約の集合
+#
+# 点 → その点を参照する制約 の索引と、連結成分への分解 (decompose.Decomposition) を持ち、
+# 制約の追加・削除・変更のたびに、関係する成分だけを作り直します。
+#   追加: 制約の点が別々の成分にあれば、それらを1つにまとめます。
+#   削除: その成分の中だけを索引でたどり直し、つながりが切れていれば成分を分けます。
+#   変更: 点が同じなら、コンパイル済みのカーネルの配列の該当する行だけを書き換えます。
+# 編集した成分には印を付けておき、resolve で印の付いた成分のうち制約を満たしていないものだけを解きます。
+# 成分の番号は編集で変わることがあります (空いた番号には最後の成分を移します)。
+# 分解は最初に使うときに作るので、スケッチを組み立てる間の追加は索引を更新するだけです。
+###########################################
+
+class ConstraintSystem:
+    """
+    A constraint set that can be edited, kept decomposed into connected components.
+    Constraints are referred to by the handle add returns.
+    :param constraints: Initial constraints, with integer or 'p<i>' point names; their handles are 0, 1, ...
+    :param point_count: Number of points.
+    """
+    def __init__(self, constraints=(), point_count=0):
+        constraints = list(constraints)
+        self.constraints = dict(enumerate(constraints))
+        self.next_handle = len(constraints)
+        # 点 → その点を参照する制約のハンドル
+        self.by_point = [set() for _ in range(point_count)]
+        for handle, constraint in self.constraints.items():
+            for p in self._points(constraint):
+                self.by_point[p].add(handle)
+
+        self._decomposition = None
+        # 成分ごとの制約のハンドル (成分の制約と同じ順番)
+        self.handles = None
+        # 成分ごとの ハンドル → (カーネルの番号, カーネル内の行) (変更するときに作ります)
+        self.positions = None
+        # 編集してから解いていない成分
+        self.dirty = set()
+
+    @property
+    def decomposition(self):
+        """
+        The decompose.Decomposition of the current constraints, updated by every later edit.
+        """
+        if self._decomposition is None:
+            self._decomposition = Decomposition(list(self.constraints.values()), self.point_count)
+            self.handles = [[] for _ in self._decomposition.components]
+            for handle, constraint in self.constraints.items():
+                self.handles[self.component_of(self._points(constraint)[0])].append(handle)
+            self.positions = [None] * len(self.handles)
+            # 作る前の編集は解いていないものとして扱います。
+            self.dirty = {component for component in self._decomposition.components if component.constraints}
+        return self._decomposition
+
+    @property
+    def point_count(self):
+        return len(self.by_point)
+
+    def __len__(self):
+        return len(self.constraints)
+
+    def __getitem__(self, handle):
+        return self.constraints[handle]
+
+    @staticmethod
+    def _points(constraint):
+        return sorted({point_index(p) for p in constraint.points()})
+
+    def component_of(self, point):
+        return int(self.decomposition.component_of[point])
+
+    def add_point(self):
+        """
+        :return: The index of the new, unconstrained point.
+        """
+        index = self.point_count
+        self.by_point.append(set())
+        if self._decomposition is None:
+            return index
+        self.decomposition.component_of = np.append(self.decomposition.component_of, len(self.handles))
+        self.decomposition.point_count += 1
+        self._append_component(np.array([index]), [])
+        return index
+
+    def add(self, constraint):
+        """
+        Add a constraint, merging the components it connects.
+        :return: The handle of the constraint.
+        """
+        handle = self.next_handle
+        self.next_handle += 1
+        self._insert(handle, constraint)
+        return handle
+
+    def remove(self, handle):
+        """
+        Remove a constraint, splitting its component if it falls apart.
+        :return: The removed Constraint.
+        """
+        constraint = self.constraints.pop(handle)
+        points = self._points(constraint)
+        for p in points:
+            self.by_point[p].discard(handle)
+        if self._decomposition is None:
+            return constraint
+        k = self.component_of(points[0])
+        self.handles[k].remove(handle)
+        self._split(k)
+        return constraint
+
+    def modify(self, handle, **values):
+        """
+        Change attributes of a constraint, e.g. modify(handle, distance=120).
+        If only parameters change, the compiled arrays of its component are updated in place;
+        if it refers to other points afterwards, it is removed and added again.
+        """
+        constraint = self.constraints[handle]
+        if any(field in values for field in constraint.point_fields):
+            updated = Constraint.from_dict({**constraint.to_dict(), **values})
+            self.remove(handle)
+            self._insert(handle, updated)
+            return
+
+        for name, value in values.items():
+            if not hasattr(constraint, name):
+                raise AttributeError(f'{type(constraint).__name__} has no attribute {name}')
+            setattr(constraint, name, value)
+        if self._decomposition is None:
+            return
+        k = self.component_of(self._points(constraint)[0])
+        component = self.decomposition.components[k]
+        if self.positions[k] is None:
+            self.positions[k] = self._positions(k)
+        kernel_number, row = self.positions[k][handle]
+        kernel = component.compiled.kernels[kernel_number]
+        copy = component.compiled.constraints[sum(len(other) for other in component.compiled.kernels[:kernel_number]) + row]
+        for name, value in values.items():
+            setattr(copy, name, value)
+        # 1行だけのカーネルを作り、その配列を元のカーネルの行に書き込みます。
+        single = type(kernel)([copy])
+        for name, array in vars(single).items():
+            getattr(kernel, name)[row] = array[0]
+        # 寸法が変わると作図手順や前処理で求めた点の位置も変わります。
+        component.plans = {}
+        component.presolve = None
+        self.dirty.add(component)
+
+    def resolve(self, points_array, tol=1e-8, method=None, callback=None):
+        """
+        Re-solve the components edited since the last resolve whose constraints are violated,
+        each keeping its first point that is not fixed where it is. Solves in place.
+        :param points_array: Flat float64 coordinate array of every point.
+        :return: {component index: OptimizeResult} of the solved components.
+        """
+        results = {}
+        for k, component in enumerate(self.decomposition.components):
+            if component not in self.dirty or not component.compiled.size:
+                continue
+            if np.max(np.abs(component.compiled.residuals(points_array[component.columns]))) <= tol:
+                continue
+            anchor = self._anchor(component)
+            results[k] = self.decomposition.solve_component(component, points_array, points_array[2 * anchor],
+                                                            points_array[2 * anchor + 1], anchor, method,
+                                                            callback=callback)
+        self.dirty.clear()
+        return results
+
+    ###########################################
+
+    def _anchor(self, component):
+        # 固定した点を目標にすると前処理で動かせる点がなくなるので、固定していない最初の点を使います。
+        for p in component.points:
+            if not any(isinstance(self.constraints[h], FixedPointConstraint) for h in self.by_point[p]):
+                return p
+        return component.points[0]
+
+    def _insert(self, handle, constraint):
+        points = self._points(constraint)
+        if not points:
+            raise ValueError(f'{type(constraint).__name__} refers to no point')
+        if any(not 0 <= p < self.point_count for p in points):
+            raise IndexError(f'{type(constraint).__name__} refers to a point that does not exist')
+        self.constraints[handle] = constraint
+        for p in points:
+            self.by_point[p].add(handle)
+        if self._decomposition is None:
+            return
+        components = sorted({self.component_of(p) for p in points})
+        # 一番大きい成分に他の成分をまとめます (付け替える点が少なくて済みます)。
+        k = max(components, key=lambda c: len(self.decomposition.components[c].points))
+        others = [c for c in components if c != k]
+        merged_points = np.concatenate([self.decomposition.components[c].points for c in components])
+        merged_handles = [h for c in components for h in self.handles[c]] + [handle]
+        self.decomposition.component_of[merged_points] = k
+        self._replace(k, np.sort(merged_points), merged_handles)
+        # 番号の大きい方から消すと、移した成分の番号が消す予定の番号とぶつかりません。
+        for c in sorted(others, reverse=True):
+            self._delete_component(c)
+
+    def _split(self, k):
+        """
+        Rebuild component k after a removal, splitting it into the parts that are still connected.
+        """
+        component = self.decomposition.components[k]
+        handles = set(self.handles[k])
+        unvisited = set(component.points.tolist())
+        parts = []
+        while unvisited:
+            start = unvisited.pop()
+            part, stack = [start], [start]
+            while stack:
+                p = stack.pop()
+                for handle in self.by_point[p]:
+                    for q in self._points(self.constraints[handle]):
+                        if q in unvisited:
+                            unvisited.remove(q)
+                            part.append(q)
+                            stack.append(q)
+            parts.append(np.sort(np.array(part, dtype=np.intp)))
+        # 一番大きい部分が元の番号を引き継ぎます。
+        parts.sort(key=len, reverse=True)
+        for number, part in enumerate(parts):
+            part_handles = sorted({h for p in part for h in self.by_point[p]} & handles)
+            if number == 0:
+                self._replace(k, part, part_handles)
+            else:
+                self.decomposition.component_of[part] = len(self.handles)
+                self._append_component(part, part_handles)
+
+    def _replace(self, k, points, handles):
+        handles = sorted(handles)
+        old = self.decomposition.components[k]
+        self.dirty.discard(old)
+        component = Component(points, [self.constraints[h] for h in handles])
+        self.decomposition.components[k] = component
+        self.handles[k] = handles
+        self.positions[k] = None
+        self.dirty.add(component)
+
+    def _append_component(self, points, handles):
+        handles = sorted(handles)
+        component = Component(points, [self.constraints[h] for h in handles])
+        self.decomposition.components.append(component)
+        self.handles.append(handles)
+        self.positions.append(None)
+        if handles:
+            self.dirty.add(component)
+
+    def _delete_component(self, k):
+        # 最後の成分を空いた番号に移します (付け替えるのはその成分の点だけです)。
+        self.dirty.discard(self.decomposition.components[k])
+        last = len(self.handles) - 1
+        if k != last:
+            self.decomposition.components[k] = self.decomposition.components[last]
+            self.handles[k] = self.handles[last]
+            self.positions[k] = self.positions[last]
+            self.decomposition.component_of[self.decomposition.components[k].points] = k
+        self.decomposition.components.pop()
+        self.handles.pop()
+        self.positions.pop()
+
+    def _positions(self, k):
+        """
+        Handle → (kernel number, row in the kernel) of component k; CompiledConstraints groups
+        the constraints by kernel in order of first appearance, keeping their order within a kernel.
+        """
+        kernels = {}
+        rows = {}
+        positions = {}
+        for handle in self.handles[k]:
+            kernel = self.constraints[handle].kernel
+            number = kernels.setdefault(kernel, len(kernels))
+            positions[handle] = (number, rows.get(kernel, 0))
+            rows[kernel] = rows.get(kernel, 0) + 1
+        return positions
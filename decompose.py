@@ -0,0 +1,184 @@
+import numpy as np
+
+from closed_form import build_plan, run_plan
+from optimize import Constraint, compile_constraints, objective_function, point_index, solve_problem
+from presolve import Presolve
+
+###########################################
+# 拘束グラフの分解
+# 点を頂点、制約が参照する点同士を辺とするグラフを作り、連結成分ごとに独立して解きます。
+###########################################
+
+def constraint_graph(constraints, point_count):
+    """
+    Adjacency matrix of the points, linking the points referenced by the same constraint.
+    :return: A scipy.sparse matrix of shape (point_count, point_count).
+    """
+    from scipy.sparse import coo_matrix
+
+    rows, cols = [], []
+    for constraint in constraints:
+        indices = [point_index(p) for p in constraint.points()]
+        for a, b in zip(indices, indices[1:]):
+            rows.append(a)
+            cols.append(b)
+    data = np.ones(len(rows))
+    return coo_matrix((data, (rows, cols)), shape=(point_count, point_count)).tocsr()
+
+###########################################
+
+class Component:
+    """
+    One connected part of the sketch, with its constraints renumbered to local point indices.
+    """
+    def __init__(self, points, constraints):
+        self.points = points
+        local = {p: i for i, p in enumerate(points)}
+        renumbered = []
+        for constraint in constraints:
+            copy = Constraint.from_dict(constraint.to_dict())
+            for field in copy.point_fields:
+                setattr(copy, field, local[point_index(getattr(copy, field))])
+            renumbered.append(copy)
+        self.constraints = constraints
+        self.compiled = compile_constraints(renumbered)
+        # compiled.constraints (種類ごとに並べ替えたもの) の各制約の、constraints での番号
+        position = {id(copy): k for k, copy in enumerate(renumbered)}
+        self.sources = [position[id(copy)] for copy in self.compiled.constraints]
+        # x, y の順に並べた、全体の座標配列での位置
+        self.columns = np.stack([2 * points, 2 * points + 1], axis=1).ravel()
+        # ドラッグする点ごとの作図手順 (幾何学的に解けない場合は None)
+        self.plans = {}
+        # 固定点を取り除いた問題 (最初に解くときの座標で作ります)
+        self.presolve = None
+
+    def local_index(self, point):
+        return int(np.searchsorted(self.points, point))
+
+    def closed_form(self, points_array, target_x, target_y, target_index, tol=1e-8):
+        """
+        Solve the component geometrically if it matches a known pattern.
+        :param points_array: Local flat coordinate array of the component.
+        :param target_index: Local index of the dragged point.
+        :return: The new local coordinate array, or None to fall back to the iterative solver.
+        """
+        if target_index not in self.plans:
+            self.plans[target_index] = build_plan(self.compiled.constraints, target_index)
+        plan = self.plans[target_index]
+        if plan is None:
+            return None
+        x = run_plan(plan, points_array, target_x, target_y)
+        if x is None or (self.compiled.size and np.max(np.abs(self.compiled.residuals(x))) > tol):
+            return None
+        return x
+
+class Decomposition:
+    """
+    The constraint set split into connected components that can be solved independently.
+    """
+    def __init__(self, constraints, point_count):
+        from scipy.sparse.csgraph import connected_components
+
+        self.point_count = point_count
+        graph = constraint_graph(constraints, point_count)
+        count, labels = connected_components(graph, directed=False)
+        self.component_of = labels
+
+        members = [[] for _ in range(count)]
+        for constraint in constraints:
+            points = constraint.points()
+            component = labels[point_index(points[0])] if points else 0
+            members[component].append(constraint)
+        self.components = [Component(np.flatnonzero(labels == k), members[k]) for k in range(count)]
+
+    def component(self, point):
+        return self.components[self.component_of[point]]
+
+    def solve_component(self, component, points_array, target_x, target_y, target_index, method=None,
+                        closed_form=True, callback=None, deadline=None):
+        """
+        Solve one component in place, geometrically when possible.
+        :param points_array: Flat array of every coordinate; the component's entries are overwritten.
+        :param deadline: Passed on to solve_problem.
+        :return: The scipy OptimizeResult of the component.
+        """
+        from scipy.optimize import OptimizeResult
+
+        local_target = component.local_index(target_index)
+        x = component.closed_form(points_array[component.columns], target_x, target_y, local_target) if closed_form else None
+        if x is not None:
+            result = OptimizeResult(x=x, success=True, status=0, message='Solved in closed form',
+                                    fun=objective_function(x, target_x, target_y, local_target),
+                                    nit=0, nfev=0, njev=0)
+        else:
+            result = self.solve_presolved(component, points_array[component.columns],
+                                          target_x, target_y, local_target, method, callback, deadline)
+        points_array[component.columns] = result.x
+        return result
+
+    def solve_presolved(self, component, points_array, target_x, target_y, target_index, method=None,
+                        callback=None, deadline=None):
+        """
+        Solve one component iteratively over its free points only.
+        If the presolve finds constraints between fixed points that contradict each other, the rest
+        is still solved but the result fails, with their indices in component.constraints as conflicts.
+        :param points_array: Local flat coordinate array of the component.
+        :return: The scipy OptimizeResult, with x expanded back to every point of the component.
+        """
+        from scipy.optimize import OptimizeResult
+
+        if component.presolve is None:
+            component.presolve = Presolve(component.compiled.constraints, points_array)
+        presolve = component.presolve
+        reduced_target = presolve.target_index(target_index)
+
+        # ドラッグした点が固定されている場合は動かせる点がありません。
+        if reduced_target is None or not presolve.system.size:
+            x = presolve.expand(presolve.reduce(points_array))
+            if reduced_target is not None:
+                x[2 * target_index:2 * target_index + 2] = target_x, target_y
+            result = OptimizeResult(x=x, success=True, status=0, message='Solved by presolve',
+                                    fun=objective_function(x, target_x, target_y, target_index),
+                                    nit=0, nfev=0, njev=0)
+        else:
+            result = solve_problem(presolve.system, presolve.reduce(points_array),
+                                   target_x, target_y, reduced_target, method, callback, deadline)
+            result.x = presolve.expand(result.x)
+
+        if presolve.conflicts:
+            # 前処理で取り除いた制約は解いても満たせないので、失敗として返します。
+            result.conflicts = sorted(component.sources[k] for k in presolve.conflicts)
+            result.success, result.status = False, 4
+            result.message = 'Constraints between fixed points contradict each other'
+        return result
+
+    def solve(self, points_array, target_x, target_y, target_index, tol=1e-8, only_dragged=False, method=None,
+              closed_form=True, callback=None, in_place=False, deadline=None):
+        """
+        Solve the component holding the dragged point, then every other component
+        whose constraints are violated (keeping its first point where it is).
+        :param only_dragged: Skip the other components, e.g. when they are already solved.
+        :param method: Passed on to solve_problem.
+        :param closed_form: Try the geometric fast paths before the iterative solver.
+        :param callback: Passed on to solve_problem, e.g. to stop at a deadline.
+        :param in_place: Write the solution into points_array (a float64 array) instead of a copy.
+        :param deadline: Optional time.monotonic() value shared by every component solved; components
+            reached after it keep their coordinates (see solve_problem).
+        :return: (new flat coordinate array, {component index: OptimizeResult})
+        """
+        x = points_array if in_place else np.array(points_array, dtype=float)
+        dragged = self.component_of[target_index]
+        results = {dragged: self.solve_component(self.components[dragged], x, target_x, target_y, target_index,
+                                                 method, closed_form, callback, deadline)}
+        if only_dragged:
+            return x, results
+
+        for k, component in enumerate(self.components):
+            if k == dragged or not component.compiled.size:
+                continue
+            if np.max(np.abs(component.compiled.residuals(x[component.columns]))) <= tol:
+                continue
+            anchor = component.points[0]
+            results[k] = self.solve_component(component, x, x[2 * anchor], x[2 * anchor + 1], anchor,
+                                              method, closed_form, callback, deadline)
+        return x, results
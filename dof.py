@@ -0,0 +1,319 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from optimize import FixedPointConstraint, compile_constraints, point_index
+
+###########################################
+# 自由度の解析
+#
+# 制約が多すぎる (冗長・矛盾している) スケッチは、反復ソルバーが反復回数の上限まで回ってから
+# 失敗するので、解く前に見つけて断ります。
+#   構造的な解析: 方程式と座標の二部グラフの最大マッチング。マッチしない方程式から
+#       交互路でたどれる方程式の集まりが、構造的に過剰な部分 (Dulmage-Mendelsohn分解の過決定部分) です。
+#   数値的な解析: 現在の配置でのヤコビアンの階数。固定点の座標は固定点の方程式だけで決まるので消去し、
+#       残りの疎なヤコビアンを連結なブロックに分けて、ブロックごとに列ピボット付きQR分解で調べます。
+#       従属な行ごとに、それが依存する行と合わせて「過剰な制約の組」とし、
+#       組の制約だけで最小二乗を解いても満たせない組を「矛盾」とします。
+#       最小二乗は局所解に止まることがあるので、現在の配置と、それをずらした restarts 個の配置から解き、
+#       どこから解いても満たせないときだけ矛盾とします。
+# 固定点の残差は二乗距離で解では勾配が0になるので、ここでは x, y の2本の一次式として扱います。
+# 矛盾のない結果は制約の並びだけで決まるとみなし、AnalysisCache で制約が変わるまで使い回します。
+# 矛盾があるという結果は配置にもよるので、同じ配置のときだけ使い回します。
+###########################################
+
+class Unsolvable(ValueError):
+    """The constraints contradict each other; report is DofAnalysis.to_dict() of the problem."""
+    def __init__(self, report):
+        super().__init__('the constraints contradict each other')
+        self.report = report
+
+def _blocks(rows, cols, row_count, col_count):
+    """
+    Connected parts of a bipartite graph.
+    :return: List of (row indices, column indices).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    size = row_count + col_count
+    graph = coo_matrix((np.ones(len(rows)), (rows, row_count + cols)), shape=(size, size))
+    count, labels = connected_components(graph, directed=False)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(count + 1))
+    blocks = []
+    for k in range(count):
+        members = order[bounds[k]:bounds[k + 1]]
+        blocks.append((members[members < row_count], members[members >= row_count] - row_count))
+    return blocks
+
+class DofAnalysis:
+    """
+    Structural and numerical degree-of-freedom analysis of a constraint list at a configuration.
+    Constraints are referred to by their position in the list.
+    :param constraints: Constraints with integer or 'p<i>' point names.
+    :param points_array: Flat coordinates at which the Jacobian is evaluated.
+    :param rank_tol: Relative size below which a pivot of the QR decomposition counts as zero.
+    :param conflict_tol: Residual left by the least-squares solve of an over-constrained subset
+        (relative to the size of the coordinates) above which the subset is a conflict.
+    :param restarts: Number of perturbed starts tried before a subset counts as a conflict.
+    :param max_block: Blocks with more free coordinates than this are not decomposed (the dense QR
+        decomposition grows with the cube of the size); their rank is the structural one and they are
+        counted in unchecked_blocks.
+    """
+    def __init__(self, constraints, points_array, rank_tol=1e-9, conflict_tol=1e-6, max_block=1000, restarts=5):
+        constraints = list(constraints)
+        base = np.array(points_array, dtype=float)
+        xy = base.reshape(-1, 2)
+        self.rank_tol = rank_tol
+        self.max_block = max_block
+        self.restarts = restarts
+        self.variables = len(base)
+        self.tolerance = conflict_tol * (1 + np.max(np.abs(base), initial=0.0))
+
+        # 固定点: 最初の固定点の制約で座標を決め、2つ目以降は冗長な制約です。
+        fixed = {}
+        rest = []
+        self.redundant = []
+        self.overconstrained = []
+        self.conflicts = set()
+        for k, constraint in enumerate(constraints):
+            if isinstance(constraint, FixedPointConstraint):
+                p = point_index(constraint.point)
+                if p in fixed:
+                    first = constraints[fixed[p]]
+                    self.redundant.append(k)
+                    self.overconstrained.append([fixed[p], k])
+                    if np.hypot(constraint.x - first.x, constraint.y - first.y) > self.tolerance:
+                        self.conflicts.update((fixed[p], k))
+                    continue
+                fixed[p] = k
+                xy[p] = constraint.x, constraint.y
+            else:
+                rest.append(k)
+        self.fixed_points = fixed
+
+        compiled = compile_constraints([constraints[k] for k in rest])
+        # compiled の行の順番 → 元の制約の番号
+        position = {id(constraints[k]): k for k in rest}
+        owners = np.array([position[id(c)] for c in compiled.constraints], dtype=np.intp)[compiled.row_owners]
+        rows, cols, values = compiled.jacobian_entries(base)
+
+        self._structural(constraints, owners, rows, cols)
+        self._numerical(constraints, owners, compiled, rows, cols, values, base)
+        self.conflicts = sorted(self.conflicts)
+        # 2行の残差を持つ制約は、両方の行が従属なら2回数えられるので重複を除きます。
+        self.redundant = sorted(set(self.redundant))
+
+    def _structural(self, constraints, owners, rows, cols):
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import maximum_bipartite_matching
+
+        # 方程式: 固定点ごとに x, y の2本、他の制約は残差の行ごとに1本 (CoincidentConstraint は2本)
+        fixed_constraints = [k for k, c in enumerate(constraints) if isinstance(c, FixedPointConstraint)]
+        fixed_columns = np.array([[2 * point_index(constraints[k].point), 2 * point_index(constraints[k].point) + 1]
+                                  for k in fixed_constraints], dtype=np.intp).reshape(-1, 2)
+        equation_owners = np.concatenate([np.repeat(np.array(fixed_constraints, dtype=np.intp), 2), owners])
+        equation_rows = np.concatenate([np.arange(fixed_columns.size), fixed_columns.size + rows])
+        equation_cols = np.concatenate([fixed_columns.ravel(), cols])
+        count = len(equation_owners)
+        graph = csr_matrix((np.ones(len(equation_rows)), (equation_rows, equation_cols)),
+                           shape=(count, self.variables))
+        graph.sum_duplicates()
+        match = maximum_bipartite_matching(graph, perm_type='column')
+        self.structural_dof = self.variables - int(np.count_nonzero(match >= 0))
+
+        # マッチしない方程式から、座標 → その座標にマッチした方程式 とたどれる方程式が過決定部分です。
+        row_of_column = np.full(self.variables, -1, dtype=np.intp)
+        row_of_column[match[match >= 0]] = np.flatnonzero(match >= 0)
+        reached = np.zeros(count, dtype=bool)
+        frontier = list(np.flatnonzero(match < 0))
+        reached[frontier] = True
+        while frontier:
+            r = frontier.pop()
+            for c in graph.indices[graph.indptr[r]:graph.indptr[r + 1]]:
+                q = row_of_column[c]
+                if q >= 0 and not reached[q]:
+                    reached[q] = True
+                    frontier.append(q)
+
+        over = np.flatnonzero(reached)
+        sub = graph[over].tocoo()
+        # 固定点の x, y のように同じ制約の方程式が別のブロックになることがあるので、重複を除きます。
+        subsets = {tuple(sorted(set(equation_owners[over[r]].tolist())))
+                   for r, _ in _blocks(sub.row, sub.col, len(over), self.variables) if len(r)}
+        self.structural_overconstrained = [list(subset) for subset in sorted(subsets)]
+
+    def _numerical(self, constraints, owners, compiled, rows, cols, values, base):
+        from scipy.linalg import qr, solve_triangular
+        from scipy.sparse import coo_matrix
+
+        # 固定点の座標の列を消去します (その列は固定点の方程式だけで決まります)。
+        fixed_columns = np.zeros(self.variables, dtype=bool)
+        for p in self.fixed_points:
+            fixed_columns[2 * p:2 * p + 2] = True
+        free_columns = np.flatnonzero(~fixed_columns)
+        column_map = np.full(self.variables, -1, dtype=np.intp)
+        column_map[free_columns] = np.arange(len(free_columns))
+        keep = column_map[cols] >= 0
+        jac = coo_matrix((values[keep], (rows[keep], column_map[cols[keep]])),
+                         shape=(compiled.size, len(free_columns))).tocsr()
+        jac.sum_duplicates()
+        jac.eliminate_zeros()
+        pattern = jac.tocoo()
+
+        self.rank = 2 * len(self.fixed_points)
+        self.unchecked_blocks = 0
+        free = np.zeros(self.variables, dtype=bool)
+        for block_rows, block_cols in _blocks(pattern.row, pattern.col, compiled.size, len(free_columns)):
+            if not len(block_rows):
+                # どの制約にも触れない座標
+                free[free_columns[block_cols]] = True
+                continue
+            if len(block_cols) > self.max_block:
+                # 大きすぎるブロックは構造的な階数 (マッチングの大きさ) で代えます。
+                from scipy.sparse.csgraph import maximum_bipartite_matching
+
+                match = maximum_bipartite_matching(jac[block_rows][:, block_cols], perm_type='column')
+                matched = int(np.count_nonzero(match >= 0))
+                self.rank += matched
+                if matched < len(block_cols):
+                    free[free_columns[block_cols]] = True
+                self.unchecked_blocks += 1
+                continue
+            # A = J^T の列ピボット付きQR分解: A P = Q R。ピボットの順に独立な行が並びます。
+            a = jac[block_rows][:, block_cols].toarray().T
+            if len(block_cols):
+                q, r, pivots = qr(a, pivoting=True, check_finite=False)
+                diagonal = np.abs(np.diagonal(r))
+                # ピボットは降順に並ぶので、最初のピボットとの比で判定します。
+                rank = int(np.count_nonzero(diagonal > self.rank_tol * np.max(diagonal, initial=0.0)))
+            else:
+                q, r, pivots, rank = np.zeros((0, 0)), np.zeros((0, len(block_rows))), np.arange(len(block_rows)), 0
+            self.rank += rank
+            # ヤコビアンの零空間 (Q の後ろの列) に成分を持つ座標が動かせる座標です。
+            null = q[:, rank:]
+            free[free_columns[block_cols[np.linalg.norm(null, axis=1) > 1e-9]]] = True
+
+            # 従属な行を、独立な行の一次結合 R[:rank, :rank] C = R[:rank, rank:] で表します。
+            dependent = pivots[rank:len(block_rows)]
+            if rank:
+                coefficients = solve_triangular(r[:rank, :rank], r[:rank, rank:len(block_rows)], check_finite=False)
+            else:
+                coefficients = np.zeros((0, len(dependent)))
+            subsets = []
+            for j, row in enumerate(dependent):
+                c = coefficients[:, j]
+                support = pivots[:rank][np.abs(c) > 1e-9 * max(np.max(np.abs(c), initial=0.0), 1.0)]
+                self.redundant.append(int(owners[block_rows[row]]))
+                subsets.append(sorted(set(owners[block_rows[np.append(support, row)]].tolist())))
+            if subsets:
+                self._check_subsets(constraints, subsets, base)
+
+        self.dof = self.variables - self.rank
+        self.free_points = sorted(set((np.flatnonzero(free) // 2).tolist()))
+
+    def _check_subsets(self, constraints, subsets, base):
+        """
+        Record the over-constrained subsets of one block (with the fixed points they touch)
+        and find the ones that cannot be satisfied.
+        All subsets of the block are solved together in one least-squares problem, from the
+        configuration and then from up to restarts perturbed copies of it; a subset conflicts
+        only if one of its constraints is still violated at the solution from every start.
+        """
+        from scipy.optimize import least_squares
+
+        from presolve import ReducedConstraints
+
+        members = sorted(set().union(*subsets))
+        points = sorted({point_index(p) for k in members for p in constraints[k].points()})
+        moving = np.array([p for p in points if p not in self.fixed_points], dtype=np.intp)
+        system = ReducedConstraints([constraints[k] for k in members], base, moving)
+        start = system.reduce(base)
+        # ずらす大きさはブロックの点の広がり程度にします。同じ入力には同じ結果を返すよう乱数は固定です。
+        spread = float(np.max(np.ptp(start.reshape(-1, 2), axis=0), initial=0.0)) if len(start) else 0.0
+        rng = np.random.default_rng(0)
+        # system の行は種類ごとに並び替わっているので、制約の番号に戻します。
+        position = {id(constraints[k]): k for k in members}
+        violated = set()
+        for attempt in range(self.restarts + 1):
+            x = start if attempt == 0 else start + rng.normal(scale=0.1 * attempt * max(spread, 1.0), size=len(start))
+            if len(x) > 200:
+                # 大きなブロックは疎なヤコビアンのまま解きます。
+                x = least_squares(system.residuals, x, jac=system.jacobian_sparse, tr_solver='lsmr',
+                                  xtol=1e-12, ftol=1e-12, gtol=1e-12, max_nfev=200).x
+            elif len(x):
+                x = least_squares(system.residuals, x, jac=system.jacobian, xtol=1e-12, ftol=1e-12, gtol=1e-12,
+                                  max_nfev=200).x
+            violated = {position[id(system.constraints[owner])]
+                        for owner in system.row_owners[np.abs(system.residuals(x)) > self.tolerance]}
+            if not violated:
+                break
+
+        anchors_of = {k: {self.fixed_points[point_index(p)] for p in constraints[k].points()
+                          if point_index(p) in self.fixed_points} for k in members}
+        for subset in subsets:
+            anchors = set().union(*(anchors_of[k] for k in subset))
+            self.overconstrained.append(sorted(set(subset) | anchors))
+            if violated.intersection(subset):
+                self.conflicts.update(subset)
+                self.conflicts.update(anchors)
+
+    @property
+    def consistent(self):
+        """False if some constraints contradict each other, so solving is hopeless."""
+        return not self.conflicts
+
+    def to_dict(self, names=None):
+        """
+        JSON-serializable report. Points are given by name if names is given.
+        """
+        name = (lambda p: names[p]) if names is not None else int
+        return {
+            'dof': self.dof,
+            'rank': self.rank,
+            'variables': self.variables,
+            'structural_dof': self.structural_dof,
+            'free_points': [name(p) for p in self.free_points],
+            'redundant': [int(k) for k in self.redundant],
+            'overconstrained': [[int(k) for k in subset] for subset in self.overconstrained],
+            'structural_overconstrained': [[int(k) for k in subset] for subset in self.structural_overconstrained],
+            'conflicts': [int(k) for k in self.conflicts],
+            'unchecked_blocks': self.unchecked_blocks,
+        }
+
+class AnalysisCache:
+    """
+    Bounded LRU cache of DofAnalysis keyed by the constraint list (cache.constraint_key).
+    A consistent analysis is computed at the configuration the constraint list is first seen with
+    and reused for any configuration; one that found conflicts is reused only at the same configuration,
+    so an unlucky configuration does not block the constraint list for every later request.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, constraints, points_array):
+        from cache import constraint_key
+
+        key = constraint_key(constraints, len(points_array) // 2)
+        configuration = (key, hashlib.blake2b(np.ascontiguousarray(points_array, dtype=float).tobytes(),
+                                              digest_size=16).hexdigest())
+        with self.lock:
+            for k in (key, configuration):
+                analysis = self.entries.get(k)
+                if analysis is not None:
+                    self.entries.move_to_end(k)
+                    return analysis
+        analysis = DofAnalysis(constraints, points_array)
+        with self.lock:
+            self.entries[key if analysis.consistent else configuration] = analysis
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return analysis
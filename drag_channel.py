@@ -0,0 +1,182 @@
+import argparse
+import json
+import sys
+import threading
+import time
+
+###########################################
+# ドラッグ用のストリーミングチャンネル
+#
+# クライアントは mousemove ごとに連番付きの目標位置を送り、
+# 結果は server-sent events で連番付きで受け取ります。
+# 解いている間に届いた目標位置は最新のものだけを残し、古いものは捨てます (latest-wins)。
+# 時間の予算内に収束しなかった途中の解 ('provisional': True) を送った後は、
+# 次の目標位置が届くまで refine で解き続け、良くなった解を同じ連番で送り直します。
+# DragChannel はHTTPに依存しないので、solve 関数を差し替えればそのまま手元で動かせます。
+###########################################
+
+class DragChannel:
+    """
+    The target slot of one drag session.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latest = None
+        self.last_seq = -1
+        # 解かれずに捨てられた目標位置の数
+        self.dropped = 0
+        self.closed = False
+        self.last_used = time.monotonic()
+
+    def push(self, seq, target):
+        """
+        Offer a new target. Older or out-of-order targets are discarded.
+        """
+        with self.condition:
+            self.last_used = time.monotonic()
+            if seq <= self.last_seq or (self.latest is not None and seq <= self.latest[0]):
+                self.dropped += 1
+                return
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = (seq, target)
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        """
+        Wait for the newest target.
+        :return: (seq, target), or None on timeout or close.
+        """
+        with self.condition:
+            # ストリームが開いている間は使用中とみなします。
+            self.last_used = time.monotonic()
+            if self.latest is None and not self.closed:
+                self.condition.wait(timeout)
+            latest, self.latest = self.latest, None
+            if latest is not None:
+                self.last_seq = latest[0]
+            return latest
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def events(self, solve, keepalive=15.0, refine=None):
+        """
+        Solve the newest target each time and yield server-sent event lines.
+        :param solve: Function taking a target and returning a JSON-serializable dict.
+            A dict with 'final': True ends the stream after it is sent.
+        :param keepalive: Seconds between keepalive comments while idle.
+        :param refine: Optional function without arguments, called while the last dict had
+            'provisional': True and no newer target is waiting; returns the next dict in the
+            same form as solve (sent with the same seq), or None to give up.
+        """
+        while not self.closed:
+            latest = self.take(keepalive)
+            if latest is None:
+                yield ': keepalive\n\n'
+                continue
+            seq, target = latest
+            message = solve(target)
+            final = message.pop('final', False)
+            message['seq'] = seq
+            yield f'data: {json.dumps(message)}\n\n'
+            if final:
+                return
+            while refine is not None and message.get('provisional') and not self.pending():
+                message = refine()
+                if message is None:
+                    break
+                final = message.pop('final', False)
+                message['seq'] = seq
+                yield f'data: {json.dumps(message)}\n\n'
+                if final:
+                    return
+
+    def pending(self):
+        """Whether a target is waiting to be solved (or the channel was closed)."""
+        with self.condition:
+            return self.latest is not None or self.closed
+
+class ChannelRegistry:
+    """
+    Drag channels keyed by session id, dropped after idle_timeout seconds without targets.
+    """
+    def __init__(self, idle_timeout=300.0):
+        self.idle_timeout = idle_timeout
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            deadline = time.monotonic() - self.idle_timeout
+            for key in [k for k, channel in self.channels.items() if channel.last_used < deadline]:
+                self.channels.pop(key).close()
+            channel = self.channels.get(session_id)
+            if channel is None:
+                channel = self.channels[session_id] = DragChannel()
+            return channel
+
+    def remove(self, session_id, channel=None):
+        """
+        Close and drop a channel; if channel is given, only when it is still the registered one.
+        """
+        with self.lock:
+            if channel is not None and self.channels.get(session_id) is not channel:
+                return
+            channel = self.channels.pop(session_id, None)
+        if channel is not None:
+            channel.close()
+
+def simulate(count=50, interval=0.002, solve_time=0.01, provisional=False, out=sys.stdout):
+    """
+    Drive a DragChannel without the server: a thread pushes count sequence-numbered targets
+    every interval seconds while a fake solve sleeps solve_time seconds per target.
+    :param provisional: Whether the fake solve returns provisional results that refine improves.
+    :return: The number of dropped targets.
+    """
+    channel = DragChannel()
+
+    def client():
+        for seq in range(count):
+            channel.push(seq, (0, float(seq), 0.0))
+            time.sleep(interval)
+        # 最後の目標位置が解かれるのを待ってから閉じます
+        while channel.pending() and not channel.closed:
+            time.sleep(solve_time)
+        time.sleep(2 * solve_time)
+        channel.close()
+
+    def solve(target):
+        time.sleep(solve_time)
+        _, x, y = target
+        return {'points': {'p': [x, y]}, 'provisional': provisional}
+
+    def refine():
+        time.sleep(solve_time)
+        return {'provisional': False, 'refined': True}
+
+    thread = threading.Thread(target=client, daemon=True)
+    thread.start()
+    for event in channel.events(solve, keepalive=solve_time, refine=refine if provisional else None):
+        if not event.startswith(':'):
+            out.write(event)
+    thread.join()
+    return channel.dropped
+
+def main(argv=None):
+    # サーバーなしで DragChannel の latest-wins の動きを確かめます
+    parser = argparse.ArgumentParser(description='Drive a DragChannel locally with a fake solver.')
+    parser.add_argument('--count', type=int, default=50, help='number of targets to push')
+    parser.add_argument('--interval', type=float, default=0.002, help='seconds between targets')
+    parser.add_argument('--solve-time', type=float, default=0.01, help='seconds per fake solve')
+    parser.add_argument('--provisional', action='store_true', help='return provisional results and refine them')
+    args = parser.parse_args(argv)
+
+    dropped = simulate(args.count, args.interval, args.solve_time, args.provisional)
+    print(f'dropped {dropped} of {args.count} targets')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
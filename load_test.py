@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+###########################################
+# 負荷試験
+#
+# Flaskのアプリをローカルで別プロセスとして起動し、ドラッグするクライアントを asyncio でいくつも同時に動かします。
+# 各クライアントは benchmark.GENERATORS のスケッチの点を円を描くように動かし、ブラウザの mousemove と同じく
+# 決まった間隔で POST /optimize を送ります (前の応答を待たずに送り、同時に使う接続はブラウザと同じ6本までです)。
+#   session: 最初に POST /session を作り、1フレームごとに目標位置だけを送ります (既定)
+#   full:    1フレームごとにスケッチ全体を送ります (セッションを使わない古いクライアント)
+# 遅延は送るはずだった時刻から応答を受け取るまでを測るので、接続が空くのを待った時間も含みます。
+# 応答の数/秒、遅延の p50/p95/p99、エラー (200以外の応答と接続の失敗) とタイムアウト
+# (クライアント側の --timeout と 504) の割合、サーバー (ワーカーを含む) のCPU時間を報告します。
+# サーバーのCPU時間は /proc から読むので Linux のみです (--url で既に動いているサーバーを試すときは測りません)。
+#
+#   python load_test.py --clients 20 --rate 60 --size 100 --duration 10
+###########################################
+
+# ブラウザが1つのホストに同時に張る接続の数
+BROWSER_CONNECTIONS = 6
+
+def drag_trace(xy, target_index, radius, rate, duration, phase=0.0, period=1.0):
+    """
+    Targets of a point dragged around a circle through its position.
+    :param rate: Events per second.
+    :param period: Seconds per turn around the circle.
+    :return: [(seconds from the start, target_x, target_y), ...]
+    """
+    times = np.arange(0.0, duration, 1.0 / rate)
+    angles = phase + 2 * np.pi * times / period
+    center = xy[target_index] - radius * np.array([np.cos(phase), np.sin(phase)])
+    return [(float(t), float(center[0] + radius * np.cos(a)), float(center[1] + radius * np.sin(a)))
+            for t, a in zip(times, angles)]
+
+def problem_json(constraints, xy, target_index):
+    """
+    The /session and /optimize request body of a generated sketch, with points named 'p0', 'p1', ...
+    """
+    points = {f'p{i}': {'x': float(x), 'y': float(y)} for i, (x, y) in enumerate(xy)}
+    items = []
+    for constraint in constraints:
+        item = constraint.to_dict()
+        for field in constraint.point_fields:
+            item[field] = f'p{item[field]}'
+        items.append(item)
+    return {'points': points, 'constraints': items,
+            'target': {'point': f'p{target_index}', 'x': float(xy[target_index, 0]),
+                       'y': float(xy[target_index, 1])}}
+
+###########################################
+# HTTPクライアント
+
+class HttpConnection:
+    """
+    A minimal HTTP/1.1 keep-alive connection on asyncio streams (enough for the JSON responses of app.py).
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, data=None):
+        """
+        :param data: JSON-serializable request body, or None.
+        :return: (HTTP status, response body bytes)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = b'' if data is None else json.dumps(data).encode()
+        head = (f'{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+                f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n')
+        self.writer.write(head.encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the server')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            response = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            response = await self.reader.read()
+        if 'content-length' not in headers or headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class DragClient:
+    """
+    One simulated user: sends every event of its trace on time, over at most `connections` connections.
+    :param records: List receiving (scheduled time, latency, outcome, HTTP status or None) per event.
+    """
+    def __init__(self, host, port, problem, trace, mode='session', connections=BROWSER_CONNECTIONS, timeout=2.0,
+                 records=None):
+        self.problem = problem
+        self.trace = trace
+        self.mode = mode
+        self.timeout = timeout
+        self.records = [] if records is None else records
+        self.idle = [HttpConnection(host, port) for _ in range(connections)]
+        self.available = asyncio.Semaphore(connections)
+        self.session = None
+
+    async def open(self, attempts=20):
+        if self.mode != 'session':
+            return
+        for attempt in range(attempts):
+            status, body = await self.idle[0].request('POST', '/session', self.problem)
+            # 同時に作るとワーカーの待ち行列があふれるので、少し待ってやり直します。
+            if status != 503:
+                break
+            await asyncio.sleep(0.05 * (attempt + 1))
+        if status != 200:
+            raise RuntimeError(f'POST /session failed with {status}: {body[:200]!r}')
+        self.session = json.loads(body)['session']
+
+    async def close(self):
+        if self.session is not None:
+            await self.idle[0].request('DELETE', f'/session/{self.session}')
+        for connection in self.idle:
+            connection.close()
+
+    def body(self, target_x, target_y):
+        target = {'point': self.problem['target']['point'], 'x': target_x, 'y': target_y}
+        if self.mode == 'session':
+            return {'session': self.session, 'target': target}
+        return dict(self.problem, target=target)
+
+    async def send(self, scheduled, data):
+        loop = asyncio.get_running_loop()
+        async with self.available:
+            connection = self.idle.pop()
+            try:
+                status, _ = await asyncio.wait_for(connection.request('POST', '/optimize', data), self.timeout)
+                outcome = 'ok' if status == 200 else 'timeout' if status == 504 else 'error'
+            except asyncio.TimeoutError:
+                # 応答の途中の接続は使い回せないので張り直します。
+                connection.close()
+                status, outcome = None, 'timeout'
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+                connection.close()
+                status, outcome = None, 'error'
+            finally:
+                self.idle.append(connection)
+        self.records.append((scheduled, loop.time() - scheduled, outcome, status))
+
+    async def run(self, start):
+        """
+        :param start: Event loop time of the first event.
+        """
+        loop = asyncio.get_running_loop()
+        tasks = []
+        for offset, target_x, target_y in self.trace:
+            await asyncio.sleep(max(0.0, start + offset - loop.time()))
+            tasks.append(asyncio.create_task(self.send(start + offset, self.body(target_x, target_y))))
+        await asyncio.gather(*tasks)
+
+async def run_clients(host, port, problem, traces, mode, connections, timeout, cpu_seconds=None):
+    """
+    :param cpu_seconds: Optional function returning the server's CPU time, read around the dragging.
+    :return: (records of every event, wall time of the dragging, server CPU seconds or None)
+    """
+    records = []
+    clients = [DragClient(host, port, problem, trace, mode, connections, timeout, records) for trace in traces]
+    await asyncio.gather(*(client.open() for client in clients))
+    # 全員のセッションができてから同時に動かし始めます。
+    cpu_start = cpu_seconds() if cpu_seconds else None
+    start = asyncio.get_running_loop().time() + 0.1
+    await asyncio.gather(*(client.run(start) for client in clients))
+    wall = asyncio.get_running_loop().time() - start
+    cpu_end = cpu_seconds() if cpu_seconds else None
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return records, wall, cpu
+
+###########################################
+# サーバー
+
+def serve(port, processes=None):
+    """
+    Run app.py on 127.0.0.1:port with a threaded server (the load test starts this in a subprocess).
+    """
+    from werkzeug.serving import make_server
+
+    import app as server
+    from solver_pool import SolverPool
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # terminate で終了処理 (ワーカーの停止) が走るよう、SIGTERM を SystemExit にします。
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    # 最初のリクエストを待たずにワーカーを起動しておきます。
+    server.pool = SolverPool(processes=processes)
+    make_server('127.0.0.1', port, server.app, threaded=True).serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(port, processes=None, timeout=60.0):
+    """
+    :return: The subprocess.Popen of the server, once it accepts connections.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port)]
+    if processes:
+        command += ['--processes', str(processes)]
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'the server exited with {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('the server did not start in time')
+
+def process_cpu_seconds(pid):
+    """
+    CPU time used by a process and all its descendants (e.g. the solver workers), from /proc.
+    :return: Seconds, or None where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # comm は括弧で囲まれ空白を含むことがあるので、最後の ')' の後から数えます。
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # fields[1]: ppid, fields[11:15]: utime, stime, cutime, cstime
+        stats[int(entry)] = (int(fields[1]), sum(int(value) for value in fields[11:15]))
+    total, family = 0, {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (parent, _) in stats.items():
+            if parent in family and child not in family:
+                family.add(child)
+                changed = True
+    for member in family:
+        if member in stats:
+            total += stats[member][1]
+    return total / ticks
+
+###########################################
+
+def summarize(records, wall, cpu_seconds=None):
+    """
+    :return: Dictionary of request counts, throughput, latency percentiles, error and timeout rates and server CPU.
+    """
+    count = len(records)
+    outcomes = [outcome for _, _, outcome, _ in records]
+    latencies = np.array([latency for _, latency, outcome, _ in records if outcome == 'ok'])
+    statuses = {}
+    for _, _, _, status in records:
+        key = 'none' if status is None else str(status)
+        statuses[key] = statuses.get(key, 0) + 1
+
+    def percentile(q):
+        return float(np.percentile(latencies, q)) if len(latencies) else None
+
+    return {
+        'requests': count,
+        'wall': wall,
+        'throughput': outcomes.count('ok') / wall if wall > 0 else 0.0,
+        'latency_p50': percentile(50),
+        'latency_p95': percentile(95),
+        'latency_p99': percentile(99),
+        'latency_max': float(latencies.max()) if len(latencies) else None,
+        'error_rate': outcomes.count('error') / count if count else 0.0,
+        'timeout_rate': outcomes.count('timeout') / count if count else 0.0,
+        'statuses': statuses,
+        'server_cpu_seconds': cpu_seconds,
+        # サーバーが平均で何コア分使ったか
+        'server_cpu_utilization': cpu_seconds / wall if cpu_seconds is not None and wall > 0 else None,
+    }
+
+def format_summary(summary):
+    def ms(value):
+        return '-' if value is None else f'{value * 1000:.1f} ms'
+
+    lines = [
+        f"requests     {summary['requests']} in {summary['wall']:.1f} s",
+        f"throughput   {summary['throughput']:.1f} responses/s",
+        f"latency      p50 {ms(summary['latency_p50'])}  p95 {ms(summary['latency_p95'])}  "
+        f"p99 {ms(summary['latency_p99'])}  max {ms(summary['latency_max'])}",
+        f"errors       {summary['error_rate'] * 100:.2f} %",
+        f"timeouts     {summary['timeout_rate'] * 100:.2f} %",
+        f"statuses     {', '.join(f'{key}: {n}' for key, n in sorted(summary['statuses'].items()))}",
+    ]
+    if summary['server_cpu_seconds'] is not None:
+        lines.append(f"server CPU   {summary['server_cpu_seconds']:.1f} s "
+                     f"({summary['server_cpu_utilization']:.2f} cores)")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test app.py with simulated dragging clients.')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent dragging users')
+    parser.add_argument('--rate', type=float, default=60.0, help='mousemove events per second per client')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of dragging')
+    parser.add_argument('--generator', default='four_bar', help='sketch generator of benchmark.py')
+    parser.add_argument('--size', type=int, default=4, help='points in the sketch')
+    parser.add_argument('--mode', choices=('session', 'full'), default='session')
+    parser.add_argument('--connections', type=int, default=BROWSER_CONNECTIONS,
+                        help='concurrent connections per client')
+    parser.add_argument('--timeout', type=float, default=2.0, help='client-side timeout of a request in seconds')
+    parser.add_argument('--processes', type=int, help='solver worker processes of the started server')
+    parser.add_argument('--url', help='test an already running server (http://host:port) instead of starting one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.port, args.processes)
+        return 0
+
+    from benchmark import GENERATORS, FixedDistanceConstraint
+
+    constraints, xy, target_index = GENERATORS[args.generator](args.size)
+    problem = problem_json(constraints, xy, target_index)
+    # benchmark.run_case と同じく、リンクの長さの中央値の10%を半径にして動かします。
+    lengths = [c.distance for c in constraints if isinstance(c, FixedDistanceConstraint)]
+    radius = 0.1 * float(np.median(lengths)) if lengths else 1.0
+    rng = np.random.default_rng(args.seed)
+    traces = [drag_trace(xy, target_index, radius, args.rate, args.duration, phase=rng.uniform(0, 2 * np.pi))
+              for _ in range(args.clients)]
+
+    server = None
+    if args.url:
+        host, _, port = args.url.split('://', 1)[-1].rstrip('/').partition(':')
+        port = int(port or 80)
+    else:
+        host, port = '127.0.0.1', free_port()
+        server = start_server(port, args.processes)
+    try:
+        records, wall, cpu_seconds = asyncio.run(run_clients(
+            host, port, problem, traces, args.mode, args.connections, args.timeout,
+            (lambda: process_cpu_seconds(server.pid)) if server else None))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    summary = summarize(records, wall, cpu_seconds)
+    print(json.dumps(summary, indent=1) if args.json else format_summary(summary))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,228 @@
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+###########################################
+# ソルバーの計測
+#
+# 解くたびに1件の記録 (辞書) を作り、SolveMetrics に集計して
+# /metrics からPrometheusのテキスト形式で返します。
+# 制約の評価時間は CompiledConstraints の評価関数に付けた timed_evaluation で
+# スレッドごとに積算し、解く前後の差を取ります (perf_counter 2回分のコストです)。
+# enable_json_log (またはロガー 'solver.metrics' を INFO で有効にする) と、1件ごとにJSONを1行出力します。
+###########################################
+
+logger = logging.getLogger('solver.metrics')
+
+class EvaluationClock(threading.local):
+    """
+    Time and calls spent evaluating constraints in the current thread.
+    """
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = {'residuals': 0, 'jacobian': 0, 'hessian': 0}
+
+evaluation_clock = EvaluationClock()
+
+def enable_json_log(stream=None):
+    """
+    Write every solve record as one JSON line to stream (default: stderr).
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def timed_evaluation(kind):
+    """
+    Decorator adding the run time of a constraint evaluation to evaluation_clock.
+    :param kind: 'residuals', 'jacobian' or 'hessian'.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                clock = evaluation_clock
+                clock.seconds += time.perf_counter() - start
+                clock.calls[kind] += 1
+        return wrapper
+    return decorator
+
+class Stopwatch:
+    """
+    Wall time of a block and the constraint evaluation time spent inside it.
+    """
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.evaluation_start = evaluation_clock.seconds
+        self.calls_start = dict(evaluation_clock.calls)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.start
+        self.evaluation = evaluation_clock.seconds - self.evaluation_start
+        self.calls = {kind: n - self.calls_start[kind] for kind, n in evaluation_clock.calls.items()}
+        return False
+
+def solve_record(kind, stopwatch, results, success, points, constraints, cached=False, cache_events=None):
+    """
+    One solve as a flat JSON-serializable dictionary.
+    :param kind: What was solved, e.g. 'solve' or 'session'.
+    :param stopwatch: The Stopwatch around the solve.
+    :param results: The OptimizeResults of the solved components (empty on a cache hit).
+        A stacked result of batch_solver counts the iterations of its slowest problem.
+    :param success: Whether the dragged component converged.
+    :param points: Number of points in the problem.
+    :param constraints: Number of constraints in the problem.
+    :param cache_events: Hits, misses and evictions of the SolutionCache during the solve
+        (see cache.SolutionCache.events_since), if one was used.
+    """
+    if cached:
+        status = 'cached'
+    elif any(np.any(r.status == 99) for r in results):
+        # コールバックが StopIteration を送出した (締め切りで打ち切った) 場合
+        status = 'deadline'
+    else:
+        status = 'converged' if success else 'failed'
+    return {
+        'kind': kind,
+        'status': status,
+        'points': points,
+        'constraints': constraints,
+        'components': len(results),
+        'wall': stopwatch.wall,
+        'constraint_time': stopwatch.evaluation,
+        'solver_time': max(stopwatch.wall - stopwatch.evaluation, 0.0),
+        'nit': sum(int(np.max(r.get('nit', 0))) for r in results),
+        'nfev': sum(int(r.get('nfev', 0)) for r in results),
+        'njev': sum(int(r.get('njev', 0)) for r in results),
+        'constraint_evaluations': stopwatch.calls['residuals'],
+        'constraint_jacobian_evaluations': stopwatch.calls['jacobian'],
+        'constraint_hessian_evaluations': stopwatch.calls['hessian'],
+        'cache_hits': (cache_events or {}).get('hits', 0),
+        'cache_misses': (cache_events or {}).get('misses', 0),
+        'cache_evictions': (cache_events or {}).get('evictions', 0),
+    }
+
+###########################################
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_labels(labels, le=repr(float(bound)))} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{_labels(labels, le="+Inf")} {cumulative}'
+        yield f'{name}_sum{_labels(labels)} {self.sum!r}'
+        yield f'{name}_count{_labels(labels)} {cumulative}'
+
+def _labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+# 名前 → (説明, ヒストグラムの区切り)
+HISTOGRAMS = {
+    'solver_solve_seconds': ('Wall time of a solve.',
+                             (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)),
+    'solver_iterations': ('Solver iterations per solve, summed over components.',
+                          (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)),
+    'solver_problem_points': ('Points per solved problem.', (10, 30, 100, 300, 1000, 3000, 10000, 100000)),
+    'solver_problem_constraints': ('Constraints per solved problem.',
+                                   (10, 30, 100, 300, 1000, 3000, 10000, 100000)),
+}
+
+# 名前 → (説明, 記録のキー)
+COUNTERS = {
+    'solver_constraint_seconds_total': ('Time spent evaluating constraints and their derivatives.', 'constraint_time'),
+    'solver_core_seconds_total': ('Time spent in the solver outside constraint evaluation.', 'solver_time'),
+    'solver_function_evaluations_total': ('Objective evaluations reported by the solver.', 'nfev'),
+    'solver_gradient_evaluations_total': ('Objective gradient evaluations reported by the solver.', 'njev'),
+    'solver_constraint_evaluations_total': ('Constraint residual evaluations.', 'constraint_evaluations'),
+    'solver_constraint_jacobian_evaluations_total': ('Constraint Jacobian evaluations.',
+                                                     'constraint_jacobian_evaluations'),
+    'solver_constraint_hessian_evaluations_total': ('Constraint Hessian evaluations.',
+                                                    'constraint_hessian_evaluations'),
+    'solver_cache_hits_total': ('Solution cache lookups that found a solution.', 'cache_hits'),
+    'solver_cache_misses_total': ('Solution cache lookups that found nothing.', 'cache_misses'),
+    'solver_cache_evictions_total': ('Solutions dropped from a full solution cache.', 'cache_evictions'),
+}
+
+class SolveMetrics:
+    """
+    Thread-safe aggregate of solve records, rendered in the Prometheus text format.
+    Every series is labelled with the kind of solve; solves are also counted by status.
+    """
+    def __init__(self):
+        self.solves = {}
+        self.histograms = {name: {} for name in HISTOGRAMS}
+        self.counters = {name: {} for name in COUNTERS}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def observe(self, record):
+        kind = (('kind', record['kind']),)
+        with self.lock:
+            key = kind + (('status', record['status']),)
+            self.solves[key] = self.solves.get(key, 0) + 1
+            for name, value in (('solver_solve_seconds', record['wall']),
+                                ('solver_iterations', record['nit']),
+                                ('solver_problem_points', record['points']),
+                                ('solver_problem_constraints', record['constraints'])):
+                series = self.histograms[name]
+                if kind not in series:
+                    series[kind] = Histogram(HISTOGRAMS[name][1])
+                series[kind].observe(value)
+            for name, (_, field) in COUNTERS.items():
+                series = self.counters[name]
+                series[kind] = series.get(kind, 0) + record[field]
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record))
+
+    def count_request(self, kind, outcome):
+        """
+        Count a request to the solver pool by its outcome (ok, cancelled, unknown, unsolvable, error or lost).
+        """
+        key = (('kind', kind), ('outcome', outcome))
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += ['# HELP solver_solves_total Solves by kind and status.', '# TYPE solver_solves_total counter']
+            lines += [f'solver_solves_total{_labels(key)} {n}' for key, n in sorted(self.solves.items())]
+            lines += ['# HELP solver_requests_total Solver pool requests by kind and outcome.',
+                      '# TYPE solver_requests_total counter']
+            lines += [f'solver_requests_total{_labels(key)} {n}' for key, n in sorted(self.requests.items())]
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for key, histogram in sorted(self.histograms[name].items()):
+                    lines += histogram.lines(name, key)
+            for name, (help_text, _) in COUNTERS.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                lines += [f'{name}{_labels(key)} {value!r}' for key, value in sorted(self.counters[name].items())]
+        return '\n'.join(lines) + '\n'
+
+# プロセス全体の集計 (Flaskのプロセスではワーカーから届いた記録もここに集めます)
+registry = SolveMetrics()
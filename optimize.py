@@ -1,34 +1,134 @@
+import math
+import time
+
 import numpy as np
-from scipy.optimize import minimize
+
+from metrics import Stopwatch, registry, solve_record, timed_evaluation
 
 ###########################################
 
+class CoordinateBuffer:
+    """
+    Holder of a flat coordinate array [x0, y0, x1, y1, ...] that points view into.
+    sketch.Sketch is the growable version.
+    """
+    __slots__ = ('coordinates',)
+
+    def __init__(self, coordinates):
+        self.coordinates = coordinates
+
 class Point:
+    """
+    A point as a view of two entries of a coordinate buffer.
+    Points of a Sketch read and write the sketch's array directly;
+    Point(x, y) makes a buffer of its own.
+    """
+    __slots__ = ('buffer', 'index')
+
     def __init__(self, x, y):
-        self.x = x
-        self.y = y
+        self.buffer = CoordinateBuffer(np.array([x, y], dtype=float))
+        self.index = 0
+
+    @classmethod
+    def view(cls, buffer, index):
+        """
+        :param buffer: Object with a flat coordinates array, e.g. a CoordinateBuffer or a Sketch.
+        """
+        point = cls.__new__(cls)
+        point.buffer = buffer
+        point.index = index
+        return point
+
+    @property
+    def x(self):
+        return float(self.buffer.coordinates[2 * self.index])
+
+    @x.setter
+    def x(self, value):
+        self.buffer.coordinates[2 * self.index] = value
+
+    @property
+    def y(self):
+        return float(self.buffer.coordinates[2 * self.index + 1])
+
+    @y.setter
+    def y(self, value):
+        self.buffer.coordinates[2 * self.index + 1] = value
+
+    def __repr__(self):
+        return f'Point(x={self.x}, y={self.y})'
 
 class Line:
+    __slots__ = ('p1', 'p2')
+
     def __init__(self, p1, p2):
         self.p1 = p1
         self.p2 = p2
 
     @property
     def length(self):
-        return np.sqrt((self.p1.x - self.p2.x) ** 2 + (self.p1.y - self.p2.y) ** 2)
+        return math.hypot(self.p1.x - self.p2.x, self.p1.y - self.p2.y)
+
+class PointsView:
+    """
+    Read-only mapping from point names ('p0', 'p1', ... or indices) to Point views
+    of a flat coordinate array, for Constraint.evaluate. Views are made on access only.
+    """
+    __slots__ = ('buffer',)
+
+    def __init__(self, points_array):
+        self.buffer = CoordinateBuffer(np.asarray(points_array, dtype=float))
+
+    def __getitem__(self, name):
+        index = point_index(name)
+        if not 0 <= index < len(self.buffer.coordinates) // 2:
+            raise KeyError(name)
+        return Point.view(self.buffer, index)
+
+    def __len__(self):
+        return len(self.buffer.coordinates) // 2
 
 ###########################################
 
 class Constraint:
+    # 同じ種類の制約をまとめてベクトル評価するカーネルクラス (サブクラスで指定)
+    kernel = None
+    # 点の名前を保持する属性の一覧 (サブクラスで指定)
+    point_fields = ()
+
     def evaluate(self, points):
         """
         Evaluate the constraint.
         :param points: A dictionary of points.
-        :return: The value of the constraint function.
+        :return: The value of the constraint function, the same as its kernel's residual
+            (a tuple in row order for kernels with more than one residual_count).
         """
         raise NotImplementedError
 
+    def points(self):
+        """
+        :return: The names of the points this constraint refers to.
+        """
+        return [getattr(self, field) for field in self.point_fields]
+
+    def to_dict(self):
+        return {'type': type(self).__name__, **vars(self)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a constraint from {'type': <class name>, <attribute>: <value>, ...}.
+        """
+        data = dict(data)
+        types = {subclass.__name__: subclass for subclass in cls.__subclasses__()}
+        name = data.pop('type')
+        if name not in types:
+            raise ValueError(f'unknown constraint type: {name}')
+        return types[name](**data)
+
 class FixedDistanceConstraint(Constraint):
+    point_fields = ('point1', 'point2')
+
     def __init__(self, point1, point2, distance):
         self.point1 = point1
         self.point2 = point2
@@ -40,6 +140,8 @@ class FixedDistanceConstraint(Constraint):
         return ((p1.x - p2.x) ** 2 + (p1.y - p2.y) ** 2) ** 0.5 - self.distance
 
 class FixedPointConstraint(Constraint):
+    point_fields = ('point',)
+
     def __init__(self, point, x, y):
         self.point = point
         self.x = x
@@ -49,118 +151,914 @@ class FixedPointConstraint(Constraint):
         p = points[self.point]
         return (p.x - self.x) ** 2 + (p.y - self.y) ** 2
 
+# 以下の制約の「直線」は2点を通る直線 (線分の長さは変えません)。
+# 角度はラジアンで、point1 → point2 の向きから point3 → point4 の向きへ x 軸から y 軸の向きに測ります。
+
+class CoincidentConstraint(Constraint):
+    """
+    Two points at the same position (two residuals, the x and y differences).
+    """
+    point_fields = ('point1', 'point2')
+
+    def __init__(self, point1, point2):
+        self.point1 = point1
+        self.point2 = point2
+
+    def evaluate(self, points):
+        p1 = points[self.point1]
+        p2 = points[self.point2]
+        return p1.x - p2.x, p1.y - p2.y
+
+class HorizontalConstraint(Constraint):
+    """
+    The line through two points is horizontal (equal y).
+    """
+    point_fields = ('point1', 'point2')
+
+    def __init__(self, point1, point2):
+        self.point1 = point1
+        self.point2 = point2
+
+    def evaluate(self, points):
+        return points[self.point1].y - points[self.point2].y
+
+class VerticalConstraint(Constraint):
+    """
+    The line through two points is vertical (equal x).
+    """
+    point_fields = ('point1', 'point2')
+
+    def __init__(self, point1, point2):
+        self.point1 = point1
+        self.point2 = point2
+
+    def evaluate(self, points):
+        return points[self.point1].x - points[self.point2].x
+
+def _cross_dot(points, point1, point2, point3, point4):
+    p1, p2, p3, p4 = (points[p] for p in (point1, point2, point3, point4))
+    ux, uy, vx, vy = p2.x - p1.x, p2.y - p1.y, p4.x - p3.x, p4.y - p3.y
+    return ux * vy - uy * vx, ux * vx + uy * vy
+
+class ParallelConstraint(Constraint):
+    """
+    The line through point1 and point2 is parallel to the line through point3 and point4.
+    """
+    point_fields = ('point1', 'point2', 'point3', 'point4')
+
+    def __init__(self, point1, point2, point3, point4):
+        self.point1 = point1
+        self.point2 = point2
+        self.point3 = point3
+        self.point4 = point4
+
+    def evaluate(self, points):
+        # 方向ベクトルの外積 (長さの二乗の単位)
+        return _cross_dot(points, *self.points())[0]
+
+class PerpendicularConstraint(Constraint):
+    """
+    The line through point1 and point2 is perpendicular to the line through point3 and point4.
+    """
+    point_fields = ('point1', 'point2', 'point3', 'point4')
+
+    def __init__(self, point1, point2, point3, point4):
+        self.point1 = point1
+        self.point2 = point2
+        self.point3 = point3
+        self.point4 = point4
+
+    def evaluate(self, points):
+        return -_cross_dot(points, *self.points())[1]
+
+class AngleConstraint(Constraint):
+    """
+    The direction point3 -> point4 is at angle (radians) from the direction point1 -> point2.
+    The opposite direction (angle + pi) also satisfies it; the solver keeps the one nearest the start.
+    """
+    point_fields = ('point1', 'point2', 'point3', 'point4')
+
+    def __init__(self, point1, point2, point3, point4, angle):
+        self.point1 = point1
+        self.point2 = point2
+        self.point3 = point3
+        self.point4 = point4
+        self.angle = angle
+
+    def evaluate(self, points):
+        # |u| |v| sin(実際の角度 - angle)
+        cross, dot = _cross_dot(points, *self.points())
+        return math.cos(self.angle) * cross - math.sin(self.angle) * dot
+
+class PointOnLineConstraint(Constraint):
+    """
+    point lies on the line through point1 and point2.
+    """
+    point_fields = ('point', 'point1', 'point2')
+
+    def __init__(self, point, point1, point2):
+        self.point = point
+        self.point1 = point1
+        self.point2 = point2
+
+    def evaluate(self, points):
+        return _cross_dot(points, self.point1, self.point2, self.point1, self.point)[0]
+
+class PointOnCircleConstraint(Constraint):
+    """
+    point lies on the circle with the given center and radius.
+    """
+    point_fields = ('point', 'center')
+
+    def __init__(self, point, center, radius):
+        self.point = point
+        self.center = center
+        self.radius = radius
+
+    def evaluate(self, points):
+        p = points[self.point]
+        c = points[self.center]
+        return math.hypot(p.x - c.x, p.y - c.y) - self.radius
+
+class EqualLengthConstraint(Constraint):
+    """
+    The segment point1-point2 is as long as the segment point3-point4.
+    """
+    point_fields = ('point1', 'point2', 'point3', 'point4')
+
+    def __init__(self, point1, point2, point3, point4):
+        self.point1 = point1
+        self.point2 = point2
+        self.point3 = point3
+        self.point4 = point4
+
+    def evaluate(self, points):
+        p1, p2, p3, p4 = (points[p] for p in self.points())
+        return math.hypot(p2.x - p1.x, p2.y - p1.y) - math.hypot(p4.x - p3.x, p4.y - p3.y)
+
+
+###########################################
+
+def point_index(name):
+    """
+    Convert a point name used by the constraints ('p0', 'p1', ...) to its index.
+    :param name: The point name, or an integer index.
+    :return: The index of the point in the flat coordinate array.
+    """
+    if isinstance(name, str):
+        return int(name.lstrip('p'))
+    return int(name)
+
+class FixedDistanceKernel:
+    """
+    All FixedDistanceConstraint instances packed into index and parameter arrays.
+    """
+    # 残差の単位が長さの何乗か (scaling.ScaledConstraints が正規化に使います)
+    residual_degree = 1
+    # 制約1つあたりの残差の行数 (2行以上なら、制約ごとに続けて並べます)
+    residual_count = 1
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point1) for c in constraints], dtype=np.intp)
+        self.j = np.array([point_index(c.point2) for c in constraints], dtype=np.intp)
+        self.distance = np.array([c.distance for c in constraints], dtype=float)
+
+    @classmethod
+    def from_arrays(cls, i, j, distance):
+        """
+        A kernel over index and distance arrays directly, e.g. for the two lengths of EqualLengthKernel.
+        """
+        kernel = cls.__new__(cls)
+        kernel.i, kernel.j, kernel.distance = i, j, distance
+        return kernel
+
+    def __len__(self):
+        return len(self.i)
+
+    def residuals(self, xy):
+        """
+        :param xy: Point coordinates of shape (..., number of points, 2); leading axes are a batch.
+        """
+        diff = xy[..., self.i, :] - xy[..., self.j, :]
+        return np.sqrt(np.einsum('...ij,...ij->...i', diff, diff)) - self.distance
+
+    def jacobian(self, xy):
+        """
+        Exact derivative of the residuals.
+        :return: (rows, cols, values) of the non-zero entries, rows local to this kernel.
+            values has the batch axes of xy in front; rows and cols are shared.
+        """
+        diff = xy[..., self.i, :] - xy[..., self.j, :]
+        norm = np.sqrt(np.einsum('...ij,...ij->...i', diff, diff))[..., None]
+        # 2点が重なっている場合は方向が定まらないので勾配0とする
+        unit = np.divide(diff, norm, out=np.zeros_like(diff), where=norm > 0)
+        rows = np.repeat(np.arange(len(self.i)), 4)
+        cols = np.stack([2 * self.i, 2 * self.i + 1, 2 * self.j, 2 * self.j + 1], axis=1).ravel()
+        values = np.concatenate([unit, -unit], axis=-1).reshape(*xy.shape[:-2], -1)
+        return rows, cols, values
+
+    def hessian(self, xy, weights):
+        """
+        Sum of the residuals' second derivatives weighted by weights (one per residual).
+        :return: (rows, cols, values) of the entries, in coordinates; duplicates are to be added.
+        """
+        diff = xy[..., self.i, :] - xy[..., self.j, :]
+        norm = np.sqrt(np.einsum('...ij,...ij->...i', diff, diff))
+        unit = np.divide(diff, norm[..., None], out=np.zeros_like(diff), where=norm[..., None] > 0)
+        # d²|p_i - p_j| は (I - u u^T) / |p_i - p_j| を [[A, -A], [-A, A]] に並べたもの
+        scale = np.divide(weights, norm, out=np.zeros_like(norm), where=norm > 0)
+        block = (np.eye(2) - unit[..., :, None] * unit[..., None, :]) * scale[..., None, None]
+        values = np.concatenate([np.concatenate([block, -block], axis=-1),
+                                 np.concatenate([-block, block], axis=-1)], axis=-2)
+        coordinates = np.stack([2 * self.i, 2 * self.i + 1, 2 * self.j, 2 * self.j + 1], axis=1)
+        rows = np.repeat(coordinates, 4, axis=1).ravel()
+        cols = np.tile(coordinates, (1, 4)).ravel()
+        return rows, cols, values.reshape(*xy.shape[:-2], -1)
+
+class FixedPointKernel:
+    """
+    All FixedPointConstraint instances packed into index and parameter arrays.
+    """
+    # 残差は距離の二乗
+    residual_degree = 2
+    residual_count = 1
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point) for c in constraints], dtype=np.intp)
+        self.position = np.array([(c.x, c.y) for c in constraints], dtype=float).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.i)
+
+    def residuals(self, xy):
+        diff = xy[..., self.i, :] - self.position
+        return np.einsum('...ij,...ij->...i', diff, diff)
+
+    def jacobian(self, xy):
+        diff = xy[..., self.i, :] - self.position
+        rows = np.repeat(np.arange(len(self.i)), 2)
+        cols = np.stack([2 * self.i, 2 * self.i + 1], axis=1).ravel()
+        values = (2 * diff).reshape(*xy.shape[:-2], -1)
+        return rows, cols, values
+
+    def hessian(self, xy, weights):
+        # |p - a|^2 の二階微分は 2I
+        coordinates = np.stack([2 * self.i, 2 * self.i + 1], axis=1).ravel()
+        values = np.repeat(2 * np.asarray(weights, dtype=float), 2, axis=-1)
+        return coordinates, coordinates, values
+
+def _no_entries(xy):
+    return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(xy.shape[:-2] + (0,))
+
+class CoincidentKernel:
+    """
+    All CoincidentConstraint instances; each gives the rows x1 - x2 and y1 - y2.
+    """
+    residual_degree = 1
+    residual_count = 2
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point1) for c in constraints], dtype=np.intp)
+        self.j = np.array([point_index(c.point2) for c in constraints], dtype=np.intp)
+
+    def __len__(self):
+        return len(self.i)
+
+    def residuals(self, xy):
+        diff = xy[..., self.i, :] - xy[..., self.j, :]
+        return diff.reshape(*xy.shape[:-2], -1)
+
+    def jacobian(self, xy):
+        rows = np.repeat(np.arange(2 * len(self.i)), 2)
+        cols = np.stack([2 * self.i, 2 * self.j, 2 * self.i + 1, 2 * self.j + 1], axis=1).ravel()
+        values = np.broadcast_to(np.tile([1.0, -1.0], 2 * len(self.i)), xy.shape[:-2] + (len(cols),))
+        return rows, cols, values
+
+    def hessian(self, xy, weights):
+        # 線形なので二階微分は0
+        return _no_entries(xy)
+
+class AxisAlignedKernel:
+    """
+    Base of HorizontalKernel and VerticalKernel: one coordinate of two points is equal.
+    """
+    residual_degree = 1
+    residual_count = 1
+    # 等しくする座標 (0: x, 1: y)
+    axis = None
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point1) for c in constraints], dtype=np.intp)
+        self.j = np.array([point_index(c.point2) for c in constraints], dtype=np.intp)
+
+    def __len__(self):
+        return len(self.i)
+
+    def residuals(self, xy):
+        return xy[..., self.i, self.axis] - xy[..., self.j, self.axis]
+
+    def jacobian(self, xy):
+        rows = np.repeat(np.arange(len(self.i)), 2)
+        cols = np.stack([2 * self.i + self.axis, 2 * self.j + self.axis], axis=1).ravel()
+        values = np.broadcast_to(np.tile([1.0, -1.0], len(self.i)), xy.shape[:-2] + (len(cols),))
+        return rows, cols, values
+
+    def hessian(self, xy, weights):
+        return _no_entries(xy)
+
+class HorizontalKernel(AxisAlignedKernel):
+    axis = 1
+
+class VerticalKernel(AxisAlignedKernel):
+    axis = 0
+
+class AngleKernel:
+    """
+    All AngleConstraint instances. With u = p2 - p1, v = p4 - p3 the residual is
+    cos(angle) cross(u, v) - sin(angle) dot(u, v) = |u| |v| sin(actual angle - angle),
+    which is bilinear in u and v, so its derivatives stay simple and defined everywhere.
+    Parallel, perpendicular and point-on-line constraints are the same residual with a fixed angle.
+    """
+    # 残差は長さの二乗
+    residual_degree = 2
+    residual_count = 1
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point1) for c in constraints], dtype=np.intp)
+        self.j = np.array([point_index(c.point2) for c in constraints], dtype=np.intp)
+        self.k = np.array([point_index(c.point3) for c in constraints], dtype=np.intp)
+        self.l = np.array([point_index(c.point4) for c in constraints], dtype=np.intp)
+        angle = np.array([c.angle for c in constraints], dtype=float)
+        self.cos = np.cos(angle)
+        self.sin = np.sin(angle)
+
+    def __len__(self):
+        return len(self.i)
+
+    def _directions(self, xy):
+        return xy[..., self.j, :] - xy[..., self.i, :], xy[..., self.l, :] - xy[..., self.k, :]
+
+    def _coordinates(self):
+        return np.stack([2 * self.i, 2 * self.i + 1, 2 * self.j, 2 * self.j + 1,
+                         2 * self.k, 2 * self.k + 1, 2 * self.l, 2 * self.l + 1], axis=1)
+
+    def residuals(self, xy):
+        u, v = self._directions(xy)
+        cross = u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+        return self.cos * cross - self.sin * np.einsum('...ij,...ij->...i', u, v)
+
+    def jacobian(self, xy):
+        u, v = self._directions(xy)
+        c, s = self.cos, self.sin
+        du = np.stack([c * v[..., 1] - s * v[..., 0], -c * v[..., 0] - s * v[..., 1]], axis=-1)
+        dv = np.stack([-c * u[..., 1] - s * u[..., 0], c * u[..., 0] - s * u[..., 1]], axis=-1)
+        rows = np.repeat(np.arange(len(self.i)), 8)
+        values = np.concatenate([-du, du, -dv, dv], axis=-1).reshape(*xy.shape[:-2], -1)
+        return rows, self._coordinates().ravel(), values
+
+    def hessian(self, xy, weights):
+        # 残差は u^T M v (M = [[-s, c], [-c, -s]]) なので、二階微分は u と v の間のブロックだけです。
+        # u = p2 - p1, v = p4 - p3 の符号を付けると (p1, p2) × (p3, p4) のブロックは [[M, -M], [-M, M]]。
+        c, s = self.cos, self.sin
+        m = np.stack([np.stack([-s, c], axis=-1), np.stack([-c, -s], axis=-1)], axis=-2)
+        block = np.concatenate([np.concatenate([m, -m], axis=-1), np.concatenate([-m, m], axis=-1)], axis=-2)
+        coordinates = self._coordinates()
+        first, second = coordinates[:, :4], coordinates[:, 4:]
+        rows = np.concatenate([np.repeat(first, 4, axis=1), np.repeat(second, 4, axis=1)], axis=1).ravel()
+        cols = np.concatenate([np.tile(second, (1, 4)), np.tile(first, (1, 4))], axis=1).ravel()
+        entries = np.concatenate([block.reshape(-1, 16), block.transpose(0, 2, 1).reshape(-1, 16)], axis=-1)
+        values = np.asarray(weights, dtype=float)[..., None] * entries
+        return rows, cols, values.reshape(*xy.shape[:-2], -1)
+
+class ParallelKernel(AngleKernel):
+    """
+    All ParallelConstraint instances: the cross product of the two directions.
+    """
+    def __init__(self, constraints):
+        super().__init__([AngleConstraint(c.point1, c.point2, c.point3, c.point4, 0.0) for c in constraints])
+
+class PerpendicularKernel(AngleKernel):
+    """
+    All PerpendicularConstraint instances: minus the dot product of the two directions.
+    """
+    def __init__(self, constraints):
+        super().__init__([AngleConstraint(c.point1, c.point2, c.point3, c.point4, 0.0) for c in constraints])
+        # cos(pi / 2) を丸め誤差なしに0にします。
+        self.cos = np.zeros(len(self.i))
+        self.sin = np.ones(len(self.i))
+
+class PointOnLineKernel(AngleKernel):
+    """
+    All PointOnLineConstraint instances: cross(p2 - p1, p - p1), i.e. p1 -> p is parallel to p1 -> p2.
+    """
+    def __init__(self, constraints):
+        super().__init__([AngleConstraint(c.point1, c.point2, c.point1, c.point, 0.0) for c in constraints])
+
+class PointOnCircleKernel(FixedDistanceKernel):
+    """
+    All PointOnCircleConstraint instances: the point is at distance radius from the center.
+    """
+    def __init__(self, constraints):
+        super().__init__([FixedDistanceConstraint(c.point, c.center, c.radius) for c in constraints])
+
+class EqualLengthKernel:
+    """
+    All EqualLengthConstraint instances: |p2 - p1| - |p4 - p3|,
+    differentiated as the difference of two FixedDistanceKernel residuals.
+    """
+    residual_degree = 1
+    residual_count = 1
+    def __init__(self, constraints):
+        self.i = np.array([point_index(c.point1) for c in constraints], dtype=np.intp)
+        self.j = np.array([point_index(c.point2) for c in constraints], dtype=np.intp)
+        self.k = np.array([point_index(c.point3) for c in constraints], dtype=np.intp)
+        self.l = np.array([point_index(c.point4) for c in constraints], dtype=np.intp)
+
+    def __len__(self):
+        return len(self.i)
+
+    def _lengths(self):
+        zero = np.zeros(len(self.i))
+        return FixedDistanceKernel.from_arrays(self.i, self.j, zero), FixedDistanceKernel.from_arrays(self.k, self.l, zero)
+
+    def residuals(self, xy):
+        first, second = self._lengths()
+        return first.residuals(xy) - second.residuals(xy)
+
+    def jacobian(self, xy):
+        first, second = self._lengths()
+        rows1, cols1, values1 = first.jacobian(xy)
+        rows2, cols2, values2 = second.jacobian(xy)
+        return np.concatenate([rows1, rows2]), np.concatenate([cols1, cols2]), np.concatenate([values1, -values2], axis=-1)
+
+    def hessian(self, xy, weights):
+        first, second = self._lengths()
+        weights = np.asarray(weights, dtype=float)
+        rows1, cols1, values1 = first.hessian(xy, weights)
+        rows2, cols2, values2 = second.hessian(xy, -weights)
+        return np.concatenate([rows1, rows2]), np.concatenate([cols1, cols2]), np.concatenate([values1, values2], axis=-1)
+
+FixedDistanceConstraint.kernel = FixedDistanceKernel
+FixedPointConstraint.kernel = FixedPointKernel
+CoincidentConstraint.kernel = CoincidentKernel
+HorizontalConstraint.kernel = HorizontalKernel
+VerticalConstraint.kernel = VerticalKernel
+ParallelConstraint.kernel = ParallelKernel
+PerpendicularConstraint.kernel = PerpendicularKernel
+AngleConstraint.kernel = AngleKernel
+PointOnLineConstraint.kernel = PointOnLineKernel
+PointOnCircleConstraint.kernel = PointOnCircleKernel
+EqualLengthConstraint.kernel = EqualLengthKernel
+
+class CompiledConstraints:
+    """
+    A constraint set compiled into NumPy arrays.
+    Constraints of the same type are evaluated together in one vectorized call,
+    so the whole residual vector costs a handful of array operations.
+    """
+    def __init__(self, constraints):
+        groups = {}
+        for constraint in constraints:
+            if constraint.kernel is None:
+                raise TypeError(f'{type(constraint).__name__} has no vectorized kernel')
+            groups.setdefault(constraint.kernel, []).append(constraint)
+
+        # 残差ベクトルは種類ごとにまとめて並ぶ。constraints はその順番
+        self.constraints = [c for group in groups.values() for c in group]
+        self.kernels = [kernel(group) for kernel, group in groups.items()]
+        # 2行以上の残差を持つ種類 (CoincidentConstraint) もあるので、行 → constraints の番号も持っておく
+        counts = [np.full(len(kernel), kernel.residual_count, dtype=np.intp) for kernel in self.kernels]
+        self.row_owners = np.repeat(np.arange(len(self.constraints)), np.concatenate(counts + [np.zeros(0, dtype=np.intp)]))
+        self.size = len(self.row_owners)
+
+    @timed_evaluation('residuals')
+    def residuals(self, points_array):
+        """
+        Evaluate every constraint at once.
+        :param points_array: Flat array of point coordinates [x0, y0, x1, y1, ...],
+            or a stack of them of shape (..., 2 * number of points) sharing these constraints.
+        :return: The residual vector, one entry per constraint (residual_count entries for kernels
+            with more than one), with the same leading axes.
+        """
+        points_array = np.asarray(points_array, dtype=float)
+        xy = points_array.reshape(*points_array.shape[:-1], -1, 2)
+        if not self.kernels:
+            return np.zeros(points_array.shape[:-1] + (0,))
+        return np.concatenate([kernel.residuals(xy) for kernel in self.kernels], axis=-1)
+
+    @timed_evaluation('jacobian')
+    def jacobian_entries(self, points_array):
+        """
+        Non-zero entries of the constraint Jacobian in coordinate (COO) form.
+        :param points_array: Flat array of point coordinates, or a stack of them.
+        :return: (rows, cols, values) arrays; values has the leading axes of points_array.
+        """
+        points_array = np.asarray(points_array, dtype=float)
+        xy = points_array.reshape(*points_array.shape[:-1], -1, 2)
+        rows, cols, values = [], [], []
+        offset = 0
+        for kernel in self.kernels:
+            r, c, v = kernel.jacobian(xy)
+            rows.append(r + offset)
+            cols.append(c)
+            values.append(v)
+            offset += len(kernel) * kernel.residual_count
+        if not rows:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(points_array.shape[:-1] + (0,))
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(values, axis=-1)
+
+    @timed_evaluation('hessian')
+    def hessian_entries(self, points_array, weights):
+        """
+        Entries of the weighted sum of the constraints' Hessians, sum_k weights[k] * d²c_k,
+        e.g. the constraint part of the Hessian of the Lagrangian with weights the multipliers.
+        :param weights: One weight per residual (with the leading axes of points_array).
+        :return: (rows, cols, values) arrays; entries at the same position are to be added.
+        """
+        points_array = np.asarray(points_array, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        xy = points_array.reshape(*points_array.shape[:-1], -1, 2)
+        rows, cols, values = [], [], []
+        offset = 0
+        for kernel in self.kernels:
+            r, c, v = kernel.hessian(xy, weights[..., offset:offset + len(kernel) * kernel.residual_count])
+            rows.append(r)
+            cols.append(c)
+            values.append(v)
+            offset += len(kernel) * kernel.residual_count
+        if not rows:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(points_array.shape[:-1] + (0,))
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(values, axis=-1)
+
+    def jacobian(self, points_array):
+        """
+        Dense constraint Jacobian, shape (number of constraints, len(points_array)),
+        or (..., number of constraints, number of coordinates) for a stack of coordinate arrays.
+        """
+        points_array = np.asarray(points_array, dtype=float)
+        rows, cols, values = self.jacobian_entries(points_array)
+        jac = np.zeros(points_array.shape[:-1] + (self.size, points_array.shape[-1]))
+        # 同じ点を2回参照する制約もあるので加算で組み立てる
+        np.add.at(jac, (Ellipsis, rows, cols), values)
+        return jac
+
+    def jacobian_sparse(self, points_array):
+        """
+        Constraint Jacobian as a scipy.sparse CSR matrix. Each constraint touches
+        only 2 to 4 coordinates, so this stays small for very large sketches.
+        """
+        from scipy.sparse import csr_matrix
+
+        rows, cols, values = self.jacobian_entries(points_array)
+        return csr_matrix((values, (rows, cols)), shape=(self.size, len(points_array)))
+
+def compile_constraints(constraints):
+    if isinstance(constraints, CompiledConstraints):
+        return constraints
+    return CompiledConstraints(constraints)
+
 
 ###########################################
 
-def objective_function(point_array, target_x, target_y):
-    x, y = point_array
+def objective_function(point_array, target_x, target_y, target_index=0):
+    x, y = point_array[2 * target_index:2 * target_index + 2]
     # 点と目標点との距離の二乗を計算
     distance_squared = (x - target_x) ** 2 + (y - target_y) ** 2
     return distance_squared
 
+def objective_gradient(point_array, target_x, target_y, target_index=0):
+    gradient = np.zeros(len(point_array))
+    x, y = point_array[2 * target_index:2 * target_index + 2]
+    gradient[2 * target_index] = 2 * (x - target_x)
+    gradient[2 * target_index + 1] = 2 * (y - target_y)
+    return gradient
+
 def constraint_function(points_array, constraint):
-    points = {f'p{i}': Point(points_array[2*i], points_array[2*i + 1]) for i in range(len(points_array) // 2)}
-    return constraint.evaluate(points)
+    # 点ごとにPointを作り直さず、配列の上のビューで評価します。
+    return constraint.evaluate(PointsView(points_array))
+
+def check_gradients(constraints, points_array, target_x=0.0, target_y=0.0, target_index=0, eps=1e-6, tol=None):
+    """
+    Compare the analytic derivatives against central finite differences.
+    :param constraints: The constraints (or a CompiledConstraints) to check.
+    :param points_array: Flat array of point coordinates to check at.
+    :param tol: If given, raise ValueError when any error exceeds it.
+    :return: Dictionary of the largest absolute error per constraint type (and of its
+        second derivative, as '<type> hessian'), plus 'objective'.
+    """
+    compiled = compile_constraints(constraints)
+    x = np.asarray(points_array, dtype=float)
+    errors = {}
+
+    def numeric(fun):
+        columns = []
+        for k in range(len(x)):
+            step = np.zeros(len(x))
+            step[k] = eps
+            columns.append((fun(x + step) - fun(x - step)) / (2 * eps))
+        return np.stack(columns, axis=-1)
 
+    args = (target_x, target_y, target_index)
+    errors['objective'] = float(np.max(np.abs(
+        objective_gradient(x, *args) - numeric(lambda z: np.asarray(objective_function(z, *args))))))
+
+    analytic = compiled.jacobian(x)
+    approx = numeric(compiled.residuals)
+    row = 0
+    for kernel in compiled.kernels:
+        count = len(kernel) * kernel.residual_count
+        name = type(compiled.constraints[compiled.row_owners[row]]).__name__
+        errors[name] = float(np.max(np.abs(analytic[row:row + count] - approx[row:row + count])))
+
+        # 二階微分は、この種類の制約だけに重み1を付けた J^T w の差分と比べます。
+        weights = np.zeros(compiled.size)
+        weights[row:row + count] = 1.0
+        rows, cols, values = compiled.hessian_entries(x, weights)
+        hessian = np.zeros((len(x), len(x)))
+        np.add.at(hessian, (rows, cols), values)
+        errors[f'{name} hessian'] = float(np.max(np.abs(hessian - numeric(lambda z: compiled.jacobian(z).T @ weights))))
+        row += count
+
+    if tol is not None:
+        wrong = {name: error for name, error in errors.items() if error > tol}
+        if wrong:
+            raise ValueError(f'analytic derivative does not match finite differences: {wrong}')
+    return errors
+
+###########################################
+# 時間制限付きの求解 (anytime)
+#
+# 締め切り (time.monotonic() の値) を渡すと、反復ごとのコールバックでそれまでで一番良い点を覚え、
+# 締め切りを過ぎたら StopIteration で打ち切ってその点を返します (status 99)。
+# 「良い」は、制約の違反が tol 以下の点の中で目的関数が小さいもの、なければ違反が小さいものです。
+# SLSQPの途中の点は拘束面から外れていることが多いので、打ち切ったときは最後の点を
+# ガウス・ニュートン法の最小ノルムの補正 dx = -J^T (J J^T)^-1 c で拘束面に戻したものも候補にします。
+# 1回の反復が長い問題でも締め切りを守れるよう、制約の評価 (DeadlineConstraints) でも時間を調べて
+# DeadlineExceeded で抜け出し、評価した点も候補にします。評価の間の計算 (密な部分問題の分解など) は
+# 止められないので、1反復目だけで予算を超えそうな密なバックエンドは、締め切りのあるときは
+# DEADLINE_BACKEND に替えます (backends.Backend.first_iteration_time)。
 ###########################################
 
-def run_optimization(constraints, initial_point, target_x, target_y):  #data):
-    # 空のリストを作成して、scipyの制約条件を格納します。
-    scipy_constraints = []
+# 締め切りまでに1反復目が終わりそうにないときに使うバックエンド
+DEADLINE_BACKEND = 'sparse-lm'
 
-    # constraintsリスト内の各制約オブジェクトに対してループを実行します。
-    for constraint in constraints:
-        # scipyの制約条件の辞書を作成します。
-        scipy_constraint = {
-            'type': 'eq',               # 等式制約を指定します。
-            'fun': constraint_function, # 制約関数を指定します。
-            'args': (constraint,)       # 制約関数に渡す追加の引数を指定します。
-        }
-        
-        # 作成した辞書をリストに追加します。
-        scipy_constraints.append(scipy_constraint)
+class DeadlineExceeded(Exception):
+    """Raised by DeadlineConstraints when an evaluation starts after the deadline."""
 
+class BestIterate:
+    """
+    Callback wrapper remembering the best iterate of a solve and stopping it at a deadline.
+    :param compiled: The CompiledConstraints being solved.
+    :param deadline: time.monotonic() value after which the solve is stopped.
+    :param tol: Constraint violation up to which an iterate counts as feasible.
+    :param restoration_steps: Gauss-Newton steps taken to bring the last iterate back onto the constraints.
+    :param callback: The caller's callback, still called with every iterate.
+    """
+    def __init__(self, compiled, target_x, target_y, target_index, deadline, tol=1e-6, restoration_steps=5,
+                 callback=None):
+        self.compiled = compiled
+        self.target = (target_x, target_y, target_index)
+        self.deadline = deadline
+        self.tol = tol
+        self.restoration_steps = restoration_steps
+        self.callback = callback
+        self.x = None
+        self.key = None
+        self.maxcv = None
 
-    # 目的関数に渡す追加の引数
-    additional_args = (target_x, target_y)
+    def consider(self, x, residuals=None):
+        """
+        :param residuals: The residuals at x, if already evaluated.
+        """
+        if residuals is None:
+            residuals = self.compiled.residuals(x)
+        maxcv = float(np.max(np.abs(residuals), initial=0.0))
+        # 実行可能な点は違反のない点として目的関数で比べ、そうでない点は違反の大きさで比べます。
+        key = (0, objective_function(x, *self.target)) if maxcv <= self.tol else (1, maxcv)
+        if self.key is None or key < self.key:
+            self.x, self.key, self.maxcv = np.array(x, dtype=float), key, maxcv
 
-    # 最適化を実行
-    result = minimize(
-        fun = objective_function,        # 最小化する目的関数
-        x0 = initial_point,              # 最適化の初期推定値
-        args = additional_args,          # 目的関数に渡す追加の引数
-        constraints = scipy_constraints  # 最適化に適用する制約条件
-    )
-    
-    print(result)
+    def __call__(self, x, *args):
+        self.consider(x)
+        if self.callback is not None:
+            self.callback(x, *args)
+        if time.monotonic() > self.deadline:
+            raise StopIteration
 
-    # The optimized point is in result.x
-    optimized_point = result.x
+    def restore(self, x):
+        """
+        Move x onto the constraints by minimum-norm Gauss-Newton steps.
+        """
+        from scipy.sparse import identity
+        from scipy.sparse.linalg import spsolve
 
+        x = np.array(x, dtype=float)
+        for _ in range(self.restoration_steps):
+            residuals = self.compiled.residuals(x)
+            if np.max(np.abs(residuals), initial=0.0) <= self.tol:
+                break
+            jac = self.compiled.jacobian_sparse(x)
+            # 冗長な制約で J J^T が特異にならないよう、わずかに正則化します。
+            normal = (jac @ jac.T + 1e-12 * identity(len(residuals))).tocsc()
+            x -= jac.T @ np.atleast_1d(spsolve(normal, residuals))
+        return x
 
-    return optimized_point
+    def finish(self, result):
+        """
+        Replace the x of an unconverged result by the best iterate, and add its violation as maxcv.
+        """
+        if result.success:
+            result.maxcv = float(np.max(np.abs(self.compiled.residuals(result.x)), initial=0.0))
+            return result
+        self.consider(result.x)
+        if self.compiled.size:
+            self.consider(self.restore(result.x))
+        result.x, result.maxcv = self.x, self.maxcv
+        result.fun = objective_function(result.x, *self.target)
+        return result
 
+class DeadlineConstraints(CompiledConstraints):
+    """
+    Compiled constraints that raise DeadlineExceeded from any evaluation after the deadline
+    of a BestIterate, and show it every point whose residuals are evaluated.
+    """
+    def __init__(self, compiled, best):
+        self.compiled = compiled
+        self.best = best
+        self.constraints = compiled.constraints
+        self.kernels = compiled.kernels
+        self.row_owners = compiled.row_owners
+        self.size = compiled.size
 
-    #a = Point(data['a']['x'], data['a']['y'])
-    #b = Point(data['b']['x'], data['b']['y'])
-    #c = Point(data['c']['x'], data['c']['y'])
-    #d = Point(data['d']['x'], data['d']['y'])
-    #dx, dy = data['displacement']
-    
-    #ab = Line(a, b)
-    #bc = Line(b, c)
-    #cd = Line(c, d)
-    #da = Line(d, a)
+    def _check(self):
+        if time.monotonic() > self.best.deadline:
+            raise DeadlineExceeded
 
-    # def objective(z):
-    #    return ((c.x+dx)-z[2]) ** 2 + ((c.y+dy)-z[3]) ** 2
+    def residuals(self, points_array):
+        self._check()
+        residuals = self.compiled.residuals(points_array)
+        if np.ndim(points_array) == 1:
+            self.best.consider(points_array, residuals)
+        return residuals
 
-    #def constraint1(z):
-    #    return np.sqrt((a.x - z[0]) ** 2 + (a.y - z[1]) ** 2) - ab.length
+    def jacobian_entries(self, points_array):
+        self._check()
+        return self.compiled.jacobian_entries(points_array)
 
-    #def constraint2(z):
-    #    return np.sqrt((z[2] - z[0]) ** 2 + (z[3] - z[1]) ** 2) - bc.length
+    def hessian_entries(self, points_array, weights):
+        self._check()
+        return self.compiled.hessian_entries(points_array, weights)
 
-    #def constraint3(z):
-    #    return np.sqrt((z[2] - d.x) ** 2 + (z[3] - d.y) ** 2) - cd.length
+###########################################
 
-    #cons = [{'type': 'eq', 'fun': constraint1},
-    #        {'type': 'eq', 'fun': constraint2},
-    #        {'type': 'eq', 'fun': constraint3}]
+# 正規化した座標で解くときのSLSQPの収束判定 (目的関数の変化の許容値)
+NORMALIZED_FTOL = 1e-10
 
-    #x0 = np.array([b.x, b.y, c.x, c.y])
+# 正規化した座標で解いた結果を成功とみなす、元の単位での制約の最大違反
+SUCCESS_TOL = 1e-6
 
-    #sol = minimize(objective, x0, constraints=cons, method='SLSQP')
+def solve_problem(constraints, initial_point, target_x, target_y, target_index=0, method=None, callback=None,
+                  deadline=None, normalize=True, options=None, tol=SUCCESS_TOL):
+    """
+    Move the point target_index as close as possible to the target while keeping the constraints.
+    :param constraints: A list of Constraint objects, or a CompiledConstraints.
+    :param initial_point: Flat array of the starting coordinates of every point.
+    :param method: A backend name (see backends.BACKENDS, e.g. 'SLSQP', 'trust-constr', 'least-squares',
+        'sparse-lm') or any other scipy.optimize.minimize method; None chooses one by the problem's
+        size and constraint mix from the autotuning table.
+    :param callback: Called with the current point after each iteration; may raise StopIteration.
+    :param deadline: Optional time.monotonic() value; the solve stops there and returns the best
+        iterate so far (see BestIterate), with its constraint violation as maxcv.
+    :param normalize: Solve scipy.optimize.minimize in coordinates normalized to unit size with
+        balanced residuals (see scaling.ScaledConstraints); x and fun are returned in original units.
+    :param options: Passed on to the backend (for minimize methods, to scipy.optimize.minimize).
+    :param tol: Largest constraint violation in original units of a successful normalized solve.
+    :return: The scipy OptimizeResult.
+    """
+    # 循環importを避けるためここでimportします。
+    from backends import choose_backend, get_backend
 
-    #result = {
-    #    'b': {'x': sol.x[0], 'y': sol.x[1]},
-    #    'c': {'x': sol.x[2], 'y': sol.x[3]}
-    #}
+    compiled = compile_constraints(constraints)
+    if method is None:
+        method = choose_backend(compiled, len(initial_point))
+    backend = get_backend(method)
+    if deadline is not None and backend.first_iteration_time(len(initial_point)) > deadline - time.monotonic():
+        # 1反復目の途中で締め切りを過ぎる密なバックエンドの代わりに、評価ごとに止められる疎な解法を使います。
+        # (options はバックエンドごとに違うので渡しません。)
+        method, options = DEADLINE_BACKEND, None
+        backend = get_backend(method)
 
-    #return result
+    if normalize and backend.normalize:
+        from scaling import ScaledConstraints
 
+        scaled, normalized_point = ScaledConstraints.normalize(compiled, initial_point, (target_x, target_y))
+        normalized_callback = None
+        if callback is not None:
+            def normalized_callback(z, *args):
+                callback(scaled.to_original(z), *args)
+        if options is None:
+            # 正規化した座標の目的関数は scale ** 2 で割った値なので、既定の収束判定のままだと
+            # ピクセル単位での精度が落ちるバックエンドがあります (SLSQPの ftol など)。
+            options = backend.normalized_options
+        result = solve_problem(scaled, normalized_point, *scaled.to_normalized_point(target_x, target_y),
+                               target_index, method, normalized_callback, deadline, normalize=False,
+                               options=options)
+        result.x = scaled.to_original(result.x)
+        result.fun = objective_function(result.x, target_x, target_y, target_index)
+        if 'jac' in result:
+            result.jac = objective_gradient(result.x, target_x, target_y, target_index)
+        # バックエンドの収束判定は正規化した単位 (残差の二乗は scale ** 2 で割った値) なので、
+        # 元の単位で違反を計り直し、許容値を超えていれば失敗とします。
+        result.maxcv = float(np.max(np.abs(compiled.residuals(result.x)), initial=0.0))
+        if result.success and result.maxcv > tol:
+            result.success, result.status = False, 4
+            result.message = f'Constraint violation {result.maxcv:.1e} exceeds {tol:.1e} in original units'
+        return result
 
-###########################################
+    if deadline is not None:
+        from scipy.optimize import OptimizeResult
+
+        best = BestIterate(compiled, target_x, target_y, target_index, deadline, callback=callback)
+        best.consider(initial_point)
+        if time.monotonic() > deadline:
+            # 締め切りを過ぎていれば解かずに初期値を返します (後回しにした成分など)。
+            return best.finish(OptimizeResult(x=best.x, success=False, status=99,
+                                              message='Deadline passed before the solve started',
+                                              nit=0, nfev=0, njev=0))
+        try:
+            result = solve_problem(DeadlineConstraints(compiled, best), initial_point, target_x, target_y,
+                                   target_index, method, best, normalize=False, options=options)
+        except DeadlineExceeded:
+            result = OptimizeResult(x=best.x, success=False, status=99,
+                                    message='Deadline passed during an evaluation', nit=0, nfev=0, njev=0)
+        return best.finish(result)
 
-# Example usage:
-constraints = [
-    FixedDistanceConstraint('p0', 'p1', 3),
-    FixedPointConstraint('p1', 2, 2)
-]
+    return backend.solve(compiled, initial_point, target_x, target_y, target_index, callback, options)
 
-initial_point = np.array([0.5, 0.5])  # Initial point (x=0.5, y=0.5)
-target_x = 5
-target_y = 5
+def run_optimization(constraints, initial_point, target_x, target_y, target_index=0, method=None, cache=None):
+    """
+    Every call is recorded in metrics.registry as a 'library' solve.
+    Each component is solved in normalized coordinates (see scaling.ScaledConstraints),
+    so the iterations do not depend on the canvas size or units.
+    :param cache: Optional cache.SolutionCache; a hit skips the solve, otherwise the nearest
+        cached target of the same problem is used as the starting point.
+    """
+    # 循環importを避けるためここでimportします。
+    from decompose import Decomposition
 
-# Run the optimization
-optimized_point = run_optimization(constraints, initial_point, target_x, target_y)
+    solved = []
 
-# Output the result
+    def solve(x0):
+        # 連結成分に分解し、ドラッグした点を含む成分と制約を満たしていない成分だけを解きます。
+        decomposition = Decomposition(constraints, len(x0) // 2)
+        optimized_point, results = decomposition.solve(x0, target_x, target_y, target_index, method=method)
+        solved.extend(results.values())
+        return optimized_point, results[decomposition.component_of[target_index]].success
 
-print("\n")
-print(f"Optimized point: x={optimized_point[0]}, y={optimized_point[1]}")
+    cache_stats = None if cache is None else cache.stats()
+    with Stopwatch() as stopwatch:
+        if cache is None:
+            # The optimized point is in result.x
+            optimized_point, success = solve(initial_point)
+        else:
+            from cache import cached_solve
+            optimized_point, success = cached_solve(cache, solve, constraints, initial_point,
+                                                    target_x, target_y, target_index)
+
+    # 結果は標準出力ではなく計測値として記録します (metrics.registry)。
+    registry.observe(solve_record('library', stopwatch, solved, success, len(initial_point) // 2, len(constraints),
+                                  cached=not solved,
+                                  cache_events=None if cache is None else cache.events_since(cache_stats)))
+
+    return optimized_point
+
+def run_optimization_file(path, target_x, target_y, target_index=0, method=None):
+    """
+    Drag a point of a sketch file (see sketch_file) opened with memory mapping: only the
+    component of the dragged point is read, and its solved coordinates are written back into the file.
+    Recorded in metrics.registry as a 'file' solve.
+    :return: The OptimizeResult of the dragged component.
+    """
+    from sketch_file import SketchFile
+
+    with SketchFile(path) as sketch_file, Stopwatch() as stopwatch:
+        results = sketch_file.solve(target_index, target_x, target_y, method=method)
+        result = results[int(sketch_file.component_of[point_index(target_index)])]
+        points, constraints = len(sketch_file), sketch_file.constraint_count
+    registry.observe(solve_record('file', stopwatch, list(results.values()), result.success, points, constraints))
+    return result
 
 
 ###########################################
 
-input("Waiting for key press...")
+if __name__ == '__main__':
+    # Example usage:
+    constraints = [
+        FixedDistanceConstraint('p0', 'p1', 3),
+        FixedPointConstraint('p1', 2, 2)
+    ]
+
+    initial_point = np.array([0.5, 0.5, 2, 2])  # p0 (x=0.5, y=0.5), p1 (x=2, y=2)
+    target_x = 5
+    target_y = 5
+
+    # Run the optimization
+    optimized_point = run_optimization(constraints, initial_point, target_x, target_y)
+
+    # Output the result
+    print(f"Optimized point: x={optimized_point[0]}, y={optimized_point[1]}")
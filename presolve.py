@@ -0,0 +1,127 @@
+import numpy as np
+
+from closed_form import intersect_circles
+from optimize import CompiledConstraints, FixedDistanceConstraint, FixedPointConstraint, point_index
+
+###########################################
+# 前処理: 固定点を定数として最適化変数から取り除く
+#
+# FixedPointConstraint の残差は二乗距離なので、解では勾配が0になり、
+# 等式制約としては退化しています。固定点は座標を代入して変数から外し、
+# さらに2つの定数点と距離で結ばれた点も位置が決まるので定数にします。
+# 残った点だけを変数とし、定数点同士の制約は取り除きます。
+###########################################
+
+class ReducedConstraints(CompiledConstraints):
+    """
+    Compiled constraints over the free points only.
+    Takes and differentiates with respect to the reduced vector of free coordinates;
+    the constant coordinates are filled in from base.
+    """
+    def __init__(self, constraints, base, free_points):
+        super().__init__(constraints)
+        self.base = base
+        self.free_columns = np.stack([2 * free_points, 2 * free_points + 1], axis=1).ravel()
+        # 全体の列番号 → 縮小した列番号 (定数の列は -1)
+        self.column_map = np.full(len(base), -1, dtype=np.intp)
+        self.column_map[self.free_columns] = np.arange(len(self.free_columns))
+
+    def expand(self, reduced_array):
+        reduced_array = np.asarray(reduced_array, dtype=float)
+        points_array = np.broadcast_to(self.base, reduced_array.shape[:-1] + self.base.shape).copy()
+        points_array[..., self.free_columns] = reduced_array
+        return points_array
+
+    def reduce(self, points_array):
+        return np.asarray(points_array, dtype=float)[..., self.free_columns]
+
+    def residuals(self, reduced_array):
+        return super().residuals(self.expand(reduced_array))
+
+    def jacobian_entries(self, reduced_array):
+        rows, cols, values = super().jacobian_entries(self.expand(reduced_array))
+        cols = self.column_map[cols]
+        keep = cols >= 0
+        return rows[keep], cols[keep], values[..., keep]
+
+    def hessian_entries(self, reduced_array, weights):
+        rows, cols, values = super().hessian_entries(self.expand(reduced_array), weights)
+        rows, cols = self.column_map[rows], self.column_map[cols]
+        keep = (rows >= 0) & (cols >= 0)
+        return rows[keep], cols[keep], values[..., keep]
+
+class Presolve:
+    """
+    Substitute fixed points, propagate the points they determine, and keep what is left.
+    :param constraints: Constraints of one problem, with integer or 'p<i>' point names.
+    :param points_array: Flat starting coordinates; chooses the branch of propagated points.
+    :param propagate: Also make constant the points that two constant points determine. Problems
+        that share the constraints but start elsewhere may need the other branch, so batches pass False.
+    conflicts lists the indices (in constraints) of the constraints dropped although violated:
+    a second, different fixed position of a point, or a violated constraint between constant points.
+    """
+    def __init__(self, constraints, points_array, propagate=True):
+        base = np.array(points_array, dtype=float)
+        xy = base.reshape(-1, 2)
+        constant = np.zeros(len(xy), dtype=bool)
+        # 定数にしたことで取り除いたが、満たされていない制約
+        self.conflicts = []
+
+        neighbours = [[] for _ in range(len(xy))]
+        for k, constraint in enumerate(constraints):
+            if isinstance(constraint, FixedPointConstraint):
+                p = point_index(constraint.point)
+                if constant[p] and (xy[p] != (constraint.x, constraint.y)).any():
+                    self.conflicts.append(k)
+                    continue
+                xy[p] = constraint.x, constraint.y
+                constant[p] = True
+            elif isinstance(constraint, FixedDistanceConstraint):
+                p, q = point_index(constraint.point1), point_index(constraint.point2)
+                neighbours[p].append((q, constraint.distance))
+                neighbours[q].append((p, constraint.distance))
+
+        # 定数点2つと距離で結ばれた点は、今の位置に近い方の交点に決まります。
+        candidates = [q for p in np.flatnonzero(constant) for q, _ in neighbours[p]] if propagate else []
+        while candidates:
+            p = candidates.pop()
+            if constant[p]:
+                continue
+            anchors = [(q, d) for q, d in neighbours[p] if constant[q]]
+            if len(anchors) < 2:
+                continue
+            (q1, d1), (q2, d2) = anchors[:2]
+            position = intersect_circles(xy[q1], d1, xy[q2], d2, xy[p])
+            if position is None:
+                continue
+            xy[p] = position
+            constant[p] = True
+            candidates.extend(q for q, _ in neighbours[p] if not constant[q])
+
+        remaining = []
+        for k, constraint in enumerate(constraints):
+            if isinstance(constraint, FixedPointConstraint):
+                continue
+            if all(constant[point_index(p)] for p in constraint.points()):
+                if np.max(np.abs(constraint.kernel([constraint]).residuals(xy))) > 1e-8:
+                    self.conflicts.append(k)
+                continue
+            remaining.append(constraint)
+
+        self.constant = constant
+        self.free_points = np.flatnonzero(~constant)
+        self.system = ReducedConstraints(remaining, base, self.free_points)
+
+    def target_index(self, point):
+        """
+        :return: Index of the point among the free points, or None if it is constant.
+        """
+        if self.constant[point]:
+            return None
+        return int(np.searchsorted(self.free_points, point))
+
+    def reduce(self, points_array):
+        return self.system.reduce(points_array)
+
+    def expand(self, reduced_array):
+        return self.system.expand(reduced_array)
@@ -0,0 +1,158 @@
+import numpy as np
+
+from optimize import Constraint, FixedDistanceConstraint, FixedPointConstraint
+
+###########################################
+# /optimize とやり取りするJSONと、ソルバーの入力との変換
+#
+# {
+#     "points": {"a": {"x": 300, "y": 300}, "b": {"x": 300, "y": 500}, ...},
+#     "constraints": [
+#         {"type": "FixedPointConstraint", "point": "a", "x": 300, "y": 300},
+#         {"type": "FixedDistanceConstraint", "point1": "a", "point2": "b", "distance": 200},
+#         {"type": "ParallelConstraint", "point1": "a", "point2": "b", "point3": "c", "point4": "d"},
+#         ...
+#     ],
+#     "target": {"point": "c", "x": 520, "y": 410}
+# }
+###########################################
+
+# 不正なリクエストで parse_* が投げる例外 (欠けたキー、コンストラクターの引数の過不足、不正な値や名前)。
+# サーバーはこれらを 400 で返します。
+PARSE_ERRORS = (KeyError, TypeError, ValueError)
+
+class Problem:
+    def __init__(self, names, points_array, constraints, target_index=0, target_x=0.0, target_y=0.0):
+        self.names = names
+        self.points_array = points_array
+        self.constraints = constraints
+        self.target_index = target_index
+        self.target_x = target_x
+        self.target_y = target_y
+
+def finite(values, what):
+    """
+    Reject NaN and infinite numbers, which the solvers would turn into meaningless output.
+    :return: values.
+    """
+    if not np.all(np.isfinite(values)):
+        raise ValueError(f'{what} must be finite')
+    return values
+
+def parse_points(data):
+    """
+    :param data: {name: {'x': x, 'y': y}, ...}
+    :return: (list of names, flat coordinate array)
+    """
+    names = list(data)
+    points_array = np.array([(data[name]['x'], data[name]['y']) for name in names], dtype=float).ravel()
+    return names, finite(points_array, 'point coordinates')
+
+def parse_constraints(items, names):
+    """
+    Build Constraint objects, replacing point names with their index
+    and converting the other parameters to finite floats.
+    """
+    index = {name: i for i, name in enumerate(names)}
+    constraints = []
+    for item in items:
+        constraint = Constraint.from_dict(item)
+        for field in constraint.point_fields:
+            name = getattr(constraint, field)
+            if name not in index:
+                raise ValueError(f'{type(constraint).__name__} refers to an unknown point: {name}')
+            setattr(constraint, field, index[name])
+        # 点以外の属性 (距離、座標、角度、半径) は数値です。
+        for field, value in vars(constraint).items():
+            if field not in constraint.point_fields:
+                setattr(constraint, field, finite(float(value), f'{type(constraint).__name__}.{field}'))
+        constraints.append(constraint)
+    return constraints
+
+def point_of(name, names):
+    """
+    :return: The index of the point called name.
+    """
+    if name not in names:
+        raise ValueError(f'unknown point: {name}')
+    return names.index(name)
+
+def parse_target(data, names):
+    """
+    :param data: {'point': name, 'x': x, 'y': y}
+    :return: (target_index, target_x, target_y)
+    """
+    x, y = finite((float(data['x']), float(data['y'])), 'the target')
+    return point_of(data['point'], names), x, y
+
+def parse_legacy(data):
+    """
+    The four-bar payload sent by the original static/script.js:
+    a and d are fixed, ab, bc and cd keep their length and c follows the displacement.
+    """
+    names = ['a', 'b', 'c', 'd']
+    _, points_array = parse_points({name: data[name] for name in names})
+    xy = points_array.reshape(-1, 2)
+    constraints = [
+        FixedPointConstraint(0, float(xy[0, 0]), float(xy[0, 1])),
+        FixedPointConstraint(3, float(xy[3, 0]), float(xy[3, 1])),
+    ]
+    for i, j in [(0, 1), (1, 2), (2, 3)]:
+        constraints.append(FixedDistanceConstraint(i, j, float(np.linalg.norm(xy[i] - xy[j]))))
+
+    dx, dy = finite(tuple(float(d) for d in data.get('displacement', (0, 0))), 'the displacement')
+    return Problem(names, points_array, constraints, 2, float(xy[2, 0] + dx), float(xy[2, 1] + dy))
+
+def parse_problem(data):
+    if 'points' not in data:
+        return parse_legacy(data)
+
+    names, points_array = parse_points(data['points'])
+    constraints = parse_constraints(data.get('constraints', []), names)
+    problem = Problem(names, points_array, constraints)
+    if 'target' in data:
+        problem.target_index, problem.target_x, problem.target_y = parse_target(data['target'], names)
+    return problem
+
+def parse_batch(data):
+    """
+    A batch request: one problem (full or legacy format) solved for many targets.
+    {..., "targets": [{"point": name, "x": x, "y": y}, ...],
+          "configurations": [{name: {"x": x, "y": y}, ...}, ...]}
+    configurations is optional and holds one starting configuration per target
+    (the problem's points are used otherwise).
+    :return: (Problem, starting coordinates (B, 2n), targets (B, 2), dragged point indices (B,))
+    """
+    problem = parse_problem(data)
+    targets = [parse_target(target, problem.names) for target in data['targets']]
+    if not targets:
+        raise ValueError('targets is empty')
+    target_indices = np.array([index for index, _, _ in targets], dtype=np.intp)
+    target_xy = np.array([(x, y) for _, x, y in targets], dtype=float)
+    if 'configurations' in data:
+        if len(data['configurations']) != len(targets):
+            raise ValueError('configurations and targets differ in length')
+        initial_points = np.array([[(configuration[name]['x'], configuration[name]['y']) for name in problem.names]
+                                   for configuration in data['configurations']], dtype=float).reshape(len(targets), -1)
+        finite(initial_points, 'configuration coordinates')
+    else:
+        initial_points = np.broadcast_to(problem.points_array, (len(targets), len(problem.points_array)))
+    return problem, initial_points, target_xy, target_indices
+
+def parse_trajectory(data):
+    """
+    A trajectory request: one problem (full or legacy format) whose point follows a path, one frame per position.
+    {..., "path": {"point": name, "positions": [{"x": x, "y": y}, ...]}}
+    :return: (Problem, target positions (number of frames, 2), dragged point index)
+    """
+    problem = parse_problem(data)
+    path = data['path']
+    positions = np.array([(float(p['x']), float(p['y'])) for p in path['positions']], dtype=float).reshape(-1, 2)
+    finite(positions, 'path positions')
+    if not len(positions):
+        raise ValueError('path is empty')
+    return problem, positions, point_of(path['point'], problem.names)
+
+def points_to_json(names, points_array):
+    xy = np.asarray(points_array).reshape(-1, 2)
+    return {name: {'x': float(x), 'y': float(y)} for name, (x, y) in zip(names, xy)}
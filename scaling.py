@@ -0,0 +1,76 @@
+import numpy as np
+
+from optimize import CompiledConstraints
+
+###########################################
+# 座標と残差の正規化
+#
+# 座標はキャンバスのピクセル単位 (数百) で届き、残差の単位も制約の種類ごとに違います
+# (FixedDistanceConstraint は距離、FixedPointConstraint や ParallelConstraint は距離の二乗)。
+# このままだとSLSQPの準ニュートン近似や収束判定がスケッチの大きさと単位に左右されるので、
+#   z = (x - center) / scale
+# の座標で解きます。center は点の重心、scale は点 (と目標位置) の重心からの二乗平均平方根の距離です。
+# 残差はカーネルの residual_degree (長さの何乗か) に合わせて scale ** -degree を掛け、
+# どの種類も正規化した座標で1程度の大きさにそろえます。
+# 目的関数 |p - target|^2 は目標位置も同じ変換をすれば形が変わりません (scale ** 2 で割った値になります)。
+# これでキャンバスの大きさや単位を変えても、解く問題は同じになります。
+###########################################
+
+class ScaledConstraints(CompiledConstraints):
+    """
+    Compiled constraints seen in normalized coordinates z = (x - center) / scale,
+    with every residual divided by scale to the power of its kernel's residual_degree.
+    :param compiled: The CompiledConstraints (or ReducedConstraints) in original coordinates.
+    :param center: Flat array added back to every coordinate, [cx, cy, cx, cy, ...].
+    :param scale: The length that becomes 1.
+    """
+    def __init__(self, compiled, center, scale):
+        # カーネルは元の制約と共有します (評価は元の制約に任せ、値だけを変換します)。
+        self.compiled = compiled
+        self.constraints = compiled.constraints
+        self.kernels = compiled.kernels
+        self.row_owners = compiled.row_owners
+        self.size = compiled.size
+        self.center = center
+        self.scale = scale
+        self.row_scale = np.concatenate(
+            [np.full(len(kernel) * kernel.residual_count, scale ** -float(kernel.residual_degree)) for kernel in self.kernels]
+            + [np.zeros(0)])
+
+    @classmethod
+    def normalize(cls, compiled, points_array, target=None):
+        """
+        Choose center and scale from the coordinates (and the target position, if given).
+        :return: (ScaledConstraints, normalized points_array)
+        """
+        xy = np.asarray(points_array, dtype=float).reshape(-1, 2)
+        center = xy.mean(axis=0) if len(xy) else np.zeros(2)
+        spread = xy - center if target is None else np.concatenate([xy, [target]]) - center
+        scale = float(np.sqrt(np.mean(np.einsum('ij,ij->i', spread, spread)))) if len(spread) else 0.0
+        # 1点だけで目標位置もそこにある場合など、長さが決まらなければ変換しません。
+        if not np.isfinite(scale) or scale <= 0:
+            scale = 1.0
+        scaled = cls(compiled, np.tile(center, len(xy)), scale)
+        return scaled, scaled.to_normalized(points_array)
+
+    def to_normalized(self, points_array):
+        return (np.asarray(points_array, dtype=float) - self.center) / self.scale
+
+    def to_original(self, normalized_array):
+        return self.center + self.scale * np.asarray(normalized_array, dtype=float)
+
+    def to_normalized_point(self, x, y):
+        return (x - self.center[0]) / self.scale, (y - self.center[1]) / self.scale
+
+    def residuals(self, normalized_array):
+        return self.row_scale * self.compiled.residuals(self.to_original(normalized_array))
+
+    def jacobian_entries(self, normalized_array):
+        # dc'/dz = scale ** -degree * dc/dx * scale
+        rows, cols, values = self.compiled.jacobian_entries(self.to_original(normalized_array))
+        return rows, cols, values * (self.row_scale[rows] * self.scale)
+
+    def hessian_entries(self, normalized_array, weights):
+        rows, cols, values = self.compiled.hessian_entries(self.to_original(normalized_array),
+                                                           np.asarray(weights, dtype=float) * self.row_scale)
+        return rows, cols, values * self.scale ** 2
@@ -0,0 +1,156 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from decompose import Decomposition
+
+###########################################
+
+class SolveSession:
+    """
+    State of one drag interaction.
+    Keeps the compiled constraints and the last solution so every update
+    warm-starts from the previous frame instead of the original geometry.
+    After the first frame only the component holding the dragged point is re-solved.
+    A frame stopped at its time budget leaves its best iterate as the provisional solution,
+    which refine keeps improving until it converges or the next frame arrives.
+    """
+    def __init__(self, problem):
+        self.names = problem.names
+        self.decomposition = Decomposition(problem.constraints, len(problem.points_array) // 2)
+        self.solution = problem.points_array.copy()
+        # クライアントが持っている座標 (作成時はクライアントが送った座標)。差分モードはここからの差分を返し、
+        # 全体の座標を返したとき (frame) と差分を返したとき (changes) に更新します。
+        self.sent = self.solution.copy()
+        # 時間切れで打ち切ったフレームの途中の解と、その目標位置 (target_index, target_x, target_y)
+        self.provisional = None
+        self.target = None
+        self.result = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        """The provisional solution if the last frame ran out of time, else the last solution."""
+        return self.solution if self.provisional is None else self.provisional
+
+    def frame(self):
+        """
+        The current solution as returned in a full frame; the delta mode compares against it from now on.
+        """
+        with self.lock:
+            self.sent = self.current.copy()
+            return self.sent.copy()
+
+    def changes(self, tolerance=0.0):
+        """
+        Points of the current solution that moved more than tolerance (in x or y) from the
+        coordinates last returned by changes or frame; they count as returned from now on.
+        :return: (point indices, their coordinates of shape (k, 2))
+        """
+        with self.lock:
+            current = self.current.reshape(-1, 2)
+            sent = self.sent.reshape(-1, 2)
+            moved = np.flatnonzero(np.any(np.abs(current - sent) > tolerance, axis=1))
+            sent[moved] = current[moved]
+            return moved, current[moved].copy()
+
+    def residual(self, points_array):
+        """Largest constraint violation of points_array over every component."""
+        return max((float(np.max(np.abs(c.compiled.residuals(points_array[c.columns])), initial=0.0))
+                    for c in self.decomposition.components), default=0.0)
+
+    def solve(self, target_index, target_x, target_y, method=None, callback=None, budget=None):
+        """
+        Solve for a new target position, starting from the last solution.
+        :param method: Passed on to solve_problem.
+        :param callback: Passed on to solve_problem, e.g. to stop at a deadline.
+        :param budget: Optional time limit in seconds; when it runs out the best iterate so far
+            becomes the provisional solution (see current and refine).
+        :return: The scipy OptimizeResult of this update.
+        """
+        with self.lock:
+            self.last_used = time.monotonic()
+            self.target = (target_index, target_x, target_y)
+            return self._solve(self.current, None if budget is None else time.monotonic() + budget,
+                               method, callback)
+
+    def refine(self, budget=None, method=None, callback=None):
+        """
+        Continue solving the provisional solution of the last frame towards its target.
+        :param budget: Optional time limit in seconds of this round.
+        :return: The scipy OptimizeResult, or None if there is nothing to refine.
+        """
+        with self.lock:
+            self.last_used = time.monotonic()
+            if self.provisional is None:
+                return None
+            return self._solve(self.provisional, None if budget is None else time.monotonic() + budget,
+                               method, callback)
+
+    def _solve(self, initial_point, deadline, method, callback):
+        target_index, target_x, target_y = self.target
+        solution, results = self.decomposition.solve(initial_point, target_x, target_y, target_index,
+                                                     only_dragged=self.result is not None,
+                                                     method=method, callback=callback, deadline=deadline)
+        result = results[self.decomposition.component_of[target_index]]
+        self.result = result
+        if result.success:
+            self.solution = solution
+            self.provisional = None
+        elif deadline is not None and result.status == 99:
+            # 時間切れなら一番良かった途中の解を返し、次のフレームもそこから解きます。
+            self.provisional = solution
+        else:
+            # それ以外で収束しなかった場合は直前に収束したフレームの解に戻します。
+            self.provisional = None
+        return result
+
+###########################################
+
+class SessionStore:
+    """
+    Sessions keyed by id, evicted after idle_timeout seconds without use
+    or when more than max_sessions are open (least recently used first).
+    """
+    def __init__(self, idle_timeout=300.0, max_sessions=1000):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, problem, session_id=None):
+        session = SolveSession(problem)
+        session_id = session_id or uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = session
+            self._evict()
+        return session_id
+
+    def get(self, session_id):
+        with self.lock:
+            self._evict()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session.last_used = time.monotonic()
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def _evict(self):
+        # 先頭ほど長く使われていないので、先頭から順に削除します。
+        deadline = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_used >= deadline and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[session_id]
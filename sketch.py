@@ -0,0 +1,201 @@
+import time
+
+import numpy as np
+
+from constraint_system import ConstraintSystem
+from optimize import Line, Point, compile_constraints, point_index
+
+###########################################
+# 配列で持つスケッチ
+#
+# 点の座標は1本の float64 配列 [x0, y0, x1, y1, ...]、線分は int32 の (始点, 終点) 配列、
+# 制約は種類ごとの型付き配列 (CompiledConstraints のカーネル) で持ちます。
+# Point / Line はこの配列の上のビューなので、1点あたりのメモリは座標の16バイトだけです。
+# solve は座標配列をそのまま読み書きするので、解くたびの変換やコピーがありません。
+# 制約は constraint_system.ConstraintSystem に持ち、追加・削除・変更は関係する成分だけを作り直します。
+###########################################
+
+class Sketch:
+    """
+    Points, segments and constraints of one sketch in flat arrays.
+    Arrays grow by doubling; coordinates and segments are views of the used part.
+    """
+    def __init__(self, capacity=16):
+        self._coordinates = np.zeros(2 * capacity)
+        self._segments = np.zeros((capacity, 2), dtype=np.int32)
+        self.point_count = 0
+        self.segment_count = 0
+        self.names = []
+        self.system = ConstraintSystem()
+        # 制約か点の数が変わるまで使い回すコンパイル済みの制約と自由度の解析
+        self._compiled = None
+        self._analysis = None
+
+    @classmethod
+    def from_arrays(cls, points_array, segments=(), constraints=(), names=None):
+        """
+        :param points_array: Flat coordinates [x0, y0, x1, y1, ...].
+        :param segments: Pairs of point indices.
+        :param names: Point names (default: 'p0', 'p1', ...).
+        """
+        points_array = np.asarray(points_array, dtype=float)
+        segments = np.asarray(segments, dtype=np.int32).reshape(-1, 2)
+        sketch = cls(max(len(points_array) // 2, len(segments), 1))
+        sketch.point_count = len(points_array) // 2
+        sketch._coordinates[:len(points_array)] = points_array
+        sketch.segment_count = len(segments)
+        sketch._segments[:len(segments)] = segments
+        sketch.names = list(names) if names is not None else [f'p{i}' for i in range(sketch.point_count)]
+        sketch.system = ConstraintSystem(constraints, sketch.point_count)
+        return sketch
+
+    @classmethod
+    def from_problem(cls, problem):
+        """
+        A sketch holding a copy of a protocol.Problem's points, with its constraints.
+        """
+        return cls.from_arrays(problem.points_array, constraints=problem.constraints, names=problem.names)
+
+    def __len__(self):
+        return self.point_count
+
+    @property
+    def coordinates(self):
+        """The flat float64 coordinate array (a view; writes go to the sketch)."""
+        return self._coordinates[:2 * self.point_count]
+
+    @property
+    def xy(self):
+        return self.coordinates.reshape(-1, 2)
+
+    @property
+    def segments(self):
+        """The (segment_count, 2) int32 array of segment end point indices."""
+        return self._segments[:self.segment_count]
+
+    @property
+    def constraints(self):
+        """The constraints, in the order of their handles."""
+        return list(self.system.constraints.values())
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = compile_constraints(self.constraints)
+        return self._compiled
+
+    @property
+    def decomposition(self):
+        return self.system.decomposition
+
+    @property
+    def analysis(self):
+        """
+        dof.DofAnalysis of the constraints, at the coordinates when it is first asked for.
+        """
+        from dof import DofAnalysis
+
+        if self._analysis is None:
+            self._analysis = DofAnalysis(self.constraints, self.coordinates)
+        return self._analysis
+
+    def _changed(self):
+        self._compiled = None
+        self._analysis = None
+
+    def add_point(self, x, y, name=None):
+        """
+        :return: A Point view of the new point.
+        """
+        if 2 * self.point_count == len(self._coordinates):
+            self._coordinates = np.concatenate([self._coordinates, np.zeros(len(self._coordinates))])
+        index = self.point_count
+        self._coordinates[2 * index:2 * index + 2] = x, y
+        self.point_count += 1
+        self.names.append(f'p{index}' if name is None else name)
+        self.system.add_point()
+        self._changed()
+        return Point.view(self, index)
+
+    def add_segment(self, p1, p2):
+        """
+        :param p1: Index or 'p<i>' name of the first end point.
+        :return: A Line view of the new segment.
+        """
+        if self.segment_count == len(self._segments):
+            self._segments = np.concatenate([self._segments, np.zeros_like(self._segments)])
+        self._segments[self.segment_count] = point_index(p1), point_index(p2)
+        self.segment_count += 1
+        return self.line(self.segment_count - 1)
+
+    def add_constraint(self, constraint):
+        """
+        :return: The handle of the constraint, for remove_constraint and modify_constraint.
+        """
+        handle = self.system.add(constraint)
+        self._changed()
+        return handle
+
+    def remove_constraint(self, handle):
+        """
+        :return: The removed Constraint.
+        """
+        constraint = self.system.remove(handle)
+        self._changed()
+        return constraint
+
+    def modify_constraint(self, handle, **values):
+        """
+        Change attributes of a constraint, e.g. modify_constraint(handle, distance=120).
+        """
+        self.system.modify(handle, **values)
+        self._changed()
+
+    def point(self, index):
+        if not 0 <= index < self.point_count:
+            raise IndexError(index)
+        return Point.view(self, index)
+
+    def line(self, index):
+        if not 0 <= index < self.segment_count:
+            raise IndexError(index)
+        i, j = self._segments[index]
+        return Line(Point.view(self, int(i)), Point.view(self, int(j)))
+
+    def segment_lengths(self):
+        """Lengths of every segment at once."""
+        diff = self.xy[self.segments[:, 0]] - self.xy[self.segments[:, 1]]
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    def residuals(self):
+        return self.compiled.residuals(self.coordinates)
+
+    def solve(self, target_index, target_x, target_y, method=None, callback=None, only_dragged=False, budget=None):
+        """
+        Drag a point towards the target, writing the solution into the coordinate array.
+        :param method: Passed on to solve_problem.
+        :param budget: Optional time limit in seconds; unconverged components get the best iterate
+            found in time, with status 99 and their constraint violation as maxcv.
+        :return: {component index: OptimizeResult}, as from Decomposition.solve.
+        """
+        deadline = None if budget is None else time.monotonic() + budget
+        _, results = self.decomposition.solve(self.coordinates, target_x, target_y, point_index(target_index),
+                                              only_dragged=only_dragged, method=method, callback=callback,
+                                              in_place=True, deadline=deadline)
+        return results
+
+    def save(self, path):
+        """
+        Write the sketch to a file that sketch_file.SketchFile opens with memory mapping.
+        """
+        from sketch_file import write_sketch
+
+        write_sketch(path, self.coordinates, self.segments, self.constraints)
+
+    def resolve(self, method=None, callback=None):
+        """
+        Re-solve only the components whose constraints were edited and are now violated,
+        writing the solution into the coordinate array.
+        :return: {component index: OptimizeResult} of the solved components.
+        """
+        return self.system.resolve(self.coordinates, method=method, callback=callback)
@@ -0,0 +1,245 @@
+import os
+import struct
+import time
+
+import numpy as np
+
+from decompose import Component, Decomposition
+from optimize import point_index
+from wire import constraint_class, pack_constraints, type_code, unpack_constraints
+
+###########################################
+# メモリーマップで開くスケッチのファイル
+#
+# 数百万点の図面を開くたびに Constraint のオブジェクトや分解を作り直すと、開くだけで時間とメモリを使うので、
+# 配列をそのままファイルに並べておき、np.memmap で開きます。読み込むのはファイルのヘッダーと区画の表だけで、
+# 配列はOSのページ単位で、触ったところだけがメモリーに載ります。
+# 連結成分への分解は保存するときに済ませ、点と制約を成分の順に並べて成分ごとの開始位置を持っておくので、
+# ドラッグした点の成分だけを (その成分の制約の行だけを読んで) 作り、解いた座標はファイルの座標配列に直接書き戻します。
+#
+# 数値はすべてリトルエンディアンで、配列は8バイト境界から始まります。制約の種類の番号は wire.CONSTRAINT_TYPES と同じです。
+#   ヘッダー 80バイト: magic 'SKF1', 版 uint32, 点の数 n, 線分の数 s, 成分の数 c, 区画の数 uint64,
+#                      座標, 線分, 点の成分, 成分順の点, 成分ごとの点の開始位置 の位置 uint64
+#   区画の表 (区画ごとに40バイト): 種類 uint16, 個数 k, パラメーター, 点, 成分ごとの開始位置 の位置 uint64
+#   座標 float64[2n], 線分 int32[s, 2], 点の成分 int32[n], 成分順の点 int32[n], 開始位置 int64[c + 1]
+#   区画ごとに: パラメーター float64[k, 数値の属性の数], 点 int32[k, 点の属性の数], 開始位置 int64[c + 1]
+# 制約は最初の点の成分の順に並べます (同じ成分の中では保存したときの順番です)。
+# 点の名前は保存しません (番号で 'p0', 'p1', ... と呼びます)。
+# 形式を変えるときは VERSION を上げてください。古い版は開けないようにエラーにします。
+###########################################
+
+MAGIC = b'SKF1'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sIQQQQQQQQQ')
+_SECTION = struct.Struct('<H6xQQQQ')
+
+def _aligned(offset):
+    return offset + -offset % 8
+
+def write_sketch(path, points_array, segments=(), constraints=()):
+    """
+    Save a sketch in the memory-mapped format, replacing the file at path.
+    :param points_array: Flat coordinates [x0, y0, x1, y1, ...].
+    :param segments: Pairs of point indices.
+    :param constraints: Constraint objects with integer or 'p<i>' point names.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    points_array = np.asarray(points_array, dtype='<f8')
+    segments = np.asarray(segments, dtype='<i4').reshape(-1, 2)
+    point_count = len(points_array) // 2
+    sections = pack_constraints(constraints)
+    for cls, points, _ in sections:
+        if len(points) and (points.min() < 0 or points.max() >= point_count):
+            raise IndexError(f'{cls.__name__} refers to a point that does not exist')
+
+    # 制約の最初の点と他の点を辺で結び、連結成分を求めます。
+    edges = [(points[:, 0], points[:, j]) for _, points, _ in sections for j in range(1, points.shape[1])]
+    rows = np.concatenate([first for first, _ in edges] + [np.zeros(0, dtype='<i4')])
+    cols = np.concatenate([other for _, other in edges] + [np.zeros(0, dtype='<i4')])
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(point_count, point_count)).tocsr()
+    component_count, labels = connected_components(graph, directed=False)
+    component_of = labels.astype('<i4')
+    component_points = np.argsort(component_of, kind='stable').astype('<i4')
+    point_starts = np.searchsorted(component_of[component_points], np.arange(component_count + 1)).astype('<i8')
+
+    ordered = []
+    for cls, points, parameters in sections:
+        first = component_of[points[:, 0]]
+        order = np.argsort(first, kind='stable')
+        starts = np.searchsorted(first[order], np.arange(component_count + 1)).astype('<i8')
+        ordered.append((cls, points[order], parameters[order], starts))
+
+    # 配列を並べる位置を決めてから、順に書き出します。
+    blocks = []
+    offset = _HEADER.size + _SECTION.size * len(ordered)
+
+    def place(array):
+        nonlocal offset
+        offset = _aligned(offset)
+        blocks.append((offset, array))
+        offset += array.nbytes
+        return blocks[-1][0]
+
+    array_offsets = [place(array) for array in (points_array, segments, component_of, component_points, point_starts)]
+    table = []
+    for cls, points, parameters, starts in ordered:
+        table.append(_SECTION.pack(type_code(cls), len(points), place(parameters), place(points), place(starts)))
+
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, point_count, len(segments), component_count, len(ordered),
+                             *array_offsets))
+        f.write(b''.join(table))
+        for position, array in blocks:
+            f.write(bytes(position - f.tell()))
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(temporary, path)
+
+###########################################
+
+class SketchFile:
+    """
+    A sketch file opened with memory mapping. Arrays are views of the file; components are
+    built from their rows of the file when first solved, and solving writes the coordinates back.
+    :param mode: 'r+' to solve in place, 'r' to read only, 'c' to solve without changing the file.
+    """
+    def __init__(self, path, mode='r+'):
+        self.path = path
+        self._map = np.memmap(path, dtype=np.uint8, mode=mode)
+        if len(self._map) < _HEADER.size or bytes(self._map[:4]) != MAGIC:
+            raise ValueError('not a sketch file')
+        (_, version, self.point_count, self.segment_count, self.component_count, section_count,
+         coordinates, segments, component_of, component_points, point_starts) = _HEADER.unpack_from(self._map)
+        if version != VERSION:
+            raise ValueError(f'unsupported sketch file version: {version}')
+
+        n, c = self.point_count, self.component_count
+        self.coordinates = self._array('<f8', (2 * n,), coordinates)
+        self.segments = self._array('<i4', (self.segment_count, 2), segments)
+        self.component_of = self._array('<i4', (n,), component_of)
+        self.component_points = self._array('<i4', (n,), component_points)
+        self.point_starts = self._array('<i8', (c + 1,), point_starts)
+
+        # [(制約のクラス, 点, パラメーター, 成分ごとの開始位置), ...]
+        self.sections = []
+        for number in range(section_count):
+            position = _HEADER.size + _SECTION.size * number
+            if len(self._map) < position + _SECTION.size:
+                raise ValueError('truncated sketch file')
+            code, count, parameters, points, starts = _SECTION.unpack_from(self._map, position)
+            cls, point_field_count, parameter_count = constraint_class(code)
+            self.sections.append((cls, self._array('<i4', (count, point_field_count), points),
+                                  self._array('<f8', (count, parameter_count), parameters),
+                                  self._array('<i8', (c + 1,), starts)))
+        self._decomposition = None
+
+    def _array(self, dtype, shape, offset):
+        size = np.dtype(dtype).itemsize * int(np.prod(shape))
+        if len(self._map) < offset + size:
+            raise ValueError('truncated sketch file')
+        return self._map[offset:offset + size].view(dtype).reshape(shape)
+
+    def __len__(self):
+        return self.point_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    @property
+    def constraint_count(self):
+        return sum(len(points) for _, points, _, _ in self.sections)
+
+    def constraints(self, k=None):
+        """
+        :param k: A component index, or None for every constraint.
+        :return: Constraint objects made from the rows of the file.
+        """
+        if k is None:
+            return [c for cls, points, parameters, _ in self.sections for c in unpack_constraints(cls, points, parameters)]
+        return [c for cls, points, parameters, starts in self.sections
+                for c in unpack_constraints(cls, points[starts[k]:starts[k + 1]], parameters[starts[k]:starts[k + 1]])]
+
+    def component(self, k):
+        """
+        Build component k from its rows of the file.
+        """
+        points = self.component_points[self.point_starts[k]:self.point_starts[k + 1]].astype(np.intp)
+        return Component(points, self.constraints(k))
+
+    @property
+    def decomposition(self):
+        if self._decomposition is None:
+            self._decomposition = MappedDecomposition(self)
+        return self._decomposition
+
+    def solve(self, target_index, target_x, target_y, method=None, callback=None, budget=None):
+        """
+        Drag a point towards the target, solving only its component and writing the solution
+        into the file's coordinate array.
+        :param budget: Optional time limit in seconds, as for Sketch.solve.
+        :return: {component index: OptimizeResult}
+        """
+        deadline = None if budget is None else time.monotonic() + budget
+        _, results = self.decomposition.solve(self.coordinates, target_x, target_y, point_index(target_index),
+                                              only_dragged=True, method=method, callback=callback,
+                                              in_place=True, deadline=deadline)
+        return results
+
+    def to_sketch(self):
+        """
+        :return: An in-memory sketch.Sketch holding a copy of everything in the file.
+        """
+        from sketch import Sketch
+
+        return Sketch.from_arrays(np.array(self.coordinates), np.array(self.segments), self.constraints())
+
+    def flush(self):
+        """
+        Write the solved coordinates to disk now (closing the file does it too).
+        """
+        if self._map.mode in ('r+', 'w+'):
+            self._map.flush()
+
+    def close(self):
+        if self._map is None:
+            return
+        self.flush()
+        self._map = self._decomposition = None
+        self.coordinates = self.segments = self.component_of = self.component_points = self.point_starts = None
+        self.sections = []
+
+class LazyComponents:
+    """
+    The components of a SketchFile as a sequence, each built when first indexed.
+    """
+    def __init__(self, sketch_file):
+        self.file = sketch_file
+        self.built = {}
+
+    def __len__(self):
+        return self.file.component_count
+
+    def __getitem__(self, k):
+        k = int(k)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        if k not in self.built:
+            self.built[k] = self.file.component(k)
+        return self.built[k]
+
+class MappedDecomposition(Decomposition):
+    """
+    The Decomposition stored in a SketchFile: component_of is a view of the file and
+    components are built lazily, so solving the dragged component reads only its own rows.
+    """
+    def __init__(self, sketch_file):
+        self.point_count = sketch_file.point_count
+        self.component_of = sketch_file.component_of
+        self.components = LazyComponents(sketch_file)
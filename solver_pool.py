@@ -0,0 +1,415 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from dof import Unsolvable
+from metrics import registry
+
+###########################################
+# ソルバーのワーカープロセス群
+#
+# /optimize の計算をFlaskのリクエストスレッドから切り離し、
+# scipy/NumPyを読み込み済みのワーカープロセスで実行します。
+#   - 各リクエストには締め切りがあり、締め切りを過ぎたものは実行前に捨て、
+#     実行中のものはソルバーのコールバックで打ち切ります。
+#   - ワーカーごとの待ち行列には上限があり、溢れたら Overloaded を送出します。
+#   - ドラッグセッションは作成したワーカーに固定し、そのワーカーが状態を保持します。
+#   - セッションを使わない要求の解は、ワーカーごとの SolutionCache に覚えます。
+#   - 解くたびの計測値 (metrics.solve_record) は結果と一緒に返し、Flask側で集計します。
+#   - 解く前に制約の自由度を解析し (dof.AnalysisCache)、矛盾した制約は解かずに Unsolvable で断ります。
+#   - セッションのフレームには時間の予算を付けられます。予算内に収束しなければ途中の解を返し、
+#     refine_session で続きを解きます (収束するか次のフレームが来るまで、Flask側から繰り返し送ります)。
+#   - 差分モードのフレームは、前回返した座標から動いた点だけを返します (SolveSession.changes)。
+###########################################
+
+class Overloaded(Exception):
+    """Every worker already has max_pending requests queued."""
+
+class UnknownSession(KeyError):
+    """The session does not exist, or was evicted by its worker."""
+
+###########################################
+# ワーカープロセス側
+
+class _WorkerState:
+    def __init__(self, idle_timeout, max_sessions, cache_size, cache_tolerance):
+        from cache import SolutionCache
+        from dof import AnalysisCache
+        from session import SessionStore
+
+        self.sessions = SessionStore(idle_timeout=idle_timeout, max_sessions=max_sessions)
+        self.cache = SolutionCache(max_entries=cache_size, tolerance=cache_tolerance)
+        # 制約の並び → 自由度の解析
+        self.analyses = AnalysisCache()
+        # 直前のリクエストの計測値 (解かないリクエストでは None)
+        self.record = None
+
+def _check_constraints(state, problem):
+    # 矛盾した制約は、反復回数の上限まで解いてから失敗する代わりにすぐ断ります。
+    analysis = state.analyses.get(problem.constraints, problem.points_array)
+    if not analysis.consistent:
+        raise Unsolvable(analysis.to_dict(problem.names))
+
+def _solve(state, callback, problem):
+    from cache import cached_solve
+    from decompose import Decomposition
+    from metrics import Stopwatch, solve_record
+
+    _check_constraints(state, problem)
+    solved = []
+
+    def solve(initial_point):
+        decomposition = Decomposition(problem.constraints, len(initial_point) // 2)
+        x, results = decomposition.solve(initial_point, problem.target_x, problem.target_y,
+                                         problem.target_index, callback=callback)
+        solved.extend(results.values())
+        return x, bool(results[decomposition.component_of[problem.target_index]].success)
+
+    cache_stats = state.cache.stats()
+    with Stopwatch() as stopwatch:
+        x, success = cached_solve(state.cache, solve, problem.constraints, problem.points_array,
+                                  problem.target_x, problem.target_y, problem.target_index)
+    state.record = solve_record('solve', stopwatch, solved, success, len(problem.points_array) // 2,
+                                len(problem.constraints), cached=not solved,
+                                cache_events=state.cache.events_since(cache_stats))
+    return x, success
+
+def _create_session(state, callback, session_id, problem):
+    _check_constraints(state, problem)
+    state.sessions.create(problem, session_id)
+
+def _session_step(state, callback, session_id, target_index, target_x, target_y, budget=None):
+    from metrics import Stopwatch, solve_record
+
+    session = state.sessions.get(session_id)
+    if session is None:
+        raise UnknownSession(session_id)
+    with Stopwatch() as stopwatch:
+        result = session.solve(target_index, target_x, target_y, callback=callback, budget=budget)
+    state.record = solve_record('session', stopwatch, [result], bool(result.success), len(session.solution) // 2,
+                                sum(len(c.constraints) for c in session.decomposition.components))
+    return session, result
+
+def _solve_session(state, callback, session_id, target_index, target_x, target_y, budget=None):
+    session, result = _session_step(state, callback, session_id, target_index, target_x, target_y, budget)
+    if budget is None:
+        return session.frame(), bool(result.success)
+    return _anytime_value(session)
+
+def _solve_session_delta(state, callback, session_id, target_index, target_x, target_y, tolerance):
+    session, result = _session_step(state, callback, session_id, target_index, target_x, target_y)
+    indices, coordinates = session.changes(tolerance)
+    return indices, coordinates, bool(result.success)
+
+def _refine_session(state, callback, session_id, budget):
+    from metrics import Stopwatch, solve_record
+
+    session = state.sessions.get(session_id)
+    if session is None:
+        raise UnknownSession(session_id)
+    with Stopwatch() as stopwatch:
+        result = session.refine(budget, callback=callback)
+    if result is not None:
+        state.record = solve_record('refine', stopwatch, [result], bool(result.success), len(session.solution) // 2,
+                                    sum(len(c.constraints) for c in session.decomposition.components))
+    return _anytime_value(session)
+
+def _anytime_value(session):
+    # 途中の解も解き続けた解も全体の座標で返すので、差分モードの基準もそこに進めます。
+    x = session.frame()
+    return x, {'provisional': session.provisional is not None, 'residual': session.residual(x)}
+
+def _solve_batch(state, callback, problem, initial_points, targets, target_index):
+    from batch_solver import solve_batch
+    from metrics import Stopwatch, solve_record
+
+    _check_constraints(state, problem)
+    with Stopwatch() as stopwatch:
+        result = solve_batch(problem.constraints, initial_points, targets, target_index, callback=callback)
+    state.record = solve_record('batch', stopwatch, [result], bool(result.success.all()),
+                                len(problem.points_array) // 2, len(problem.constraints))
+    return result.x, result.success
+
+def _solve_trajectory(state, callback, problem, targets, target_index):
+    from metrics import Stopwatch, solve_record
+    from trajectory import solve_trajectory
+
+    _check_constraints(state, problem)
+    with Stopwatch() as stopwatch:
+        result = solve_trajectory(problem.constraints, problem.points_array, targets, target_index,
+                                  callback=callback)
+    state.record = solve_record('trajectory', stopwatch, [result], bool(result.success.all()),
+                                len(problem.points_array) // 2, len(problem.constraints))
+    report = {'success': result.success.tolist(), 'singular': result.singular,
+              'branch_switches': result.branch_switches, 'fallbacks': result.fallbacks}
+    return result.x, report
+
+def _delete_session(state, callback, session_id):
+    return state.sessions.remove(session_id)
+
+HANDLERS = {
+    'solve': _solve,
+    'create': _create_session,
+    'session': _solve_session,
+    'refine': _refine_session,
+    'delta': _solve_session_delta,
+    'batch': _solve_batch,
+    'trajectory': _solve_trajectory,
+    'delete': _delete_session,
+}
+
+def _worker_main(requests, results, options):
+    # 最初のリクエストを待たせないよう、重いモジュールを先に読み込みます。
+    import scipy.optimize
+    import scipy.sparse.linalg
+    import decompose
+
+    state = _WorkerState(**options)
+    results.put((None, 'ready', os.getpid(), None))
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, deadline, kind, args = message
+        if time.time() > deadline:
+            results.put((request_id, 'cancelled', None, None))
+            continue
+
+        def callback(x):
+            if time.time() > deadline:
+                raise StopIteration
+
+        state.record = None
+        try:
+            value = HANDLERS[kind](state, callback, *args)
+            results.put((request_id, 'ok', value, state.record))
+        except UnknownSession as e:
+            results.put((request_id, 'unknown', str(e), None))
+        except Unsolvable as e:
+            results.put((request_id, 'unsolvable', e.report, None))
+        except Exception as e:
+            results.put((request_id, 'error', repr(e), state.record))
+
+###########################################
+# Flask側
+
+class _Worker:
+    def __init__(self, context, results, options):
+        self.requests = context.Queue()
+        self.process = context.Process(target=_worker_main, args=(self.requests, results, options),
+                                       daemon=True)
+        self.process.start()
+        # このワーカーに送って、まだ結果が返っていないリクエスト
+        self.pending = set()
+        # このワーカーが持っているセッションの数
+        self.session_count = 0
+
+class SolverPool:
+    """
+    A pool of solver processes with per-request deadlines and bounded queues.
+    :param processes: Number of worker processes (default: number of CPUs).
+    :param max_pending: Requests allowed in flight per worker before Overloaded is raised.
+    :param timeout: Default deadline of a request, in seconds.
+    :param idle_timeout: Idle time after which a worker drops a drag session.
+    :param max_sessions: Drag sessions kept open in the whole pool (each worker keeps its share).
+    :param cache_size: Solutions each worker keeps in its SolutionCache.
+    :param cache_tolerance: Targets closer than this share a cached solution.
+    :param metrics: metrics.SolveMetrics collecting the workers' solve records (default: metrics.registry).
+    """
+    def __init__(self, processes=None, max_pending=4, timeout=1.0, idle_timeout=300.0, max_sessions=10000,
+                 cache_size=1024, cache_tolerance=0.5, metrics=None):
+        self.max_pending = max_pending
+        self.metrics = registry if metrics is None else metrics
+        self.timeout = timeout
+        self.max_sessions = max_sessions
+        processes = processes or os.cpu_count() or 1
+        # セッションはワーカーに均等に割り振るので、各ワーカーは上限を等分した数 (切り上げ) まで持ちます。
+        self.options = {'idle_timeout': idle_timeout, 'max_sessions': -(-max_sessions // processes),
+                        'cache_size': cache_size, 'cache_tolerance': cache_tolerance}
+        self.context = multiprocessing.get_context('spawn')
+        self.results = self.context.Queue()
+        self.workers = [_Worker(self.context, self.results, self.options) for _ in range(processes)]
+        # 全てのワーカーがscipyを読み込み終わるまで待ちます。
+        for _ in self.workers:
+            self.results.get()
+        # session id → (ワーカー番号, 点の名前)
+        self.sessions = OrderedDict()
+        self.futures = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _collect(self):
+        while True:
+            try:
+                message = self.results.get()
+            except (EOFError, OSError):
+                return
+            if message is None:
+                return
+            request_id, status, value, record = message
+            if status == 'ready':
+                continue
+            if record is not None:
+                self.metrics.observe(record)
+            with self.lock:
+                future, kind = self.futures.pop(request_id, (None, None))
+                for worker in self.workers:
+                    worker.pending.discard(request_id)
+            if kind is not None:
+                self.metrics.count_request(kind, status)
+            if future is None or future.done():
+                continue
+            if status == 'ok':
+                future.set_result(value)
+            elif status == 'unknown':
+                future.set_exception(UnknownSession(value))
+            elif status == 'unsolvable':
+                future.set_exception(Unsolvable(value))
+            elif status == 'cancelled':
+                future.set_exception(TimeoutError('deadline passed before the solve started'))
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _submit(self, index, kind, args, timeout):
+        with self.lock:
+            if index is None:
+                index = min(range(len(self.workers)), key=lambda i: len(self.workers[i].pending))
+            worker = self.workers[index]
+            if not worker.process.is_alive():
+                # 落ちたワーカーは作り直します (そのワーカーのセッションは失われます)。
+                for lost in worker.pending:
+                    future, lost_kind = self.futures.pop(lost, (None, None))
+                    if future is not None:
+                        self.metrics.count_request(lost_kind, 'lost')
+                        future.set_exception(RuntimeError('solver worker exited'))
+                lost_sessions = worker.session_count
+                worker = self.workers[index] = _Worker(self.context, self.results, self.options)
+                # 失われたセッションも閉じられるまでは数に入れておきます (閉じるときに減らすため)。
+                worker.session_count = lost_sessions
+            # セッションを閉じる要求は、混んでいても断りません。
+            if len(worker.pending) >= self.max_pending and kind != 'delete':
+                raise Overloaded(f'worker {index} has {len(worker.pending)} requests queued')
+            request_id = next(self.counter)
+            future = Future()
+            self.futures[request_id] = (future, kind)
+            worker.pending.add(request_id)
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        worker.requests.put((request_id, deadline, kind, args))
+        return future
+
+    def solve(self, problem, timeout=None):
+        """
+        Solve a stateless problem on the least busy worker.
+        :return: A Future of (flat coordinate array, success).
+        """
+        return self._submit(None, 'solve', (problem,), timeout)
+
+    def create_session(self, problem, timeout=None):
+        """
+        Open a drag session on the worker with the fewest sessions (of those, the least busy one)
+        and wait until it exists. When max_sessions are open, the least recently used one is closed first.
+        :return: The session id.
+        """
+        with self.lock:
+            evicted = []
+            while self.sessions and len(self.sessions) >= self.max_sessions:
+                evicted_id, (evicted_index, _) = self.sessions.popitem(last=False)
+                self.workers[evicted_index].session_count -= 1
+                evicted.append((evicted_index, evicted_id))
+            # 先に閉じておけば、どのワーカーも上限を等分した数を超えません。
+            index = min(range(len(self.workers)),
+                        key=lambda i: (self.workers[i].session_count, len(self.workers[i].pending)))
+            # 同時に作られるセッションと数がずれないよう、作り終わる前に枠を取っておきます
+            # (id はまだ誰にも渡していないので、作りかけのセッションが使われることはありません)。
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = (index, problem.names)
+            self.workers[index].session_count += 1
+        try:
+            for evicted_index, evicted_id in evicted:
+                self._submit(evicted_index, 'delete', (evicted_id,), None)
+            future = self._submit(index, 'create', (session_id, problem), timeout)
+            future.result(timeout=self.timeout if timeout is None else timeout)
+        except BaseException:
+            self.delete_session(session_id)
+            raise
+        return session_id
+
+    def session_names(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:
+                raise UnknownSession(session_id)
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id][1]
+
+    def solve_session(self, session_id, target_index, target_x, target_y, timeout=None, budget=None):
+        """
+        Solve the next frame of a drag session on the worker that holds it.
+        :param budget: Optional time limit of the solve in seconds (see SolveSession.solve).
+        :return: A Future of (flat coordinate array, success), or with a budget of
+            (flat coordinate array, {'provisional': stopped before converging, 'residual': constraint violation}).
+        """
+        index = self._session_worker(session_id)
+        return self._submit(index, 'session', (session_id, target_index, target_x, target_y, budget), timeout)
+
+    def solve_session_delta(self, session_id, target_index, target_x, target_y, tolerance, timeout=None):
+        """
+        Solve the next frame of a drag session and return only the points that moved more than
+        tolerance since the last delta frame (see SolveSession.changes).
+        :return: A Future of (point indices (k,), coordinates (k, 2), success).
+        """
+        index = self._session_worker(session_id)
+        return self._submit(index, 'delta', (session_id, target_index, target_x, target_y, tolerance), timeout)
+
+    def refine_session(self, session_id, budget, timeout=None):
+        """
+        Keep solving a frame that ran out of its budget for another budget seconds.
+        :return: A Future of (flat coordinate array, {'provisional': ..., 'residual': ...}) as from solve_session.
+        """
+        index = self._session_worker(session_id)
+        return self._submit(index, 'refine', (session_id, budget), timeout)
+
+    def _session_worker(self, session_id):
+        with self.lock:
+            if session_id not in self.sessions:
+                raise UnknownSession(session_id)
+            return self.sessions[session_id][0]
+
+    def solve_batch(self, problem, initial_points, targets, target_index, timeout=None):
+        """
+        Solve one problem for many targets at once (see batch_solver.solve_batch) on the least busy worker.
+        :return: A Future of (coordinates of shape (B, 2n), success array of shape (B,)).
+        """
+        return self._submit(None, 'batch', (problem, initial_points, targets, target_index), timeout)
+
+    def solve_trajectory(self, problem, targets, target_index, timeout=None):
+        """
+        Drag one point along a path (see trajectory.solve_trajectory) on the least busy worker.
+        :return: A Future of (frames of shape (number of frames, 2n),
+            {'success': per frame, 'singular': frames, 'branch_switches': frames, 'fallbacks': frames}).
+        """
+        return self._submit(None, 'trajectory', (problem, targets, target_index), timeout)
+
+    def delete_session(self, session_id):
+        with self.lock:
+            index, _ = self.sessions.pop(session_id, (None, None))
+            if index is not None:
+                self.workers[index].session_count -= 1
+        if index is None:
+            return False
+        self._submit(index, 'delete', (session_id,), None)
+        return True
+
+    def close(self):
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=1.0)
+        self.results.put(None)
+        self.collector.join(timeout=1.0)
@@ -0,0 +1,210 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
+
+from optimize import compile_constraints, objective_function
+
+###########################################
+# 疎行列を使うガウス・ニュートン / レーベンバーグ・マーカート法
+#
+# 各反復で、制約を線形化した上でラグランジュ関数の二次近似を最小化します。
+#   min  |x_t + dx_t - target|^2 + mu |dx|^2 + dx^T (sum lambda_k d²c_k) dx / 2   s.t.  c(x) + J dx = 0
+# KKT系 [[H + mu I, J^T], [J, -delta I]] を疎行列のLU分解で解くので、
+# 1つの制約が2〜4座標にしか触れない大きなスケッチでも計算量はほぼ線形です。
+# mu は減衰項で、同時にドラッグと関係のない点をなるべく動かさない役割も持ちます。
+# ステップは L1 メリット関数 (目的関数 + penalty |c|_1) が減るときだけ受け入れ、減らないときは
+# 二次補正をかけてもう一度判定します。
+# ステップの計算 (kkt_step) と採否 (merit_step) は問題を積み重ねたまま扱えるので、batch_solver も同じものを使います。
+###########################################
+
+# 棄却されたステップにかける二次補正の最大回数
+SOC_ITERATIONS = 3
+
+def kkt_step(system, z, residuals, gradient, hessian_diagonal, damping, multipliers, delta):
+    """
+    Newton steps of a stack of drag problems that share one constraint system.
+    The KKT system of every problem goes on the diagonal of one sparse matrix, so the whole stack
+    costs one sparse LU factorization.
+    :param system: The CompiledConstraints of every problem, evaluated on stacked points.
+    :param z: Current points, shape (B, n).
+    :param residuals: Constraint residuals at z, shape (B, m).
+    :param gradient: Gradients of the objective at z, shape (B, n).
+    :param hessian_diagonal: Diagonal of the objective's Hessian, shape (B, n).
+    :param damping: Levenberg-Marquardt damping, shape (B,).
+    :param multipliers: Multipliers of the last accepted step, shape (B, m).
+    :param delta: Regularization of the constraint block, so redundant constraints stay solvable.
+    :return: (steps, shape (B, n), their multipliers, shape (B, m), solve_kkt), where
+        solve_kkt(positions in the stack, right-hand sides of shape (k, n + m)) reuses the factorization.
+    :raises np.linalg.LinAlgError: If the factorization fails.
+    """
+    count, n = z.shape
+    m = residuals.shape[1]
+    size = n + m
+    jacobian_rows, jacobian_cols, jacobian_values = system.jacobian_entries(z)
+    # ヘッセ行列は目的関数の対角と、直前の乗数で重み付けした制約の二階微分の和です。
+    # 目標に届かない場合は乗数が大きくなるので、制約の曲率を入れないと拘束面に沿って少しずつしか進めません。
+    hessian_rows, hessian_cols, hessian_values = system.hessian_entries(z, multipliers)
+    diagonal = np.arange(size)
+    rows = np.concatenate([diagonal, hessian_rows, n + jacobian_rows, jacobian_cols])
+    cols = np.concatenate([diagonal, hessian_cols, jacobian_cols, n + jacobian_rows])
+    values = np.concatenate([hessian_diagonal + damping[:, None], np.full((count, m), -delta), hessian_values,
+                             jacobian_values, jacobian_values], axis=1)
+    # 問題 b の系は行・列とも b * size からの区画に置きます (同じ位置の値は加算されます)。
+    offsets = size * np.arange(count)[:, None]
+    kkt = csc_matrix((values.ravel(), ((rows + offsets).ravel(), (cols + offsets).ravel())),
+                     shape=(count * size, count * size))
+    try:
+        # KKT系は対称なので、対称モードと A + A^T の最小次数順序で分解してフィルインを抑えます。
+        factor = splu(kkt, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.0, options={'SymmetricMode': True})
+    except RuntimeError as error:
+        raise np.linalg.LinAlgError(str(error)) from None
+    # 正則化の分だけ制約がずれないよう、直前の乗数で右辺を補正します (近接点法)。
+    rhs = np.concatenate([-gradient, -residuals - delta * multipliers], axis=1)
+    solution = factor.solve(rhs.ravel()).reshape(count, size)
+    if not np.all(np.isfinite(solution)):
+        raise np.linalg.LinAlgError('Singular KKT system')
+
+    def solve_kkt(positions, rhs):
+        stacked = np.zeros((count, size))
+        stacked[positions] = rhs
+        return factor.solve(stacked.ravel()).reshape(count, size)[positions]
+
+    return solution[:, :n], solution[:, n:], solve_kkt
+
+def merit_step(system, objective, z, residuals, step, multipliers, penalty, damping, solve_kkt):
+    """
+    Accept or reject Newton steps by the L1 merit function, vectorized over a stack of problems.
+    A rejected step gets second-order corrections: a step along the linearized constraints leaves
+    the curved constraint surface, so the merit function can reject even full steps next to the
+    solution (the Maratos effect). The same KKT system solved for c(x + dx) pulls it back, up to
+    SOC_ITERATIONS times while the violation keeps shrinking.
+    :param system: The CompiledConstraints of every problem, evaluated on stacked points.
+    :param objective: Function (stacked points, positions in the stack) returning the objective of each.
+    :param z: Current points, shape (B, n).
+    :param residuals: Constraint residuals at z, shape (B, m).
+    :param step: Newton steps, shape (B, n).
+    :param multipliers: Multipliers of the steps, shape (B, m).
+    :param penalty: Penalty weights of the merit function, shape (B,).
+    :param damping: Levenberg-Marquardt damping, shape (B,).
+    :param solve_kkt: Function (positions in the stack, right-hand sides of shape (k, n + m)) solving
+        the KKT systems the steps came from; may raise np.linalg.LinAlgError.
+    :return: An OptimizeResult with accept (B,), x and residuals of the candidates, step (including
+        corrections), the updated penalty and damping, and nfev, the number of stacked residual evaluations.
+    """
+    n, m = z.shape[1], residuals.shape[1]
+    if m:
+        penalty = np.maximum(penalty, 2 * np.max(np.abs(multipliers), axis=1) + 1)
+    candidate = z + step
+    candidate_residuals = system.residuals(candidate)
+    nfev = 1
+    positions = np.arange(len(z))
+    merit = objective(z, positions) + penalty * np.sum(np.abs(residuals), axis=1)
+    accept = objective(candidate, positions) + penalty * np.sum(np.abs(candidate_residuals), axis=1) <= merit
+
+    # 補正はニュートン法の射影なので、残差が二次収束で減る限り数回まで繰り返します。
+    rejected = np.flatnonzero(~accept) if m else np.array([], dtype=int)
+    corrected, corrected_residuals = candidate[rejected], candidate_residuals[rejected]
+    step = step.copy()
+    for _ in range(SOC_ITERATIONS):
+        if not len(rejected):
+            break
+        rhs = np.concatenate([np.zeros((len(rejected), n)), -corrected_residuals], axis=1)
+        try:
+            correction = solve_kkt(rejected, rhs)[:, :n]
+        except np.linalg.LinAlgError:
+            break
+        previous = np.sum(np.abs(corrected_residuals), axis=1)
+        corrected = corrected + correction
+        corrected_residuals = system.residuals(corrected)
+        nfev += 1
+        step[rejected] += correction
+        violation = np.sum(np.abs(corrected_residuals), axis=1)
+        better = objective(corrected, rejected) + penalty[rejected] * violation <= merit[rejected]
+        candidate[rejected[better]] = corrected[better]
+        candidate_residuals[rejected[better]] = corrected_residuals[better]
+        accept[rejected[better]] = True
+        # 受理されたものと、残差が減らなくなったものは補正をやめます。
+        going = ~better & (violation < previous)
+        rejected, corrected, corrected_residuals = rejected[going], corrected[going], corrected_residuals[going]
+
+    damping = np.where(accept, np.maximum(damping / 3, 1e-12), damping * 4)
+    return OptimizeResult(accept=accept, x=candidate, residuals=candidate_residuals, step=step,
+                          penalty=penalty, damping=damping, nfev=nfev)
+
+def solve_sparse(constraints, initial_point, target_x, target_y, target_index=0,
+                 maxiter=100, tol=1e-8, mu=1e-3, delta=1e-10, callback=None):
+    """
+    Sparse constrained Gauss-Newton / Levenberg-Marquardt solve of the drag problem.
+    :param constraints: A list of Constraint objects, or a CompiledConstraints.
+    :param initial_point: Flat array of the starting coordinates of every point.
+    :param maxiter: Maximum number of accepted or rejected steps.
+    :param tol: Tolerance on the constraint violation and on the step length.
+    :param mu: Initial damping.
+    :param delta: Regularization of the constraint block, so redundant constraints stay solvable.
+    :param callback: Called with x after each accepted step; may raise StopIteration to stop early.
+    :return: A scipy OptimizeResult with the same fields minimize reports.
+    """
+    compiled = compile_constraints(constraints)
+    x = np.array(initial_point, dtype=float)
+    n = len(x)
+    m = compiled.size
+    target = np.array([target_x, target_y], dtype=float)
+    cols = np.array([2 * target_index, 2 * target_index + 1])
+
+    # 目的関数のヘッセ行列は対象点の2座標だけが2で、他は0です。
+    hessian_diagonal = np.zeros(n)
+    hessian_diagonal[cols] = 2.0
+
+    def objective(points, positions):
+        return np.sum((points[:, cols] - target) ** 2, axis=1)
+
+    residuals = compiled.residuals(x)
+    penalty = 1.0
+    multipliers = np.zeros(m)
+    nfev, njev = 1, 0
+    status, message = 1, 'Iteration limit reached'
+    nit = 0
+    for nit in range(1, maxiter + 1):
+        gradient = np.zeros(n)
+        gradient[cols] = 2 * (x[cols] - target)
+        njev += 1
+        # 1問題だけの積み重ねとして解き、判定します (二次補正も同じ分解で解きます)。
+        try:
+            step, candidate_multipliers, solve_kkt = kkt_step(compiled, x[None], residuals[None], gradient[None],
+                                                              hessian_diagonal[None], np.array([mu]),
+                                                              multipliers[None], delta)
+        except np.linalg.LinAlgError:
+            # 特異な場合は減衰を強めてやり直します。
+            mu *= 10
+            continue
+        taken = merit_step(compiled, objective, x[None], residuals[None], step, candidate_multipliers,
+                           np.array([penalty]), np.array([mu]), solve_kkt)
+        nfev += taken.nfev
+        penalty, mu = float(taken.penalty[0]), float(taken.damping[0])
+        if taken.accept[0]:
+            x, residuals, multipliers = taken.x[0], taken.residuals[0], candidate_multipliers[0]
+            step = taken.step[0]
+            small_step = np.linalg.norm(step) <= tol * (1 + np.linalg.norm(x))
+            feasible = not m or np.max(np.abs(residuals)) <= tol
+            if small_step and feasible:
+                status, message = 0, 'Optimization terminated successfully'
+                break
+            if callback is not None:
+                try:
+                    callback(x)
+                except StopIteration:
+                    status, message = 99, '`callback` raised `StopIteration`.'
+                    break
+
+    return OptimizeResult(
+        x=x,
+        success=status == 0,
+        status=status,
+        message=message,
+        fun=objective_function(x, target_x, target_y, target_index),
+        maxcv=float(np.max(np.abs(residuals))) if m else 0.0,
+        nit=nit,
+        nfev=nfev,
+        njev=njev,
+    )
@@ -8,39 +8,111 @@ let data = {
     displacement: [0, 0]
 };
 
+// サーバー側のドラッグセッションID (直前のフレームの解から解き直すために使う)
+let sessionId = null;
+let sessionRequest = null;
+
+// 結果を受け取るストリームと、送った目標位置の連番
+// 1フレームの計算時間の予算 (秒)。間に合わなければ途中の解が届き、続きが同じ連番で届きます。
+const FRAME_BUDGET = 0.016;
+let stream = null;
+let seq = 0;
+let drawnSeq = -1;
+
+function draw(newCoordinates) {
+    // canvasをクリア
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+    // 新しい座標をcanvasに描画
+    ctx.beginPath();
+    ctx.moveTo(data.a.x, data.a.y);
+    ctx.lineTo(newCoordinates.b.x, newCoordinates.b.y);
+    ctx.lineTo(newCoordinates.c.x, newCoordinates.c.y);
+    ctx.lineTo(data.d.x, data.d.y);
+    ctx.lineTo(data.a.x, data.a.y);
+    ctx.stroke();
+}
+
+function openStream() {
+    stream = new EventSource('/drag/' + sessionId + '/stream?budget=' + FRAME_BUDGET);
+    stream.onmessage = (event) => {
+        let r_data = JSON.parse(event.data);
+
+        // セッションが破棄されていたら作り直す
+        if (r_data.error === 'unknown session') {
+            resetSession();
+            return;
+        }
+        // 古い結果は描画しない (同じ連番でも、途中の解を解き直したものは描画する)
+        if (r_data.points === undefined || r_data.seq < drawnSeq || (r_data.seq === drawnSeq && !r_data.refined)) {
+            return;
+        }
+        drawnSeq = r_data.seq;
+        draw(r_data.points);
+    };
+    stream.onerror = () => {
+        // 接続が切れたら作り直す (EventSourceの自動再接続では古いセッションに繋がるため)
+        resetSession();
+    };
+}
+
+function resetSession() {
+    if (stream !== null) {
+        stream.close();
+        stream = null;
+    }
+    sessionId = null;
+    createSession();
+}
+
+function createSession() {
+    if (sessionRequest === null) {
+        sessionRequest = fetch('/session', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(data)
+        })
+        .then(response => response.json())
+        .then(r_data => {
+            sessionId = r_data.session;
+            if (sessionId !== undefined) {
+                openStream();
+            } else {
+                sessionId = null;
+            }
+        })
+        .catch((error) => {
+            console.error('Error:', error);
+        })
+        .finally(() => {
+            sessionRequest = null;
+        });
+    }
+    return sessionRequest;
+}
+
+createSession();
+
 canvas.addEventListener('mousemove', (event) => {
     // マウスカーソルの位置を取得
     let mouseX = event.clientX - canvas.offsetLeft;
     let mouseY = event.clientY - canvas.offsetTop;
 
-    // c点とマウスカーソルの位置との相対位置を計算
-    data.displacement[0] = mouseX - data.c.x;
-    data.displacement[1] = mouseY - data.c.y;
+    if (sessionId === null) {
+        createSession();
+        return;
+    }
 
-    // /optimize エンドポイントにデータを送信
-    fetch('/optimize', {
+    // c点の目標位置を連番付きで送信 (結果はストリームで届き、古い目標はサーバー側で捨てられる)
+    seq += 1;
+    fetch('/drag/' + sessionId, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify(data)
-    })
-    .then(response => response.json())
-    .then(r_data => {
-        // 最適化後の新しい座標を取得
-        let newCoordinates = r_data;
-
-        // canvasをクリア
-        ctx.clearRect(0, 0, canvas.width, canvas.height);
-
-        // 新しい座標をcanvasに描画
-        ctx.beginPath();
-        ctx.moveTo(data.a.x, data.a.y);
-        ctx.lineTo(newCoordinates.b.x, newCoordinates.b.y);
-        ctx.lineTo(newCoordinates.c.x, newCoordinates.c.y);
-        ctx.lineTo(data.d.x, data.d.y);
-        ctx.lineTo(data.a.x, data.a.y);
-        ctx.stroke();
+        body: JSON.stringify({seq: seq, target: {point: 'c', x: mouseX, y: mouseY}})
     })
     .catch((error) => {
         console.error('Error:', error);
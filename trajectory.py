@@ -0,0 +1,269 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import splu
+
+from decompose import Decomposition
+from presolve import Presolve
+
+###########################################
+# 経路に沿ったドラッグ (アニメーション) の連続解法
+#
+# 目標位置の列を、前のフレームの解と接線を使う予測子・修正子法で順に解きます。
+#   予測子: KKT系 K = [[H, J^T], [J, -delta I]] を目標位置で微分した接線で次の解を予測します。
+#           K は前のフレームで分解済みのものをそのまま使います。
+#   修正子: 予測した点からKKT系のニュートン法で数回だけ修正します。
+# 修正子が収束しなければ目標の刻みを半分にしてやり直し、それでも駄目なら通常のソルバーで解きます。
+# K の行列式の符号が変わったフレームは分岐の切り替わり (特異点の通過)、
+# LU分解の最小の相対ピボットが最初のフレームより桁違いに小さくなったフレームは特異な配置として報告します。
+# 修正子が予測から大きく離れた点に収束した場合も、別の停留点に飛び移らないよう刻みを細かくします。
+# POST /optimize/trajectory はワーカーでこれを呼び、全フレームをまとめて返します。
+# 動くのはドラッグした点を含む成分だけなので、固定点などを取り除いたその成分だけを追跡します。
+###########################################
+
+def _permutation_parity(permutation):
+    """
+    :return: +1 for an even permutation, -1 for an odd one.
+    """
+    seen = np.zeros(len(permutation), dtype=bool)
+    transpositions = 0
+    for start in range(len(permutation)):
+        length = 0
+        i = start
+        while not seen[i]:
+            seen[i] = True
+            i = permutation[i]
+            length += 1
+        transpositions += max(length - 1, 0)
+    return -1 if transpositions % 2 else 1
+
+class _Tracker:
+    """
+    Continuation state of the reduced system of the dragged component: the solution,
+    its multipliers and the factorized KKT matrix there.
+    """
+    def __init__(self, system, z, target_index, tol, max_corrections, delta):
+        self.system = system
+        self.z = np.array(z, dtype=float)
+        self.multipliers = np.zeros(system.size)
+        self.columns = np.array([2 * target_index, 2 * target_index + 1])
+        self.tol = tol
+        self.max_corrections = max_corrections
+        self.delta = delta
+        self.lu = None
+        # 直近のフレームで分解したKKT行列の、最小の相対ピボット (特異点への近さ)
+        self.smallest_pivot_ratio = np.inf
+        self.nfev = 0
+        self.njev = 0
+
+    def factorize(self, z, multipliers):
+        n, m = len(z), self.system.size
+        # KKT行列は要素 (行, 列, 値) を並べて一度に組み立てます (bmat などを重ねると組み立てが分解より重くなります)。
+        hessian_rows, hessian_cols, hessian_values = self.system.hessian_entries(z, multipliers)
+        jacobian_rows, jacobian_cols, jacobian_values = self.system.jacobian_entries(z)
+        self.njev += 1
+        rows = np.concatenate([hessian_rows, self.columns, n + jacobian_rows, jacobian_cols, n + np.arange(m)])
+        cols = np.concatenate([hessian_cols, self.columns, jacobian_cols, n + jacobian_rows, n + np.arange(m)])
+        values = np.concatenate([hessian_values, [2.0, 2.0], jacobian_values, jacobian_values, np.full(m, -self.delta)])
+        kkt = coo_matrix((values, (rows, cols)), shape=(n + m, n + m)).tocsc()
+        # 減衰項がないのでヘッセ行列のブロックは対角が0になり得ます。対称モードではなく、
+        # 部分ピボット選択付きで分解します。
+        return splu(kkt)
+
+    def correct(self, z, multipliers, target):
+        """
+        Newton's method on the KKT conditions from (z, multipliers).
+        :return: (z, multipliers, LU factorization near z, iterations), or None if it did not converge.
+        """
+        previous = np.inf
+        for iteration in range(1, self.max_corrections + 1):
+            try:
+                lu = self.factorize(z, multipliers)
+            except RuntimeError:
+                return None
+            gradient = np.zeros(len(z))
+            gradient[self.columns] = 2 * (z[self.columns] - target)
+            residuals = self.system.residuals(z)
+            self.nfev += 1
+            solution = lu.solve(np.concatenate([-gradient, -residuals - self.delta * multipliers]))
+            step = solution[:len(z)]
+            if not np.all(np.isfinite(solution)):
+                return None
+            z, multipliers = z + step, solution[len(z):]
+            size = np.max(np.abs(step), initial=0.0)
+            if size <= self.tol * (1 + np.max(np.abs(z), initial=0.0)):
+                residuals = self.system.residuals(z)
+                self.nfev += 1
+                if np.max(np.abs(residuals), initial=0.0) <= self.tol:
+                    self.smallest_pivot_ratio = min(self.smallest_pivot_ratio, _pivot_ratio(lu))
+                    return z, multipliers, lu, iteration
+            # ニュートン法が縮小していなければ、予測が遠すぎたとみなします。
+            if size > previous:
+                return None
+            previous = size
+        return None
+
+    def predict(self, shift):
+        """
+        First-order change of (z, multipliers) when the target moves by shift.
+        """
+        rhs = np.zeros(len(self.z) + self.system.size)
+        rhs[self.columns] = 2 * np.asarray(shift, dtype=float)
+        tangent = self.lu.solve(rhs)
+        return self.z + tangent[:len(self.z)], self.multipliers + tangent[len(self.z):]
+
+    def advance(self, start, end, halvings):
+        """
+        Move the target from start to end, halving the step while the corrector fails.
+        :return: (states passed through as (z, multipliers, lu), corrector iterations), or None.
+        """
+        predicted, multipliers = self.predict(end - start)
+        corrected = self.correct(predicted, multipliers, end)
+        if corrected is not None:
+            z, multipliers, lu, iterations = corrected
+            # 予測から大きく離れた点に収束した場合は、別の停留点に飛び移ったとみなして刻みを細かくします。
+            allowed = 10 * (np.max(np.abs(predicted - self.z), initial=0.0) + np.max(np.abs(end - start)))
+            if np.max(np.abs(z - predicted), initial=0.0) <= allowed + self.tol:
+                return [(z, multipliers, lu)], iterations
+        if not halvings:
+            return None
+        middle = (start + end) / 2
+        first = self.advance(start, middle, halvings - 1)
+        if first is None:
+            return None
+        saved = self.z, self.multipliers, self.lu
+        self.z, self.multipliers, self.lu = first[0][-1]
+        second = self.advance(middle, end, halvings - 1)
+        self.z, self.multipliers, self.lu = saved
+        if second is None:
+            return None
+        return first[0] + second[0], first[1] + second[1]
+
+    def reset(self, z, target):
+        """
+        Start tracking from a solved configuration.
+        :return: Whether the KKT conditions could be solved there.
+        """
+        z = np.array(z, dtype=float)
+        # 乗数は停留条件 grad f + J^T multipliers = 0 の最小二乗解から始めます。
+        # 0から始めると目標に届かない場合の最初のニュートンステップが大きく外れます。
+        gradient = np.zeros(len(z))
+        gradient[self.columns] = 2 * (z[self.columns] - target)
+        multipliers = np.linalg.lstsq(self.system.jacobian(z).T, -gradient, rcond=None)[0]
+        corrected = self.correct(z, multipliers, target)
+        if corrected is None:
+            return False
+        self.z, self.multipliers, self.lu, _ = corrected
+        return True
+
+def _determinant_sign(lu):
+    pivots = lu.U.diagonal()
+    return int(np.prod(np.sign(pivots))) * _permutation_parity(lu.perm_r) * _permutation_parity(lu.perm_c)
+
+def _pivot_ratio(lu):
+    pivots = np.abs(lu.U.diagonal())
+    return float(pivots.min() / pivots.max()) if len(pivots) and pivots.max() > 0 else 1.0
+
+def solve_trajectory(constraints, initial_point, targets, target_index=0, tol=1e-8, max_corrections=8,
+                     max_halvings=6, singular_tol=0.1, delta=1e-10, method=None, callback=None):
+    """
+    Drag a point along a path of targets, one frame per target, by predictor-corrector continuation.
+    The first frame is solved from initial_point with Decomposition.solve, every later one from the previous.
+    :param targets: Target positions, shape (number of frames, 2).
+    :param max_corrections: Newton iterations allowed per step before the step is halved.
+    :param max_halvings: How often a step may be halved before the frame is solved from scratch.
+    :param singular_tol: Frames where the smallest relative LU pivot of the KKT matrix falls below this fraction
+        of its value at the first frame are reported as singular.
+    :param method: Passed on to solve_problem for the first frame and for fallbacks.
+    :param callback: Called with each frame's coordinates; may raise StopIteration to stop early.
+    :return: A scipy OptimizeResult with
+        x: the frames, shape (number of frames, len(initial_point)),
+        success, nit: per frame (nit counts corrector iterations),
+        singular: frames at a singular configuration,
+        branch_switches: frames reached by passing through a singularity (the branch may have changed),
+        fallbacks: frames the continuation could not reach, solved by the normal solver instead.
+    """
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    decomposition = Decomposition(constraints, len(initial_point) // 2)
+    frames = np.empty((len(targets), len(initial_point)))
+    success = np.zeros(len(targets), dtype=bool)
+    nit = np.zeros(len(targets), dtype=int)
+    singular, branch_switches, fallbacks = [], [], []
+    status, message = 0, 'Trajectory solved'
+    if not len(targets):
+        return OptimizeResult(x=frames, success=success, status=status, message=message, nit=nit,
+                              singular=singular, branch_switches=branch_switches, fallbacks=fallbacks)
+
+    x, results = decomposition.solve(initial_point, targets[0, 0], targets[0, 1], target_index, method=method)
+    dragged = decomposition.component_of[target_index]
+    frames[0] = x
+    success[0] = results[dragged].success
+    nit[0] = results[dragged].get('nit', 0)
+
+    component = decomposition.components[dragged]
+    local_target = component.local_index(target_index)
+    presolve = Presolve(component.compiled.constraints, x[component.columns])
+    reduced_target = presolve.target_index(local_target)
+    tracker = None
+    tracking = False
+    if reduced_target is not None and presolve.system.size:
+        tracker = _Tracker(presolve.system, presolve.reduce(x[component.columns]), reduced_target,
+                           tol, max_corrections, delta)
+        tracking = tracker.reset(tracker.z, targets[0])
+    if tracking:
+        sign = _determinant_sign(tracker.lu)
+        # ピボットの大きさは寸法の単位に依存するので、最初のフレームとの比で判定します。
+        reference_ratio = _pivot_ratio(tracker.lu)
+
+    for k in range(1, len(targets)):
+        if callback is not None:
+            try:
+                callback(frames[k - 1])
+            except StopIteration:
+                frames[k:] = frames[k - 1]
+                status, message = 99, '`callback` raised `StopIteration`.'
+                break
+
+        frames[k] = frames[k - 1]
+        advanced = None
+        if tracking:
+            tracker.smallest_pivot_ratio = np.inf
+            advanced = tracker.advance(targets[k - 1], targets[k], max_halvings)
+        if advanced is not None:
+            states, nit[k] = advanced
+            success[k] = True
+            for state in states:
+                state_sign = _determinant_sign(state[2])
+                if state_sign != sign and k not in branch_switches:
+                    branch_switches.append(k)
+                sign = state_sign
+            tracker.z, tracker.multipliers, tracker.lu = states[-1]
+            if tracker.smallest_pivot_ratio < singular_tol * reference_ratio:
+                singular.append(k)
+            frames[k][component.columns] = presolve.expand(tracker.z)
+            continue
+
+        # 連続法で届かないフレームは通常のソルバーで解き、そこから追跡し直します。
+        result = decomposition.solve_component(component, frames[k], targets[k, 0], targets[k, 1], target_index,
+                                               method)
+        success[k] = result.success
+        nit[k] = result.get('nit', 0)
+        if tracking:
+            fallbacks.append(k)
+            # 刻みを細かくしても届かなかったのは、多くの場合その手前で特異点に近づいたためです。
+            passed_singularity = tracker.smallest_pivot_ratio < singular_tol * reference_ratio
+            if passed_singularity:
+                singular.append(k)
+            tracking = tracker.reset(presolve.reduce(frames[k][component.columns]), targets[k])
+            if tracking:
+                state_sign = _determinant_sign(tracker.lu)
+                if state_sign != sign or passed_singularity:
+                    branch_switches.append(k)
+                sign = state_sign
+
+    if status == 0 and not success.all():
+        status, message = 1, 'Some frames did not converge'
+    return OptimizeResult(x=frames, success=success, status=status, message=message, nit=nit,
+                          nfev=tracker.nfev if tracker is not None else 0,
+                          njev=tracker.njev if tracker is not None else 0,
+                          singular=singular, branch_switches=branch_switches, fallbacks=fallbacks)
@@ -0,0 +1,264 @@
+import inspect
+import struct
+
+import numpy as np
+
+from optimize import Constraint, point_index
+from protocol import Problem, finite
+
+###########################################
+# /optimize のバイナリ形式
+#
+# 大きなスケッチでは名前付きの点のJSONの変換が解くより遅くなるので、
+# Content-Type: application/x-sketch-solver のときは詰めた配列でやり取りします。
+# 数値はすべてリトルエンディアンで、float64 の配列は8バイト境界から始まるので、
+# サーバーは np.frombuffer でリクエストのバイト列をコピーせずにそのまま配列として読みます。
+# 点は名前ではなく番号 (座標配列での順番) で指します。
+#
+# 問題 (PROBLEM, 1回で解く / POST /session でセッションを作る)
+#   ヘッダー 40バイト: magic 'SKW1', 種類 uint8, 点の数 n uint32, 制約の区画の数 uint32,
+#                      ドラッグする点 int32, 目標位置 x, y float64
+#   座標 float64[2n]
+#   区画 (制約の種類ごと): 種類 uint16, 個数 k uint32 (8バイト),
+#                          パラメーター float64[k, 数値の属性の数], 点 int32[k, 点の属性の数], 8バイト境界までの詰め物
+# 結果 (RESULT)
+#   ヘッダー 16バイト: magic, 種類, 収束したか uint8, 点の数 n uint32;  座標 float64[2n]
+#
+# 差分モード: ドラッグセッションに動かした点だけを送り、前回クライアントに返した座標から
+# tolerance より動いた点だけを受け取ります。
+# 差分 (DELTA)
+#   56バイト: magic, 種類, セッションID 16バイト, ドラッグする点 int32, 目標位置 x, y float64, tolerance float64
+# 差分の結果 (DELTA_RESULT)
+#   ヘッダー 16バイト: magic, 種類, 収束したか uint8, 変わった点の数 k uint32;
+#   座標 float64[k, 2], 点の番号 int32[k]
+# 差分の結果を受け取り損ねたら、クライアントの座標がずれるので、セッションを作り直してください。
+###########################################
+
+MEDIA_TYPE = 'application/x-sketch-solver'
+MAGIC = b'SKW1'
+
+PROBLEM, RESULT, DELTA, DELTA_RESULT = 1, 2, 3, 4
+
+_PROBLEM = struct.Struct('<4sB3xIIi4xdd')
+_SECTION = struct.Struct('<H2xI')
+_RESULT = struct.Struct('<4sB?2xI4x')
+_DELTA = struct.Struct('<4sB3x16si4xddd')
+
+# 制約の種類の番号 (通信で使うので、番号は変えずに追加してください)
+CONSTRAINT_TYPES = {
+    1: 'FixedPointConstraint',
+    2: 'FixedDistanceConstraint',
+    3: 'CoincidentConstraint',
+    4: 'HorizontalConstraint',
+    5: 'VerticalConstraint',
+    6: 'ParallelConstraint',
+    7: 'PerpendicularConstraint',
+    8: 'AngleConstraint',
+    9: 'PointOnLineConstraint',
+    10: 'PointOnCircleConstraint',
+    11: 'EqualLengthConstraint',
+}
+_TYPE_CODES = {name: code for code, name in CONSTRAINT_TYPES.items()}
+
+def _constraint_class(name):
+    return {subclass.__name__: subclass for subclass in Constraint.__subclasses__()}[name]
+
+def _parameter_fields(cls):
+    # コンストラクターの引数のうち、点以外のもの (すべて数値) の並び
+    names = list(inspect.signature(cls.__init__).parameters)[1:]
+    return [name for name in names if name not in cls.point_fields]
+
+def constraint_class(code):
+    """
+    :return: The Constraint subclass of a type code, with its number of (point, parameter) fields.
+    """
+    if code not in CONSTRAINT_TYPES:
+        raise ValueError(f'unknown constraint type code: {code}')
+    cls = _constraint_class(CONSTRAINT_TYPES[code])
+    return cls, len(cls.point_fields), len(_parameter_fields(cls))
+
+def type_code(cls):
+    if cls.__name__ not in _TYPE_CODES:
+        raise TypeError(f'{cls.__name__} has no binary type code')
+    return _TYPE_CODES[cls.__name__]
+
+def pack_constraints(constraints):
+    """
+    Group constraints by type into arrays, in order of first appearance.
+    :param constraints: Constraint objects with integer or 'p<i>' point names.
+    :return: [(constraint class, points (k, number of point fields) int32,
+        parameters (k, number of parameter fields) float64), ...]
+    """
+    groups = {}
+    for constraint in constraints:
+        groups.setdefault(type(constraint), []).append(constraint)
+    sections = []
+    for cls, group in groups.items():
+        type_code(cls)
+        fields = _parameter_fields(cls)
+        parameters = np.array([[getattr(c, field) for field in fields] for c in group],
+                              dtype='<f8').reshape(len(group), len(fields))
+        points = np.array([[point_index(p) for p in c.points()] for c in group],
+                          dtype='<i4').reshape(len(group), len(cls.point_fields))
+        sections.append((cls, points, parameters))
+    return sections
+
+def unpack_constraints(cls, points, parameters):
+    """
+    Constraint objects from the rows of one section of pack_constraints.
+    """
+    parameter_fields = _parameter_fields(cls)
+    return [cls(**dict(zip(cls.point_fields, point_row)), **dict(zip(parameter_fields, parameter_row)))
+            for point_row, parameter_row in zip(points.tolist(), parameters.tolist())]
+
+def _padding(size):
+    return -size % 8
+
+###########################################
+# デコード
+
+class PackedProblem(Problem):
+    """
+    A Problem decoded from the binary format. Coordinates and constraint parameters stay
+    NumPy views of the request bytes; Constraint objects and point names ('p0', 'p1', ...)
+    are made only when something asks for them, and only the arrays are pickled.
+    :param sections: [(constraint class, points (k, number of point fields) int32,
+        parameters (k, number of parameter fields) float64), ...]
+    """
+    def __init__(self, points_array, sections, target_index=0, target_x=0.0, target_y=0.0):
+        self.points_array = points_array
+        self.sections = sections
+        self.target_index = target_index
+        self.target_x = target_x
+        self.target_y = target_y
+        self._names = None
+        self._constraints = None
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = [f'p{i}' for i in range(len(self.points_array) // 2)]
+        return self._names
+
+    @property
+    def constraints(self):
+        if self._constraints is None:
+            self._constraints = [constraint for section in self.sections for constraint in unpack_constraints(*section)]
+        return self._constraints
+
+    def __getstate__(self):
+        return {**self.__dict__, '_names': None, '_constraints': None}
+
+def message_kind(body):
+    """
+    :return: The kind of a binary message (PROBLEM, RESULT, DELTA or DELTA_RESULT).
+    """
+    if len(body) < 8 or bytes(body[:4]) != MAGIC:
+        raise ValueError('not a binary solver message')
+    return body[4]
+
+def decode_problem(body):
+    """
+    :param body: bytes of a PROBLEM message.
+    :return: A PackedProblem whose arrays are read-only views of body.
+    """
+    if message_kind(body) != PROBLEM or len(body) < _PROBLEM.size:
+        raise ValueError('truncated problem message')
+    _, _, point_count, section_count, target_index, target_x, target_y = _PROBLEM.unpack_from(body)
+    offset = _PROBLEM.size
+    points_array = _array(body, '<f8', 2 * point_count, offset)
+    offset += 16 * point_count
+
+    sections = []
+    for _ in range(section_count):
+        if len(body) < offset + _SECTION.size:
+            raise ValueError('truncated constraint section')
+        code, count = _SECTION.unpack_from(body, offset)
+        offset += _SECTION.size
+        cls, point_field_count, parameter_count = constraint_class(code)
+        parameters = _array(body, '<f8', count * parameter_count, offset).reshape(count, parameter_count)
+        offset += 8 * count * parameter_count
+        points = _array(body, '<i4', count * point_field_count, offset).reshape(count, point_field_count)
+        offset += 4 * count * point_field_count
+        offset += _padding(offset)
+        if len(points) and (points.min() < 0 or points.max() >= point_count):
+            raise ValueError(f'{cls.__name__} refers to a point that does not exist')
+        finite(parameters, f'{cls.__name__} parameters')
+        sections.append((cls, points, parameters))
+
+    if point_count and not 0 <= target_index < point_count:
+        raise ValueError('the dragged point does not exist')
+    finite(points_array, 'point coordinates')
+    finite((target_x, target_y), 'the target')
+    return PackedProblem(points_array, sections, target_index, target_x, target_y)
+
+def decode_delta(body):
+    """
+    :param body: bytes of a DELTA message.
+    :return: (session id as hex, target_index, target_x, target_y, tolerance)
+    """
+    if message_kind(body) != DELTA or len(body) < _DELTA.size:
+        raise ValueError('truncated delta message')
+    _, _, session_id, target_index, target_x, target_y, tolerance = _DELTA.unpack_from(body)
+    finite((target_x, target_y), 'the target')
+    return session_id.hex(), target_index, target_x, target_y, tolerance
+
+def decode_result(body):
+    """
+    :return: (flat coordinate array, success) of a RESULT message.
+    """
+    if message_kind(body) != RESULT or len(body) < _RESULT.size:
+        raise ValueError('truncated result message')
+    _, _, success, point_count = _RESULT.unpack_from(body)
+    return _array(body, '<f8', 2 * point_count, _RESULT.size), success
+
+def decode_delta_result(body):
+    """
+    :return: (point indices int32 (k,), coordinates (k, 2), success) of a DELTA_RESULT message.
+    """
+    if message_kind(body) != DELTA_RESULT or len(body) < _RESULT.size:
+        raise ValueError('truncated delta result message')
+    _, _, success, count = _RESULT.unpack_from(body)
+    coordinates = _array(body, '<f8', 2 * count, _RESULT.size).reshape(count, 2)
+    return _array(body, '<i4', count, _RESULT.size + 16 * count), coordinates, success
+
+def _array(body, dtype, count, offset):
+    if len(body) < offset + np.dtype(dtype).itemsize * count:
+        raise ValueError('truncated message')
+    return np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+
+###########################################
+# エンコード
+
+def encode_problem(points_array, constraints, target_index=0, target_x=0.0, target_y=0.0):
+    """
+    :param points_array: Flat coordinates of every point.
+    :param constraints: Constraint objects with integer or 'p<i>' point names.
+    :return: bytes of a PROBLEM message.
+    """
+    points_array = np.asarray(points_array, dtype='<f8')
+    sections = pack_constraints(constraints)
+    parts = [_PROBLEM.pack(MAGIC, PROBLEM, len(points_array) // 2, len(sections), target_index,
+                           target_x, target_y), points_array.tobytes()]
+    for cls, points, parameters in sections:
+        size = _SECTION.size + parameters.nbytes + points.nbytes
+        parts += [_SECTION.pack(type_code(cls), len(points)), parameters.tobytes(), points.tobytes(),
+                  bytes(_padding(size))]
+    return b''.join(parts)
+
+def encode_result(points_array, success):
+    points_array = np.asarray(points_array, dtype='<f8')
+    return _RESULT.pack(MAGIC, RESULT, bool(success), len(points_array) // 2) + points_array.tobytes()
+
+def encode_delta(session_id, target_index, target_x, target_y, tolerance=0.0):
+    """
+    :param session_id: The id returned by POST /session (32 hex digits).
+    :param tolerance: Points that moved less than this (in x and y) since the last reply are left out.
+    """
+    return _DELTA.pack(MAGIC, DELTA, bytes.fromhex(session_id), target_index, target_x, target_y, tolerance)
+
+def encode_delta_result(indices, coordinates, success):
+    indices = np.asarray(indices, dtype='<i4')
+    coordinates = np.asarray(coordinates, dtype='<f8').reshape(-1, 2)
+    return (_RESULT.pack(MAGIC, DELTA_RESULT, bool(success), len(indices)) + coordinates.tobytes()
+            + indices.tobytes())